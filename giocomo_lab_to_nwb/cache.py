@@ -0,0 +1,102 @@
+"""Fingerprints of conversion inputs, to skip sessions whose output is already up to date.
+
+A fingerprint hashes the files a session is converted from (size and modification time, or their contents), the
+resolved metadata and options of the conversion, the compression policy and the version of the converter. It is
+stored next to the output as ``<output>.fingerprint.json``.
+"""
+import hashlib
+import json
+import os
+import uuid
+from functools import lru_cache
+from pathlib import Path
+
+from .compression import get_policy
+
+# namespace of the identifiers derived from fingerprints
+IDENTIFIER_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/ben-dichter-consulting/giocomo-lab-to-nwb')
+
+
+@lru_cache(maxsize=None)
+def converter_version():
+    """Version of the package, with a hash of its source so that any change to the converters is picked up."""
+    try:
+        from importlib.metadata import version
+        package_version = version('giocomo_lab_to_nwb')
+    except Exception:
+        package_version = 'unknown'
+    source = hashlib.sha256()
+    package_path = Path(__file__).parent
+    for file_path in sorted(package_path.rglob('*')):
+        if file_path.suffix in ('.py', '.yml', '.json'):
+            source.update(str(file_path.relative_to(package_path)).encode())
+            source.update(file_path.read_bytes())
+    return '{}+{}'.format(package_version, source.hexdigest()[:12])
+
+
+def _file_state(file_path, hash_contents):
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 24), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _input_state(path, hash_contents):
+    path = Path(path)
+    if not path.is_dir():
+        return _file_state(path, hash_contents)
+    return {str(file_path.relative_to(path)): _file_state(file_path, hash_contents)
+            for file_path in sorted(path.rglob('*')) if file_path.is_file()}
+
+
+def fingerprint(input_paths, metadata=None, hash_contents=False):
+    """Fingerprint the inputs of the conversion of one session.
+
+    Parameters
+    ----------
+    input_paths: iterable of str | Path
+        files and directories the session is converted from. Directories are fingerprinted file by file.
+    metadata: dict | None (optional)
+        anything else the output depends on, e.g. resolved metadata and conversion options. Values that are not
+        JSON are taken as their str.
+    hash_contents: bool (optional)
+        hash the contents of the files instead of their size and modification time
+    Returns
+    -------
+    str
+    """
+    state = dict(
+        inputs={str(Path(path).resolve()): _input_state(path, hash_contents) for path in input_paths},
+        metadata=metadata,
+        compression=get_policy(),
+        converter=converter_version(),
+    )
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fingerprint_path(output_path):
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + '.fingerprint.json')
+
+
+def is_up_to_date(output_path, session_fingerprint):
+    """Whether `output_path` exists and was written from inputs with `session_fingerprint`."""
+    if not Path(output_path).exists() or not fingerprint_path(output_path).exists():
+        return False
+    with open(fingerprint_path(output_path), 'r') as f:
+        return json.load(f).get('fingerprint') == session_fingerprint
+
+
+def write_fingerprint(output_path, session_fingerprint):
+    """Store the fingerprint of the inputs next to the output, once it is written."""
+    with open(fingerprint_path(output_path), 'w') as f:
+        json.dump(dict(fingerprint=session_fingerprint, converter=converter_version()), f, indent=2)
+
+
+def deterministic_identifier(session_fingerprint):
+    """NWBFile identifier derived from the fingerprint, the same every time the same inputs are converted."""
+    return str(uuid.uuid5(IDENTIFIER_NAMESPACE, session_fingerprint))
@@ -0,0 +1,145 @@
+"""Catalog of the files of each recording session, built by walking the data roots once.
+
+Every session directory under a data root is listed with os.scandir, together with its subdirectories, and the
+SpikeGLX AP, LF and NIDQ files, their .meta files and the behaviour text files are recorded. Converters then resolve
+their inputs by dictionary lookup instead of globbing the tree again::
+
+    catalog = build_catalog(['/data/spikeglx'], 'spikeglx_catalog.json')
+    session = find_session(catalog, 'npI5_0417')
+    session['ap'], session['behavior']['licks']
+
+The catalog can be persisted as JSON. A session is scanned again only when the modification time of its directory,
+or of one of its subdirectories, changed.
+"""
+import json
+import os
+
+# behaviour text files, recorded by the end of their name, e.g. 'npI5_0417_baseline_1_trial_times.txt'
+BEHAVIOR_KINDS = ('licks', 'reward_times', 'trial_times', 'position')
+
+# SpikeGLX files, recorded by the end of their name
+SPIKEGLX_KINDS = dict(
+    ap='imec0.ap.bin',
+    ap_meta='imec0.ap.meta',
+    lf='imec0.lf.bin',
+    lf_meta='imec0.lf.meta',
+    nidq='.nidq.bin',
+    nidq_meta='.nidq.meta',
+)
+
+# sessions cataloged by this process, by absolute path
+_sessions = dict()
+
+
+def _scandir(path):
+    with os.scandir(path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+def scan_session(session_path):
+    """Record the files of one session directory and of its subdirectories.
+
+    Parameters
+    ----------
+    session_path: str | Path
+    Returns
+    -------
+    dict
+        path: the session directory
+        ap, ap_meta, lf, lf_meta, nidq, nidq_meta: path of each SpikeGLX file, or None
+        behavior: kind -> paths of the behaviour text files of that kind, sorted by name
+        mtimes: directory -> modification time in ns, when it was scanned
+    """
+    session_path = os.path.abspath(session_path)
+    session = dict(path=session_path, **{kind: None for kind in SPIKEGLX_KINDS}, behavior=dict(), mtimes=dict())
+    directories = [session_path]
+    for depth in range(2):
+        subdirectories = []
+        for directory in directories:
+            session['mtimes'][directory] = os.stat(directory).st_mtime_ns
+            for entry in _scandir(directory):
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                    continue
+                for kind, ending in SPIKEGLX_KINDS.items():
+                    if session[kind] is None and entry.name.endswith(ending):
+                        session[kind] = entry.path
+                if depth == 0 and entry.name.endswith('.txt'):
+                    for kind in BEHAVIOR_KINDS:
+                        if entry.name.endswith(kind + '.txt'):
+                            session['behavior'].setdefault(kind, []).append(entry.path)
+        directories = subdirectories
+    return session
+
+
+def is_current(session):
+    """Whether none of the directories of a cataloged session was modified since it was scanned."""
+    try:
+        return all(os.stat(directory).st_mtime_ns == mtime for directory, mtime in session['mtimes'].items())
+    except OSError:
+        return False
+
+
+def build_catalog(roots, catalog_path=None):
+    """Catalog every session directory under the data roots.
+
+    Parameters
+    ----------
+    roots: iterable of str | Path
+        directories whose subdirectories are sessions
+    catalog_path: str | Path | None (optional)
+        JSON file the catalog is read from and written to. Sessions whose directories did not change since are not
+        scanned again.
+    Returns
+    -------
+    dict
+        absolute path of each session directory -> its files, see `scan_session`
+    """
+    previous = dict()
+    if catalog_path is not None and os.path.exists(catalog_path):
+        with open(catalog_path, 'r') as f:
+            previous = json.load(f)
+
+    catalog = dict()
+    for root in roots:
+        for entry in _scandir(os.path.abspath(root)):
+            if not entry.is_dir():
+                continue
+            session = previous.get(entry.path)
+            if session is None or not is_current(session):
+                session = scan_session(entry.path)
+            catalog[entry.path] = session
+
+    if catalog_path is not None and catalog != previous:
+        try:
+            with open(catalog_path, 'w') as f:
+                json.dump(catalog, f, indent=1)
+        except OSError:
+            # read-only location, the catalog is rebuilt next time
+            pass
+    _sessions.update(catalog)
+    return catalog
+
+
+def find_session(catalog, prefix):
+    """The first session, by name, whose directory name starts with `prefix`, e.g. 'npI5_0417'."""
+    for path in sorted(catalog, key=os.path.basename):
+        if os.path.basename(path).startswith(prefix):
+            return catalog[path]
+    raise KeyError("no session starting with '{}' in the catalog".format(prefix))
+
+
+def session_paths(session):
+    """Every file recorded for a cataloged session, e.g. to fingerprint it without walking its directory again."""
+    paths = [session[kind] for kind in SPIKEGLX_KINDS if session[kind] is not None]
+    for kind_paths in session['behavior'].values():
+        paths.extend(kind_paths)
+    return paths
+
+
+def session_files(session_path):
+    """Files of a session, from the catalog built by this process, or scanned now if it is not cataloged."""
+    session_path = os.path.abspath(session_path)
+    if session_path not in _sessions:
+        _sessions[session_path] = scan_session(session_path)
+    return _sessions[session_path]
@@ -0,0 +1,235 @@
+"""Benchmark compression codecs on short samples of a session and recommend a compression policy.
+
+Each sample is written with every candidate codec, chunked as the current policy chunks its kind, to an HDF5 file
+held in memory. The write throughput, compression ratio and latency of reading one random chunk are measured, and
+the best codec of each kind is written as a profile that compression.set_policy reads, e.g.::
+
+    samples = dict(
+        raw=spikeglx_sample('session_g0_t0.imec0.ap.bin'),
+        lfp=spikeglx_sample('session_g0_t0.imec0.lf.bin'),
+        spikes=mat_sample('npI5_0417_baseline_1.mat', 'sp/st'),
+        timeseries=mat_sample('npI5_0417_baseline_1.mat', 'posx'),
+    )
+    results = benchmark(samples)
+    print(format_results(results))
+    write_profile(recommend(results), 'compression_profile.yml', results)
+
+    compression.set_policy('compression_profile.yml')
+
+Blosc filters are only benchmarked when hdf5plugin is installed, and files written with them need hdf5plugin to be
+read. The raw and lfp kinds are written by nwb_conversion_tools, which only supports gzip and lzf.
+"""
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import yaml
+
+from .compression import chunk_shape, get_policy
+from .matfile import MatFile
+
+RECORDING_KINDS = ('raw', 'lfp')
+
+
+def candidate_codecs():
+    """HDF5 dataset options of each codec to benchmark, by name.
+
+    Returns
+    -------
+    dict
+    """
+    candidates = dict()
+    for level in (1, 4, 9):
+        candidates['gzip-{}'.format(level)] = dict(compression='gzip', compression_opts=level, shuffle=True)
+    candidates['lzf'] = dict(compression='lzf', compression_opts=None, shuffle=True)
+    try:
+        import hdf5plugin
+    except ImportError:
+        return candidates
+    for cname in ('lz4', 'zstd'):
+        blosc = dict(hdf5plugin.Blosc(cname=cname, clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        candidates['blosc-' + cname] = dict(compression=blosc['compression'],
+                                            compression_opts=tuple(blosc['compression_opts']), shuffle=False)
+    return candidates
+
+
+def read_spikeglx_meta(file_path):
+    """Read the .meta file next to a SpikeGLX .bin file into a dict of strings."""
+    with open(Path(file_path).with_suffix('.meta'), 'r') as f:
+        return dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+
+
+def spikeglx_sample(file_path, duration=10.):
+    """Read `duration` seconds from the middle of a SpikeGLX recording.
+
+    Parameters
+    ----------
+    file_path: str | Path
+        .ap.bin or .lf.bin file, with its .meta file next to it
+    duration: float (optional)
+        in seconds
+    Returns
+    -------
+    np.ndarray (n_samples, n_channels) of int16
+    """
+    meta = read_spikeglx_meta(file_path)
+    sampling_rate = float(meta.get('imSampRate', meta.get('niSampRate')))
+    recording = np.memmap(file_path, dtype=np.int16, mode='r').reshape(-1, int(meta['nSavedChans']))
+    n_samples = min(len(recording), int(duration * sampling_rate))
+    start = (len(recording) - n_samples) // 2
+    return np.array(recording[start:start + n_samples])
+
+
+def mat_sample(file_path, path, size=2 ** 20):
+    """Read `size` elements from the middle of a vector in a MATLAB v7.3 file.
+
+    Parameters
+    ----------
+    file_path: str | Path
+    path: str
+        variable or struct field, e.g. 'sp/st'
+    size: int (optional)
+    Returns
+    -------
+    np.ndarray
+    """
+    with MatFile(file_path) as matfile:
+        vector = matfile.array(path)
+        size = min(size, vector.size)
+        start = (vector.size - size) // 2
+        return vector.segment(start, start + size)
+
+
+def measure(data, options, chunks, n_reads=50, seed=0):
+    """Write `data` with one codec and time it.
+
+    Parameters
+    ----------
+    data: np.ndarray
+    options: dict
+        HDF5 dataset options of the codec
+    chunks: tuple
+    n_reads: int (optional)
+        number of random chunks read back
+    seed: int (optional)
+    Returns
+    -------
+    dict
+        write_mb_s: write throughput in MB/s of uncompressed data
+        ratio: uncompressed size over stored size
+        read_ms: median latency of reading one chunk, in milliseconds
+    """
+    options = {key: tuple(value) if isinstance(value, list) else value
+               for key, value in options.items() if value is not None}
+    with h5py.File('benchmark.h5', 'w', driver='core', backing_store=False) as f:
+        start = time.perf_counter()
+        dataset = f.create_dataset('data', data=data, chunks=chunks, **options)
+        f.flush()
+        write_time = time.perf_counter() - start
+
+        ratio = data.nbytes / max(dataset.id.get_storage_size(), 1)
+
+        rng = np.random.default_rng(seed)
+        n_chunks = -(-len(data) // chunks[0])
+        read_times = []
+        for chunk in rng.integers(0, n_chunks, n_reads):
+            selection = slice(chunk * chunks[0], (chunk + 1) * chunks[0])
+            start = time.perf_counter()
+            dataset[selection]
+            read_times.append(time.perf_counter() - start)
+
+    return dict(write_mb_s=data.nbytes / 1e6 / write_time, ratio=ratio, read_ms=1e3 * np.median(read_times))
+
+
+def benchmark(samples, candidates=None, n_reads=50):
+    """Measure every candidate codec on the sample of each kind of dataset.
+
+    Parameters
+    ----------
+    samples: dict
+        representative array of each kind of dataset in the policy, e.g. 'raw', 'lfp', 'spikes', 'timeseries'
+    candidates: dict | None (optional)
+        HDF5 dataset options by codec name. Defaults to `candidate_codecs()`.
+    n_reads: int (optional)
+    Returns
+    -------
+    dict
+        kind -> codec name -> measurements, see `measure`
+    """
+    if candidates is None:
+        candidates = candidate_codecs()
+    policy = get_policy()
+    results = dict()
+    for kind, data in samples.items():
+        data = np.asarray(data)
+        chunks = chunk_shape(policy.get(kind, policy['default']).get('chunks'), data.shape)
+        if not isinstance(chunks, tuple):
+            # automatic or contiguous chunking in the policy, benchmark with ~1 MB chunks along the first axis
+            chunks = (max(1, min(len(data), 2 ** 20 // max(1, data[:1].nbytes))),) + data.shape[1:]
+        results[kind] = dict()
+        for name, options in candidates.items():
+            if kind in RECORDING_KINDS and not isinstance(options['compression'], str):
+                continue
+            results[kind][name] = dict(measure(data, options, chunks, n_reads=n_reads), options=options)
+    return results
+
+
+def recommend(results, min_write_mb_s=50., max_read_ms=None):
+    """Pick the codec of each kind with the best compression ratio among those that are fast enough.
+
+    Parameters
+    ----------
+    results: dict
+        as returned by `benchmark`
+    min_write_mb_s: float (optional)
+        slowest acceptable write throughput
+    max_read_ms: float | None (optional)
+        slowest acceptable chunk read
+    Returns
+    -------
+    dict
+        kind -> HDF5 dataset options, i.e. a compression policy without chunks
+    """
+    profile = dict()
+    for kind, codecs in results.items():
+        fast = [name for name, result in codecs.items()
+                if result['write_mb_s'] >= min_write_mb_s
+                and (max_read_ms is None or result['read_ms'] <= max_read_ms)]
+        if fast:
+            best = max(fast, key=lambda name: (codecs[name]['ratio'], -codecs[name]['read_ms']))
+        else:
+            best = max(codecs, key=lambda name: codecs[name]['write_mb_s'])
+        # YAML has no tuples, plugin filter options are written as lists
+        profile[kind] = {key: list(value) if isinstance(value, tuple) else value
+                         for key, value in codecs[best]['options'].items()}
+    return profile
+
+
+def format_results(results):
+    """Format the measurements as a table, one line per kind and codec."""
+    lines = ['{:<12}{:<14}{:>12}{:>8}{:>10}'.format('kind', 'codec', 'write MB/s', 'ratio', 'read ms')]
+    for kind, codecs in results.items():
+        for name, result in codecs.items():
+            lines.append('{:<12}{:<14}{:>12.1f}{:>8.2f}{:>10.3f}'.format(
+                kind, name, result['write_mb_s'], result['ratio'], result['read_ms']))
+    return '\n'.join(lines)
+
+
+def write_profile(profile, file_path, results=None):
+    """Write a recommended profile as a compression policy YAML file, optionally with the measurements as comments.
+
+    Parameters
+    ----------
+    profile: dict
+        as returned by `recommend`
+    file_path: str | Path
+    results: dict | None (optional)
+        as returned by `benchmark`
+    """
+    with open(file_path, 'w') as f:
+        f.write('# Compression profile recommended by giocomo_lab_to_nwb.codec_benchmark\n')
+        if results is not None:
+            for line in format_results(results).split('\n'):
+                f.write('# ' + line + '\n')
+        yaml.safe_dump(profile, f, default_flow_style=None, sort_keys=False)
@@ -0,0 +1,118 @@
+from pathlib import Path
+
+import numpy as np
+import yaml
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator
+
+DEFAULT_POLICY_PATH = Path(__file__).parent / 'compression.yml'
+
+_policy = None
+
+
+def load_policy(file_path=None):
+    """Read a compression policy from YAML, on top of the package defaults.
+
+    Parameters
+    ----------
+    file_path: str | Path | None (optional)
+        YAML file mapping dataset kinds to HDF5 dataset options, see compression.yml
+    Returns
+    -------
+    dict
+    """
+    with open(DEFAULT_POLICY_PATH, 'r') as f:
+        policy = yaml.safe_load(f)
+    if file_path is not None:
+        with open(file_path, 'r') as f:
+            for kind, options in (yaml.safe_load(f) or dict()).items():
+                policy[kind] = dict(policy.get(kind, dict()), **(options or dict()))
+    return policy
+
+
+def set_policy(policy=None):
+    """Set the compression policy of this process.
+
+    Parameters
+    ----------
+    policy: dict | str | Path | None (optional)
+        a policy, a YAML file to read it from, or None to go back to the package defaults
+    """
+    global _policy
+    _policy = policy if isinstance(policy, dict) else load_policy(policy)
+
+
+def get_policy():
+    if _policy is None:
+        set_policy()
+    return _policy
+
+
+def chunk_shape(chunks, shape):
+    """Resolve the chunks of a policy entry for data of `shape`: null axes take the whole axis and no chunk is
+    larger than the data."""
+    if chunks is None or isinstance(chunks, bool):
+        return chunks
+    chunks = list(chunks)[:len(shape)] + [None] * (len(shape) - len(chunks))
+    return tuple(length if size is None else max(1, min(size, length)) for size, length in zip(chunks, shape))
+
+
+def compressed(data, kind='default'):
+    """Wrap data for writing with the chunking and compression that the policy sets for its kind.
+
+    Parameters
+    ----------
+    data: array-like | hdmf.data_utils.AbstractDataChunkIterator
+    kind: str (optional)
+        kind of dataset, a key of the policy, e.g. 'spikes', 'timeseries' or 'waveforms'
+    Returns
+    -------
+    H5DataIO | array-like
+        `data` itself when it is empty or already wrapped
+    """
+    if isinstance(data, H5DataIO):
+        return data
+    policy = get_policy()
+    options = dict(policy.get(kind, policy['default']))
+    if isinstance(data, AbstractDataChunkIterator):
+        shape = data.maxshape
+        if None in shape or not all(shape):
+            return data
+    else:
+        if not isinstance(data, np.ndarray):
+            data = np.asarray(data)
+        if not data.size or data.dtype == object:
+            return data
+        shape = data.shape
+
+    options['chunks'] = chunk_shape(options.get('chunks'), shape)
+    if not options['chunks']:
+        # contiguous datasets cannot be filtered
+        return data
+    if isinstance(options.get('compression'), int):
+        # filters from hdf5plugin (e.g. Blosc) are given by id, importing it registers them with HDF5
+        import hdf5plugin  # noqa: F401
+        options.setdefault('allow_plugin_filters', True)
+        if options.get('compression_opts') is not None:
+            options['compression_opts'] = tuple(options['compression_opts'])
+    return H5DataIO(data, **{key: value for key, value in options.items() if value is not None})
+
+
+def recording_options(kind='raw'):
+    """Compression options of a policy kind in the form taken by the run_conversion of the recording interfaces of
+    nwb_conversion_tools (e.g. SpikeGLXRecording), which only support the filters built into HDF5.
+
+    Parameters
+    ----------
+    kind: str (optional)
+        'raw' for AP band or 'lfp' for LF band recordings
+    Returns
+    -------
+    dict
+    """
+    policy = get_policy()
+    options = policy.get(kind, policy['default'])
+    if not isinstance(options.get('compression'), str):
+        raise ValueError("compression of '%s' must be gzip or lzf to be written by nwb_conversion_tools, got %s"
+                         % (kind, options.get('compression')))
+    return dict(compression=options['compression'], compression_opts=options.get('compression_opts'))
@@ -1,18 +1,32 @@
+import argparse
+import traceback
 import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import yaml
 
-import hdf5storage
 import numpy as np
 import pytz
 import sys
 from pynwb import NWBFile, NWBHDF5IO
-from pynwb.misc import Units
 from pynwb.file import Subject
 from pynwb.behavior import Position, BehavioralEvents
 from pynwb.image import ImageSeries
 from ndx_labmetadata_giocomo import LabMetaData_ext
 
+from giocomo_lab_to_nwb import cache
+from giocomo_lab_to_nwb.compression import compressed, set_policy
+from giocomo_lab_to_nwb.matfile import MatFile
+from giocomo_lab_to_nwb.tables import (
+    add_electrodes,
+    add_rows,
+    column,
+    make_template_units,
+    make_units,
+    waveform_columns,
+)
+from giocomo_lab_to_nwb.utils import cluster_templates, group_by_label, segment_runs
+
 
 def convert(
     input_file,
@@ -31,6 +45,10 @@ def convert(
     experiment_description="Virtual Hallway Task",
     institution="Stanford University School of Medicine",
     lab_name="Giocomo Lab",
+    share_spike_times=False,
+    waveform_dtype=None,
+    skip_unchanged=False,
+    deterministic_identifier=False,
 ):
     """
     Read in the .mat file specified by input_file and convert to .nwb format.
@@ -69,15 +87,26 @@ def convert(
         what institution was the experiment performed in
     lab_name : string
         the lab where the experiment was performed
+    share_spike_times : bool
+        if every cluster is exactly one template, store the spike times only in the units table and have
+        each TemplateUnits row refer to its unit instead of writing a second copy
+    waveform_dtype : None or str
+        None keeps the dtype of the templates, 'float32' or 'int16' converts them. Either way they are written as
+        one dataset chunked and compressed as 'waveforms' in the compression policy, by default one chunk per unit
+    skip_unchanged : bool
+        skip the conversion if the output exists and was converted from the same input file and arguments
+        by the same converter, according to the fingerprint stored next to it
+    deterministic_identifier : bool
+        derive the identifier of the NWB file from the fingerprint of the inputs instead of a random uuid,
+        so converting the same inputs again gives the same identifier
 
     Returns
     -------
     nwbfile : NWBFile
         The contents of the .mat file converted into the NWB format.  The nwbfile is saved to disk using NDWHDF5
     """
-
-    # input matlab data
-    matfile = hdf5storage.loadmat(input_file)
+    arguments = dict(locals())
+    arguments.pop("skip_unchanged")
 
     # output path for nwb data
     def replace_last(source_string, replace_what, replace_with):
@@ -86,6 +115,11 @@ def convert(
 
     outpath = replace_last(input_file, ".mat", ".nwb")
 
+    session_fingerprint = cache.fingerprint([input_file], metadata=arguments)
+    if skip_unchanged and cache.is_up_to_date(outpath, session_fingerprint):
+        print("up to date, skipping", outpath)
+        return None
+
     create_date = datetime.today()
     timezone_cali = pytz.timezone("US/Pacific")
     create_date_tz = timezone_cali.localize(create_date)
@@ -102,12 +136,15 @@ def convert(
         subject_date_of_birth = timezone_cali.localize(subject_date_of_birth)
 
     # create unique identifier for this experimental session
-    uuid_identifier = uuid.uuid1()
+    if deterministic_identifier:
+        identifier = cache.deterministic_identifier(session_fingerprint)
+    else:
+        identifier = uuid.uuid1().hex
 
     # Create NWB file
     nwbfile = NWBFile(
         session_description=experiment_description,  # required
-        identifier=uuid_identifier.hex,  # required
+        identifier=identifier,  # required
         session_id=session_id,
         experiment_description=experiment_description,
         experimenter=experimenter,
@@ -130,218 +167,222 @@ def convert(
     )
     nwbfile.subject = experiment_subject
 
-    # adding constants via LabMetaData container
-    # constants
-    sample_rate = float(matfile["sp"][0]["sample_rate"][0][0][0])
-    n_channels_dat = int(matfile["sp"][0]["n_channels_dat"][0][0][0])
-    dat_path = matfile["sp"][0]["dat_path"][0][0][0]
-    offset = int(matfile["sp"][0]["offset"][0][0][0])
-    data_dtype = matfile["sp"][0]["dtype"][0][0][0]
-    hp_filtered = bool(matfile["sp"][0]["hp_filtered"][0][0][0])
-    vr_session_offset = matfile["sp"][0]["vr_session_offset"][0][0][0]
-    # container
-    lab_metadata = LabMetaData_ext(
-        name="LabMetaData",
-        acquisition_sampling_rate=sample_rate,
-        number_of_electrodes=n_channels_dat,
-        file_path=dat_path,
-        bytes_to_skip=offset,
-        raw_data_dtype=data_dtype,
-        high_pass_filtered=hp_filtered,
-        movie_start_time=vr_session_offset,
-    )
-    nwbfile.add_lab_meta_data(lab_metadata)
-
-    # Adding trial information
-    nwbfile.add_trial_column(
-        "trial_contrast",
-        "visual contrast of the maze through which the mouse is running",
-    )
-    trial = np.ravel(matfile["trial"])
-    trial_nums = np.unique(trial)
-    position_time = np.ravel(matfile["post"])
-    # matlab trial numbers start at 1. To correctly index trial_contract vector,
-    # subtracting 1 from 'num' so index starts at 0
-    for num in trial_nums:
-        trial_times = position_time[trial == num]
-        nwbfile.add_trial(
-            start_time=trial_times[0],
-            stop_time=trial_times[-1],
-            trial_contrast=matfile["trial_contrast"][num - 1][0],
+    # input matlab data, read lazily field by field
+    with MatFile(input_file) as matfile:
+        # adding constants via LabMetaData container
+        # constants
+        sample_rate = float(matfile.scalar("sp/sample_rate"))
+        n_channels_dat = int(matfile.scalar("sp/n_channels_dat"))
+        dat_path = matfile.string("sp/dat_path")
+        offset = int(matfile.scalar("sp/offset"))
+        data_dtype = matfile.string("sp/dtype")
+        hp_filtered = bool(matfile.scalar("sp/hp_filtered"))
+        vr_session_offset = matfile.scalar("sp/vr_session_offset")
+        # container
+        lab_metadata = LabMetaData_ext(
+            name="LabMetaData",
+            acquisition_sampling_rate=sample_rate,
+            number_of_electrodes=n_channels_dat,
+            file_path=dat_path,
+            bytes_to_skip=offset,
+            raw_data_dtype=data_dtype,
+            high_pass_filtered=hp_filtered,
+            movie_start_time=vr_session_offset,
         )
+        nwbfile.add_lab_meta_data(lab_metadata)
 
-    # Add mouse position inside:
-    position = Position()
-    position_virtual = np.ravel(matfile["posx"])
-    # position inside the virtual environment
-    sampling_rate = 1 / (position_time[1] - position_time[0])
-    position.create_spatial_series(
-        name="Position",
-        data=position_virtual,
-        starting_time=position_time[0],
-        rate=sampling_rate,
-        reference_frame="The start of the trial, which begins at the start "
-        "of the virtual hallway.",
-        conversion=0.01,
-        description="Subject position in the virtual hallway.",
-        comments="The values should be >0 and <400cm. Values greater than "
-        "400cm mean that the mouse briefly exited the maze.",
-    )
-
-    # physical position on the mouse wheel
-    physical_posx = position_virtual
-    trial_gain = np.ravel(matfile["trial_gain"])
-    for num in trial_nums:
-        physical_posx[trial == num] = physical_posx[trial == num] / trial_gain[num - 1]
-
-    position.create_spatial_series(
-        name="PhysicalPosition",
-        data=physical_posx,
-        starting_time=position_time[0],
-        rate=sampling_rate,
-        reference_frame="Location on wheel re-referenced to zero "
-        "at the start of each trial.",
-        conversion=0.01,
-        description="Physical location on the wheel measured "
-        "since the beginning of the trial.",
-        comments="Physical location found by dividing the "
-        'virtual position by the "trial_gain"',
-    )
-    nwbfile.add_acquisition(position)
-
-    # Add timing of lick events, as well as mouse's virtual position during lick event
-    lick_events = BehavioralEvents()
-    lick_events.create_timeseries(
-        "LickEvents",
-        data=np.ravel(matfile["lickx"]),
-        timestamps=np.ravel(matfile["lickt"]),
-        unit="centimeter",
-        description="Subject position in virtual hallway during the lick.",
-    )
-    nwbfile.add_acquisition(lick_events)
-
-    # Add information on the visual stimulus that was shown to the subject
-    # Assumed rate=60 [Hz]. Update if necessary
-    # Update external_file to link to Unity environment file
-    visualization = ImageSeries(
-        name="ImageSeries",
-        unit="seconds",
-        format="external",
-        external_file=list(["https://unity.com/VR-and-AR-corner"]),
-        starting_time=vr_session_offset,
-        starting_frame=[[0]],
-        rate=float(60),
-        description="virtual Unity environment that the mouse navigates through",
-    )
-    nwbfile.add_stimulus(visualization)
+        # Adding trial information
+        nwbfile.add_trial_column(
+            "trial_contrast",
+            "visual contrast of the maze through which the mouse is running",
+        )
+        trial = matfile.vector("trial").astype(int)
+        position_time = matfile.vector("post")
+        trial_contrast = matfile.vector("trial_contrast")
+        # one pass over the samples finds where each trial starts and stops
+        trial_starts, trial_stops, trial_nums = segment_runs(trial)
+        # matlab trial numbers start at 1. To correctly index trial_contract vector,
+        # subtracting 1 from the trial numbers so index starts at 0
+        add_rows(
+            nwbfile.trials,
+            dict(
+                start_time=position_time[trial_starts],
+                stop_time=position_time[trial_stops - 1],
+                trial_contrast=trial_contrast[trial_nums - 1],
+            ),
+        )
 
-    # Add the recording device, a neuropixel probe
-    recording_device = nwbfile.create_device(name="neuropixel_probes")
-    electrode_group_description = (
-        "single neuropixels probe http://www.open-ephys.org/neuropixelscorded"
-    )
-    electrode_group_name = "probe1"
+        # Add mouse position inside:
+        position = Position()
+        position_virtual = matfile.vector("posx")
+        # position inside the virtual environment
+        sampling_rate = 1 / (position_time[1] - position_time[0])
+        position.create_spatial_series(
+            name="Position",
+            data=compressed(position_virtual, "timeseries"),
+            starting_time=position_time[0],
+            rate=sampling_rate,
+            reference_frame="The start of the trial, which begins at the start "
+            "of the virtual hallway.",
+            conversion=0.01,
+            description="Subject position in the virtual hallway.",
+            comments="The values should be >0 and <400cm. Values greater than "
+            "400cm mean that the mouse briefly exited the maze.",
+        )
 
-    electrode_group = nwbfile.create_electrode_group(
-        electrode_group_name,
-        description=electrode_group_description,
-        location=subject_brain_region,
-        device=recording_device,
-    )
+        # physical position on the mouse wheel
+        # divide each sample by the gain of its trial, into a new buffer so "Position" keeps the virtual position
+        trial_gain = matfile.vector("trial_gain")
+        physical_posx = position_virtual / trial_gain[trial - 1]
+
+        position.create_spatial_series(
+            name="PhysicalPosition",
+            data=compressed(physical_posx, "timeseries"),
+            starting_time=position_time[0],
+            rate=sampling_rate,
+            reference_frame="Location on wheel re-referenced to zero "
+            "at the start of each trial.",
+            conversion=0.01,
+            description="Physical location on the wheel measured "
+            "since the beginning of the trial.",
+            comments="Physical location found by dividing the "
+            'virtual position by the "trial_gain"',
+        )
+        nwbfile.add_acquisition(position)
+
+        # Add timing of lick events, as well as mouse's virtual position during lick event
+        lick_events = BehavioralEvents()
+        lick_events.create_timeseries(
+            "LickEvents",
+            data=compressed(matfile.vector("lickx"), "events"),
+            timestamps=compressed(matfile.vector("lickt"), "events"),
+            unit="centimeter",
+            description="Subject position in virtual hallway during the lick.",
+        )
+        nwbfile.add_acquisition(lick_events)
+
+        # Add information on the visual stimulus that was shown to the subject
+        # Assumed rate=60 [Hz]. Update if necessary
+        # Update external_file to link to Unity environment file
+        visualization = ImageSeries(
+            name="ImageSeries",
+            unit="seconds",
+            format="external",
+            external_file=list(["https://unity.com/VR-and-AR-corner"]),
+            starting_time=vr_session_offset,
+            starting_frame=[[0]],
+            rate=float(60),
+            description="virtual Unity environment that the mouse navigates through",
+        )
+        nwbfile.add_stimulus(visualization)
 
-    # Add information about each electrode
-    xcoords = np.ravel(matfile["sp"][0]["xcoords"][0])
-    ycoords = np.ravel(matfile["sp"][0]["ycoords"][0])
-    data_filtered_flag = matfile["sp"][0]["hp_filtered"][0][0]
-    if data_filtered_flag:
-        filter_desc = (
-            "The raw voltage signals from the electrodes were high-pass filtered"
+        # Add the recording device, a neuropixel probe
+        recording_device = nwbfile.create_device(name="neuropixel_probes")
+        electrode_group_description = (
+            "single neuropixels probe http://www.open-ephys.org/neuropixelscorded"
         )
-    else:
-        filter_desc = (
-            "The raw voltage signals from the electrodes were not high-pass filtered"
+        electrode_group_name = "probe1"
+
+        electrode_group = nwbfile.create_electrode_group(
+            electrode_group_name,
+            description=electrode_group_description,
+            location=subject_brain_region,
+            device=recording_device,
         )
 
-    num_recording_electrodes = xcoords.shape[0]
-    recording_electrodes = range(0, num_recording_electrodes)
-
-    # create electrode columns for the x,y location on the neuropixel  probe
-    # the standard x,y,z locations are reserved for Allen Brain Atlas location
-    nwbfile.add_electrode_column("rel_x", "electrode x-location on the probe")
-    nwbfile.add_electrode_column("rel_y", "electrode y-location on the probe")
-
-    for idx in recording_electrodes:
-        nwbfile.add_electrode(
-            id=idx,
-            x=np.nan,
-            y=np.nan,
-            z=np.nan,
-            rel_x=float(xcoords[idx]),
-            rel_y=float(ycoords[idx]),
-            imp=np.nan,
+        # Add information about each electrode
+        xcoords = matfile.vector("sp/xcoords")
+        ycoords = matfile.vector("sp/ycoords")
+        data_filtered_flag = matfile.scalar("sp/hp_filtered")
+        if data_filtered_flag:
+            filter_desc = (
+                "The raw voltage signals from the electrodes were high-pass filtered"
+            )
+        else:
+            filter_desc = "The raw voltage signals from the electrodes were not high-pass filtered"
+
+        # x,y location on the neuropixel probe are stored in rel_x and rel_y,
+        # the standard x,y,z locations are reserved for Allen Brain Atlas location
+        add_electrodes(
+            nwbfile,
+            groups=[electrode_group] * len(xcoords),
             location="medial entorhinal cortex",
             filtering=filter_desc,
-            group=electrode_group,
+            rel_x=xcoords,
+            rel_y=ycoords,
         )
 
-    # Add information about each unit, termed 'cluster' in giocomo data
-    # create new columns in unit table
-    nwbfile.add_unit_column(
-        "quality",
-        "labels given to clusters during manual sorting in phy (1=MUA, "
-        "2=Good, 3=Unsorted)",
-    )
-
-    # cluster information
-    cluster_ids = matfile["sp"][0]["cids"][0][0]
-    cluster_quality = matfile["sp"][0]["cgs"][0][0]
-    # spikes in time
-    spike_times = np.ravel(matfile["sp"][0]["st"][0])  # the time of each spike
-    spike_cluster = np.ravel(
-        matfile["sp"][0]["clu"][0]
-    )  # the cluster_id that spiked at that time
-
-    for i, cluster_id in enumerate(cluster_ids):
-        unit_spike_times = spike_times[spike_cluster == cluster_id]
-        waveforms = matfile["sp"][0]["temps"][0][cluster_id]
-        nwbfile.add_unit(
-            id=int(cluster_id),
-            spike_times=unit_spike_times,
-            quality=cluster_quality[i],
-            waveform_mean=waveforms,
-            electrode_group=electrode_group,
+        # Add information about each unit, termed 'cluster' in giocomo data
+        # cluster information
+        cluster_ids = matfile.vector("sp/cids")
+        cluster_quality = matfile.vector("sp/cgs")
+        # spikes in time
+        spike_times = matfile.array("sp/st")  # the time of each spike, read on demand
+        spike_cluster = matfile.vector(
+            "sp/clu"
+        )  # the cluster_id that spiked at that time
+
+        # partition the spikes by cluster in one pass and fill the units table in bulk
+        spike_order, spike_times_index, cluster_ids = group_by_label(
+            spike_cluster, cluster_ids
         )
-
-    # Trying to add another Units table to hold the results of the automatic spike sorting
-    # create TemplateUnits units table
-    template_units = Units(
-        name="TemplateUnits",
-        description="units assigned during automatic spike sorting",
-    )
-    template_units.add_column(
-        "tempScalingAmps",
-        "scaling amplitude applied to the template when extracting spike",
-        index=True,
-    )
-
-    # information on extracted spike templates
-    spike_templates = np.ravel(matfile["sp"][0]["spikeTemplates"][0])
-    spike_template_ids = np.unique(spike_templates)
-    # template scaling amplitudes
-    temp_scaling_amps = np.ravel(matfile["sp"][0]["tempScalingAmps"][0])
-
-    for i, spike_template_id in enumerate(spike_template_ids):
-        template_spike_times = spike_times[spike_templates == spike_template_id]
-        temp_scaling_amps_per_template = temp_scaling_amps[
-            spike_templates == spike_template_id
-        ]
-        template_units.add_unit(
-            id=int(spike_template_id),
-            spike_times=template_spike_times,
-            electrode_group=electrode_group,
-            tempScalingAmps=temp_scaling_amps_per_template,
+        nwbfile.units = make_units(
+            ids=cluster_ids.astype(int),
+            spike_times=spike_times.take(spike_order),
+            spike_times_index=spike_times_index,
+            columns=[
+                column(
+                    "quality",
+                    "labels given to clusters during manual sorting in phy (1=MUA, "
+                    "2=Good, 3=Unsorted)",
+                    cluster_quality,
+                ),
+                *waveform_columns(
+                    matfile.array("sp/temps").rows(cluster_ids.astype(int)),
+                    dtype=waveform_dtype,
+                ),
+                column(
+                    "electrode_group",
+                    "the electrode group that each spike unit came from",
+                    [electrode_group] * len(cluster_ids),
+                ),
+            ],
         )
 
+        # Add another Units table to hold the results of the automatic spike sorting
+        # information on extracted spike templates
+        spike_templates = matfile.vector("sp/spikeTemplates")
+        # template scaling amplitudes
+        temp_scaling_amps = matfile.array("sp/tempScalingAmps")
+
+        # the spike times can only be stored once if every cluster is exactly one template
+        template_of_cluster = None
+        if share_spike_times and len(spike_order) == spike_times.size:
+            template_of_cluster = cluster_templates(
+                spike_cluster, spike_templates, cluster_ids
+            )
+
+        if template_of_cluster is None:
+            template_order, template_index, spike_template_ids = group_by_label(
+                spike_templates
+            )
+            template_units = make_template_units(
+                template_ids=spike_template_ids.astype(int),
+                spike_times_index=template_index,
+                temp_scaling_amps=temp_scaling_amps.take(template_order),
+                electrode_group=electrode_group,
+                spike_times=spike_times.take(template_order),
+            )
+        else:
+            # templates reuse the partition of the units table and refer to its spike times
+            template_units = make_template_units(
+                template_ids=template_of_cluster,
+                spike_times_index=spike_times_index,
+                temp_scaling_amps=temp_scaling_amps.take(spike_order),
+                electrode_group=electrode_group,
+                units=nwbfile.units,
+            )
+
     # create ecephys processing module
     spike_template_module = nwbfile.create_processing_module(
         name="ecephys", description="units assigned during automatic spike sorting"
@@ -357,14 +398,104 @@ def convert(
     with NWBHDF5IO(outpath, "w") as io:
         io.write(nwbfile)
         print("saved", outpath)
+    cache.write_fingerprint(outpath, session_fingerprint)
+
+
+def _init_worker(compression_policy=None, memory_limit_gb=None):
+    """Set up a worker process of read_yaml: compression policy and address space limit."""
+    if memory_limit_gb is not None:
+        import resource
+
+        limit = int(memory_limit_gb * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    set_policy(compression_policy)
+
+
+def _convert_session(experiment_info):
+    """Run convert on one session and return the traceback if it fails, None if it succeeds."""
+    try:
+        print("converting", experiment_info["input_file"])
+        convert(**experiment_info)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def read_yaml(
+    config_file="config.yaml",
+    compression_policy=None,
+    n_jobs=1,
+    memory_limit_gb=None,
+    skip_unchanged=False,
+    deterministic_identifier=False,
+):
+    """Convert every session listed in a (multi-document) YAML config file.
 
+    A session that fails does not stop the others, a summary of all sessions is printed at the end.
 
-def read_yaml(config_file="config.yaml"):
+    Parameters
+    ----------
+    config_file: str
+    compression_policy: str | None (optional)
+        compression policy YAML file, e.g. a profile written by codec_benchmark. None uses the package defaults.
+    n_jobs: int (optional)
+        number of sessions converted in parallel, each in its own process. 1 converts them one after the other
+        in this process.
+    memory_limit_gb: float | None (optional)
+        limit on the address space of each worker process, in GB. A session that exceeds it fails with a
+        MemoryError. Only applies when n_jobs > 1.
+    skip_unchanged: bool (optional)
+        skip sessions whose output is up to date, unless their config sets it otherwise. See convert.
+    deterministic_identifier: bool (optional)
+        derive NWB identifiers from the inputs, unless a session's config sets it otherwise. See convert.
+    Returns
+    -------
+    dict
+        traceback of each failed session, by (index of its YAML document, input file). Empty if every session was
+        converted.
+    """
     with open(config_file, "r") as input_file:
-        results = yaml_as_python(input_file)
-        for experiment_info in results:
-            print("converting", experiment_info["input_file"])
-            convert(**experiment_info)
+        sessions = [
+            dict(dict(skip_unchanged=skip_unchanged, deterministic_identifier=deterministic_identifier), **info)
+            for info in yaml_as_python(input_file)
+        ]
+
+    # keyed by document, the same input file can be listed twice, e.g. with other options
+    keys = [(index, info["input_file"]) for index, info in enumerate(sessions)]
+    errors = dict()
+    if n_jobs == 1:
+        set_policy(compression_policy)
+        for key, experiment_info in zip(keys, sessions):
+            errors[key] = _convert_session(experiment_info)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_worker,
+            initargs=(compression_policy, memory_limit_gb),
+        ) as executor:
+            futures = {
+                executor.submit(_convert_session, experiment_info): key
+                for key, experiment_info in zip(keys, sessions)
+            }
+            for future in as_completed(futures):
+                try:
+                    errors[futures[future]] = future.result()
+                except Exception:
+                    # the worker process died, e.g. killed by the OS
+                    errors[futures[future]] = traceback.format_exc()
+
+    failed = {key: error for key, error in errors.items() if error is not None}
+    print(
+        "converted {} of {} sessions".format(len(sessions) - len(failed), len(sessions))
+    )
+    for key in keys:
+        index, file = key
+        if key in failed:
+            print("  FAILED", "#{}".format(index), file)
+            print("    " + failed[key].strip().split("\n")[-1])
+        else:
+            print("  ok    ", "#{}".format(index), file)
+    return failed
 
 
 def yaml_as_python(val):
@@ -382,12 +513,25 @@ if __name__ == "__main__":
     -run interface_gui
     -run conversion.py in the terminal which will calls interface_config and convert the data listed in that file
         e.g. *\PycharmProjects\giocomo-lab-to-nwb\giocomo_lab_to_nwb>conversion.py config.yaml
+        optionally followed by a compression profile, e.g. conversion.py config.yaml compression_profile.yml
+        -j/--jobs converts sessions in parallel, e.g. conversion.py config.yaml -j 8 --memory-limit-gb 16
     """
 
-    if len(sys.argv) > 1:
-        # this indicates conversion.py being called from terminal and should use path entered in terminal
-        config_file_path = sys.argv[1]
-        read_yaml(config_file_path)
-    else:
-        # indicates __main__ being run inside editor
-        read_yaml()
+    parser = argparse.ArgumentParser(description="Convert the sessions listed in a YAML config file to NWB")
+    # without arguments (e.g. run inside an editor) config.yaml is converted
+    parser.add_argument("config_file", nargs="?", default="config.yaml")
+    parser.add_argument("compression_policy", nargs="?", default=None, help="compression profile YAML file")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of sessions converted in parallel")
+    parser.add_argument("--memory-limit-gb", type=float, default=None, help="memory limit of each worker process")
+    parser.add_argument("--skip-unchanged", action="store_true", help="skip sessions whose output is up to date")
+    parser.add_argument("--deterministic", action="store_true", help="derive NWB identifiers from the inputs")
+    args = parser.parse_args()
+    failed = read_yaml(
+        args.config_file,
+        args.compression_policy,
+        n_jobs=args.jobs,
+        memory_limit_gb=args.memory_limit_gb,
+        skip_unchanged=args.skip_unchanged,
+        deterministic_identifier=args.deterministic,
+    )
+    sys.exit(1 if failed else 0)
@@ -6,18 +6,23 @@ from nwbn_conversion_tools.ephys.acquisition.spikeglx.spikeglx import Spikeglx2N
 from ndx_labmetadata_giocomo import LabMetaData_ext
 import pynwb
 from pynwb.file import Subject
-from pynwb.misc import Units
 from pynwb.behavior import Position, BehavioralEvents
 
+from giocomo_lab_to_nwb.compression import compressed
+from giocomo_lab_to_nwb.matfile import MatFile
+from giocomo_lab_to_nwb.tables import (add_electrodes, add_rows, column, make_units, make_template_units,
+                                      waveform_columns)
+from giocomo_lab_to_nwb.utils import cluster_templates, group_by_label, segment_runs
+
 import numpy as np
-import hdf5storage
 import copy
 import os
 import sys
 import yaml
 
 
-def conversion_function(source_paths, f_nwb, metadata, add_spikeglx=False, add_processed=False):
+def conversion_function(source_paths, f_nwb, metadata, add_spikeglx=False, add_processed=False,
+                        share_spike_times=False, waveform_dtype=None):
     """
     Copy data stored in a set of .npz files to a single NWB file.
 
@@ -33,6 +38,12 @@ def conversion_function(source_paths, f_nwb, metadata, add_spikeglx=False, add_p
         Dictionary containing metadata
     add_spikeglx: bool
     add_processed: bool
+    share_spike_times: bool
+        If every cluster is exactly one template, store the spike times only in the units table and have
+        each TemplateUnits row refer to its unit instead of writing a second copy.
+    waveform_dtype: None or str
+        None keeps the dtype of the templates, 'float32' or 'int16' converts them. Either way they are written as
+        one dataset chunked and compressed as 'waveforms' in the compression policy, by default one chunk per unit.
     """
 
     # Source files
@@ -54,170 +65,162 @@ def conversion_function(source_paths, f_nwb, metadata, add_spikeglx=False, add_p
 
     # If adding processed data
     if add_processed:
-        # Source matlab data
-        matfile = hdf5storage.loadmat(mat_file_path)
-
-        # Adding trial information
-        nwbfile.add_trial_column(
-            name='trial_contrast',
-            description='visual contrast of the maze through which the mouse is running'
-        )
-        trial = np.ravel(matfile['trial'])
-        trial_nums = np.unique(trial)
-        position_time = np.ravel(matfile['post'])
-        # matlab trial numbers start at 1. To correctly index trial_contract vector,
-        # subtracting 1 from 'num' so index starts at 0
-        for num in trial_nums:
-            trial_times = position_time[trial == num]
-            nwbfile.add_trial(start_time=trial_times[0],
-                              stop_time=trial_times[-1],
-                              trial_contrast=matfile['trial_contrast'][num-1][0])
-
-        # create behavior processing module
-        behavior = nwbfile.create_processing_module(
-            name='behavior',
-            description='behavior processing module'
-        )
-
-        # Add mouse position
-        position = Position(name=metadata['Behavior']['Position']['name'])
-        meta_pos_names = [sps['name'] for sps in metadata['Behavior']['Position']['spatial_series']]
-
-        # Position inside the virtual environment
-        pos_vir_meta_ind = meta_pos_names.index('VirtualPosition')
-        meta_vir = metadata['Behavior']['Position']['spatial_series'][pos_vir_meta_ind]
-        position_virtual = np.ravel(matfile['posx'])
-        sampling_rate = 1/(position_time[1] - position_time[0])
-        position.create_spatial_series(
-            name=meta_vir['name'],
-            data=position_virtual,
-            starting_time=position_time[0],
-            rate=sampling_rate,
-            reference_frame=meta_vir['reference_frame'],
-            conversion=meta_vir['conversion'],
-            description=meta_vir['description'],
-            comments=meta_vir['comments']
+        # Source matlab data, read lazily field by field
+        with MatFile(mat_file_path) as matfile:
+            # Adding trial information
+            nwbfile.add_trial_column(
+                name='trial_contrast',
+                description='visual contrast of the maze through which the mouse is running'
+            )
+            trial = matfile.vector('trial').astype(int)
+            position_time = matfile.vector('post')
+            trial_contrast = matfile.vector('trial_contrast')
+            # one pass over the samples finds where each trial starts and stops
+            trial_starts, trial_stops, trial_nums = segment_runs(trial)
+            # matlab trial numbers start at 1. To correctly index trial_contract vector,
+            # subtracting 1 from the trial numbers so index starts at 0
+            add_rows(nwbfile.trials, dict(start_time=position_time[trial_starts],
+                                          stop_time=position_time[trial_stops-1],
+                                          trial_contrast=trial_contrast[trial_nums-1]))
+
+            # create behavior processing module
+            behavior = nwbfile.create_processing_module(
+                name='behavior',
+                description='behavior processing module'
             )
 
-        # Physical position on the mouse wheel
-        pos_phys_meta_ind = meta_pos_names.index('PhysicalPosition')
-        meta_phys = metadata['Behavior']['Position']['spatial_series'][pos_phys_meta_ind]
-        physical_posx = position_virtual
-        trial_gain = np.ravel(matfile['trial_gain'])
-        for num in trial_nums:
-            physical_posx[trial == num] = physical_posx[trial == num]/trial_gain[num-1]
-        position.create_spatial_series(
-            name=meta_phys['name'],
-            data=physical_posx,
-            starting_time=position_time[0],
-            rate=sampling_rate,
-            reference_frame=meta_phys['reference_frame'],
-            conversion=meta_phys['conversion'],
-            description=meta_phys['description'],
-            comments=meta_phys['comments']
-        )
+            # Add mouse position
+            position = Position(name=metadata['Behavior']['Position']['name'])
+            meta_pos_names = [sps['name'] for sps in metadata['Behavior']['Position']['spatial_series']]
+
+            # Position inside the virtual environment
+            pos_vir_meta_ind = meta_pos_names.index('VirtualPosition')
+            meta_vir = metadata['Behavior']['Position']['spatial_series'][pos_vir_meta_ind]
+            position_virtual = matfile.vector('posx')
+            sampling_rate = 1/(position_time[1] - position_time[0])
+            position.create_spatial_series(
+                name=meta_vir['name'],
+                data=compressed(position_virtual, 'timeseries'),
+                starting_time=position_time[0],
+                rate=sampling_rate,
+                reference_frame=meta_vir['reference_frame'],
+                conversion=meta_vir['conversion'],
+                description=meta_vir['description'],
+                comments=meta_vir['comments']
+                )
+
+            # Physical position on the mouse wheel
+            pos_phys_meta_ind = meta_pos_names.index('PhysicalPosition')
+            meta_phys = metadata['Behavior']['Position']['spatial_series'][pos_phys_meta_ind]
+            # divide each sample by the gain of its trial, into a new buffer so VirtualPosition is left untouched
+            trial_gain = matfile.vector('trial_gain')
+            physical_posx = position_virtual/trial_gain[trial-1]
+            position.create_spatial_series(
+                name=meta_phys['name'],
+                data=compressed(physical_posx, 'timeseries'),
+                starting_time=position_time[0],
+                rate=sampling_rate,
+                reference_frame=meta_phys['reference_frame'],
+                conversion=meta_phys['conversion'],
+                description=meta_phys['description'],
+                comments=meta_phys['comments']
+            )
 
-        behavior.add(position)
+            behavior.add(position)
 
-        # Add timing of lick events, as well as mouse's virtual position during lick event
-        lick_events = BehavioralEvents(name=metadata['Behavior']['BehavioralEvents']['name'])
-        meta_ts = metadata['Behavior']['BehavioralEvents']['time_series']
-        meta_ts['data'] = np.ravel(matfile['lickx'])
-        meta_ts['timestamps'] = np.ravel(matfile['lickt'])
-        lick_events.create_timeseries(**meta_ts)
+            # Add timing of lick events, as well as mouse's virtual position during lick event
+            lick_events = BehavioralEvents(name=metadata['Behavior']['BehavioralEvents']['name'])
+            meta_ts = metadata['Behavior']['BehavioralEvents']['time_series']
+            meta_ts['data'] = compressed(matfile.vector('lickx'), 'events')
+            meta_ts['timestamps'] = compressed(matfile.vector('lickt'), 'events')
+            lick_events.create_timeseries(**meta_ts)
 
-        behavior.add(lick_events)
+            behavior.add(lick_events)
 
-        # Add the recording device, a neuropixel probe
-        recording_device = nwbfile.create_device(name=metadata['Ecephys']['Device'][0]['name'])
+            # Add the recording device, a neuropixel probe
+            recording_device = nwbfile.create_device(name=metadata['Ecephys']['Device'][0]['name'])
 
-        # Add ElectrodeGroup
-        electrode_group = nwbfile.create_electrode_group(
-            name=metadata['Ecephys']['ElectrodeGroup'][0]['name'],
-            description=metadata['Ecephys']['ElectrodeGroup'][0]['description'],
-            location=metadata['Ecephys']['ElectrodeGroup'][0]['location'],
-            device=recording_device
-        )
+            # Add ElectrodeGroup
+            electrode_group = nwbfile.create_electrode_group(
+                name=metadata['Ecephys']['ElectrodeGroup'][0]['name'],
+                description=metadata['Ecephys']['ElectrodeGroup'][0]['description'],
+                location=metadata['Ecephys']['ElectrodeGroup'][0]['location'],
+                device=recording_device
+            )
 
-        # Add information about each electrode
-        xcoords = np.ravel(matfile['sp'][0]['xcoords'][0])
-        ycoords = np.ravel(matfile['sp'][0]['ycoords'][0])
-        data_filtered_flag = matfile['sp'][0]['hp_filtered'][0][0]
-        if metadata['NWBFile']['lab_meta_data']['high_pass_filtered']:
-            filter_desc = 'The raw voltage signals from the electrodes were high-pass filtered'
-        else:
-            filter_desc = 'The raw voltage signals from the electrodes were not high-pass filtered'
-        num_recording_electrodes = xcoords.shape[0]
-        recording_electrodes = range(0, num_recording_electrodes)
-
-        # create electrode columns for the x,y location on the neuropixel  probe
-        # the standard x,y,z locations are reserved for Allen Brain Atlas location
-        nwbfile.add_electrode_column('relativex','electrode x-location on the probe')
-        nwbfile.add_electrode_column('relativey','electrode y-location on the probe')
-        for idx in recording_electrodes:
-            nwbfile.add_electrode(
-                id=idx,
-                x=np.nan,
-                y=np.nan,
-                z=np.nan,
-                relativex=float(xcoords[idx]),
-                relativey=float(ycoords[idx]),
-                imp=np.nan,
+            # Add information about each electrode
+            xcoords = matfile.vector('sp/xcoords')
+            ycoords = matfile.vector('sp/ycoords')
+            data_filtered_flag = matfile.scalar('sp/hp_filtered')
+            if metadata['NWBFile']['lab_meta_data']['high_pass_filtered']:
+                filter_desc = 'The raw voltage signals from the electrodes were high-pass filtered'
+            else:
+                filter_desc = 'The raw voltage signals from the electrodes were not high-pass filtered'
+
+            # x,y location on the neuropixel probe are stored in relativex and relativey,
+            # the standard x,y,z locations are reserved for Allen Brain Atlas location
+            add_electrodes(
+                nwbfile,
+                groups=[electrode_group] * len(xcoords),
                 location='medial entorhinal cortex',
                 filtering=filter_desc,
-                group=electrode_group
+                rel_x=xcoords,
+                rel_y=ycoords,
+                coordinate_columns=('relativex', 'relativey')
             )
 
-        # Add information about each unit, termed 'cluster' in giocomo data
-        # create new columns in unit table
-        nwbfile.add_unit_column(
-            name='quality',
-            description='labels given to clusters during manual sorting in phy '
-                '(1=MUA, 2=Good, 3=Unsorted)'
-        )
-
-        # cluster information
-        cluster_ids = matfile['sp'][0]['cids'][0][0]
-        cluster_quality = matfile['sp'][0]['cgs'][0][0]
-        # spikes in time
-        spike_times = np.ravel(matfile['sp'][0]['st'][0])  # the time of each spike
-        spike_cluster = np.ravel(matfile['sp'][0]['clu'][0])  # the cluster_id that spiked at that time
-        for i, cluster_id in enumerate(cluster_ids):
-            unit_spike_times = spike_times[spike_cluster == cluster_id]
-            waveforms = matfile['sp'][0]['temps'][0][cluster_id]
-            nwbfile.add_unit(
-                id=int(cluster_id),
-                spike_times=unit_spike_times,
-                quality=cluster_quality[i],
-                waveform_mean=waveforms,
-                electrode_group=electrode_group
+            # Add information about each unit, termed 'cluster' in giocomo data
+            # cluster information
+            cluster_ids = matfile.vector('sp/cids')
+            cluster_quality = matfile.vector('sp/cgs')
+            # spikes in time
+            spike_times = matfile.array('sp/st')  # the time of each spike, read on demand
+            spike_cluster = matfile.vector('sp/clu')  # the cluster_id that spiked at that time
+
+            # partition the spikes by cluster in one pass and fill the units table in bulk
+            spike_order, spike_times_index, cluster_ids = group_by_label(spike_cluster, cluster_ids)
+            nwbfile.units = make_units(
+                ids=cluster_ids.astype(int),
+                spike_times=spike_times.take(spike_order),
+                spike_times_index=spike_times_index,
+                columns=[
+                    column('quality', 'labels given to clusters during manual sorting in phy '
+                           '(1=MUA, 2=Good, 3=Unsorted)', cluster_quality),
+                    *waveform_columns(matfile.array('sp/temps').rows(cluster_ids.astype(int)), dtype=waveform_dtype),
+                    column('electrode_group', 'the electrode group that each spike unit came from',
+                           [electrode_group] * len(cluster_ids))
+                ]
             )
 
-        # Trying to add another Units table to hold the results of the automatic spike sorting
-        # create TemplateUnits units table
-        template_units = Units(
-            name='TemplateUnits',
-            description='units assigned during automatic spike sorting'
-        )
-        template_units.add_column(
-            name='tempScalingAmps',
-            description='scaling amplitude applied to the template when extracting spike',
-            index=True
-        )
-        # information on extracted spike templates
-        spike_templates = np.ravel(matfile['sp'][0]['spikeTemplates'][0])
-        spike_template_ids = np.unique(spike_templates)
-        # template scaling amplitudes
-        temp_scaling_amps = np.ravel(matfile['sp'][0]['tempScalingAmps'][0])
-        for i, spike_template_id in enumerate(spike_template_ids):
-            template_spike_times = spike_times[spike_templates == spike_template_id]
-            temp_scaling_amps_per_template = temp_scaling_amps[spike_templates == spike_template_id]
-            template_units.add_unit(
-                id=int(spike_template_id),
-                spike_times=template_spike_times,
-                electrode_group=electrode_group,
-                tempScalingAmps=temp_scaling_amps_per_template
-            )
+            # Add another Units table to hold the results of the automatic spike sorting
+            # information on extracted spike templates
+            spike_templates = matfile.vector('sp/spikeTemplates')
+            # template scaling amplitudes
+            temp_scaling_amps = matfile.array('sp/tempScalingAmps')
+
+            # the spike times can only be stored once if every cluster is exactly one template
+            template_of_cluster = None
+            if share_spike_times and len(spike_order) == spike_times.size:
+                template_of_cluster = cluster_templates(spike_cluster, spike_templates, cluster_ids)
+
+            if template_of_cluster is None:
+                template_order, template_index, spike_template_ids = group_by_label(spike_templates)
+                template_units = make_template_units(
+                    template_ids=spike_template_ids.astype(int),
+                    spike_times_index=template_index,
+                    temp_scaling_amps=temp_scaling_amps.take(template_order),
+                    electrode_group=electrode_group,
+                    spike_times=spike_times.take(template_order)
+                )
+            else:
+                # templates reuse the partition of the units table and refer to its spike times
+                template_units = make_template_units(
+                    template_ids=template_of_cluster,
+                    spike_times_index=spike_times_index,
+                    temp_scaling_amps=temp_scaling_amps.take(spike_order),
+                    electrode_group=electrode_group,
+                    units=nwbfile.units
+                )
 
         # create ecephys processing module
         spike_template_module = nwbfile.create_processing_module(
@@ -1,54 +1,389 @@
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from warnings import warn
 
 import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
 from pynwb import NWBFile
+from pynwb.behavior import Position
+from pynwb.ecephys import LFP, SpikeEventSeries
 
-from ..read_axona import importspikes
+from ..compression import compressed
+from ..read_axona import (
+    channel_conversion,
+    eeg_channel,
+    find_session_files,
+    led_positions,
+    mean_waveforms,
+    read_cluster_labels,
+    read_eeg,
+    read_pos,
+    read_set,
+    read_tetrode,
+    tetrode_conversion
+)
+from ..tables import add_electrodes, column, make_units, waveform_columns
+from ..utils import check_module, group_by_label
 
-spikes_fpath = '/Volumes/easystore5T/data/Giocomo/maze_and_free_to_publish/raw/052301.6'
+session_fpath = '/Volumes/easystore5T/data/Giocomo/maze_and_free_to_publish/raw/052301'
 
 
-def read_spikes(spikes_fpath):
+class RecordIterator(AbstractDataChunkIterator):
+    """Iterate over blocks of rows that are read on demand, e.g. from a memory-mapped file, so that a dataset is
+    written block by block without ever being held in memory."""
 
-    name = 'tetrode{}'.format(spikes_fpath.split('.')[-1])
+    def __init__(self, read, n_rows, row_shape, dtype, buffer_rows=2 ** 16):
+        """
+        Parameters
+        ----------
+        read: callable
+            read(start, stop) returns rows start:stop as an array
+        n_rows: int
+        row_shape: tuple
+        dtype: np.dtype
+        buffer_rows: int (optional)
+            number of rows read and written at a time
+        """
+        self.read = read
+        self.n_rows = n_rows
+        self.row_shape = tuple(row_shape)
+        self._dtype = np.dtype(dtype)
+        self.buffer_rows = buffer_rows
+        self._start = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._start >= self.n_rows:
+            raise StopIteration
+        stop = min(self._start + self.buffer_rows, self.n_rows)
+        selection = (slice(self._start, stop),) + tuple(slice(0, length) for length in self.row_shape)
+        chunk = DataChunk(data=self.read(self._start, stop), selection=selection)
+        self._start = stop
+        return chunk
+
+    def __len__(self):
+        return self.n_rows
+
+    def recommended_chunk_shape(self):
+        return None
+
+    def recommended_data_shape(self):
+        return self.maxshape
 
-    data_dict, params = importspikes(spikes_fpath)
-    data = np.swapaxes(
-        np.dstack(
-            [data_dict['ch{}'.format(i)] for i in range(1, 5)]
-        ), 1, 2)
+    @property
+    def dtype(self):
+        return self._dtype
 
-    timestamps = data['t'].ravel()
+    @property
+    def maxshape(self):
+        return (self.n_rows,) + self.row_shape
 
-    return dict(name=name, data=data, timestamps=timestamps)
 
+def common_conversion(dtype, conversion):
+    """Bring the samples of all channels to one conversion factor, since a SpikeEventSeries has a single one.
 
-nwbfile = NWBFile('aa', 'bb', datetime.datetime.now())
+    Channels recorded with the same gain keep their integers. Otherwise the samples are rescaled to multiples of the
+    smallest step of all channels, which are stored in a wider integer type.
 
-tetrodes = ['tetrode5', 'tetrode6']
+    Parameters
+    ----------
+    dtype: np.dtype
+        integer type of the samples
+    conversion: np.ndarray (n_channels,) | None
+        volts per bit of each channel, None if unknown
+    Returns
+    -------
+    ratio: np.ndarray (n_channels,) | None
+        factor to multiply the samples of each channel with, None to keep them as they are
+    dtype: np.dtype
+        type of the rescaled samples
+    conversion: float
+    """
+    if conversion is None:
+        return None, np.dtype(dtype), 1.
+    if np.allclose(conversion, conversion[0]):
+        return None, np.dtype(dtype), float(conversion[0])
+    step = conversion.min()
+    ratio = conversion / step
+    max_value = np.abs(np.iinfo(dtype).min) * ratio.max()
+    out_dtype = np.int16 if max_value <= np.iinfo(np.int16).max else np.int32
+    return ratio, np.dtype(out_dtype), float(step)
 
-electrodes_dict = dict()
-for itetrode, tetrode in enumerate(tetrodes):
-    device = nwbfile.create_device(tetrode)
-    nwbfile.add_electrode_group(
-        name=tetrode,
-        description='a 4-wired probe',
-        location='entorhinal cortex',
-        device=device
+
+def read_spikes(spikes_fpath, set_fpath=None, buffer_spikes=2 ** 16):
+    """Stream the spikes of one tetrode from its memory-mapped file, keeping the waveforms in their integer dtype.
+
+    Parameters
+    ----------
+    spikes_fpath: str
+        tetrode file, e.g. 052301.6
+    set_fpath: str | None (optional)
+        .set file of the session, for the gains of the channels. Defaults to the tetrode file with a .set extension.
+    buffer_spikes: int (optional)
+        number of spikes read and written at a time
+    Returns
+    -------
+    dict
+        name, data (n_spikes, 4, n_samples), timestamps in seconds and conversion of data to volts. data and
+        timestamps are RecordIterators, or empty arrays if the tetrode has no spikes.
+    """
+    name = 'tetrode{}'.format(spikes_fpath.split('.')[-1])
+
+    spikes, params = read_tetrode(spikes_fpath)
+    channels = ['ch{}'.format(i) for i in range(1, 5)]
+    ratio, dtype, conversion = common_conversion(
+        spikes.dtype['ch1']['waveform'].base, tetrode_conversion(spikes_fpath, params['bytes_per_sample'], set_fpath)
     )
-    for _ in range(4):
-        nwbfile.add_electrode(
-            x=np.nan,
-            y=np.nan,
-            z=np.nan,
-            location='entorhinal cortex',
+
+    def read_waveforms(start, stop):
+        block = np.stack([spikes[channel]['waveform'][start:stop] for channel in channels], axis=1)
+        if ratio is None:
+            return block
+        return np.round(block * ratio[None, :, None]).astype(dtype)
+
+    def read_timestamps(start, stop):
+        # only really care about the first time that gets written
+        return spikes['ch1']['t'][start:stop] / params['timebase']
+
+    n_spikes = params['num_spikes']
+    if not n_spikes:
+        return dict(name=name, data=read_waveforms(0, 0), timestamps=read_timestamps(0, 0), conversion=conversion)
+    data = RecordIterator(read_waveforms, n_spikes, (len(channels), params['samples_per_spike']), dtype,
+                          buffer_rows=buffer_spikes)
+    timestamps = RecordIterator(read_timestamps, n_spikes, (), float, buffer_rows=buffer_spikes)
+
+    return dict(name=name, data=data, timestamps=timestamps, conversion=conversion)
+
+
+def add_tetrodes(nwbfile, tetrodes, location='entorhinal cortex'):
+    """Add a device, electrode group and 4 electrodes for each tetrode.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    tetrodes: iterable of int
+        tetrode numbers
+    location: str (optional)
+    Returns
+    -------
+    dict
+        tetrode number -> electrode table region of its electrodes
+    """
+    electrodes_dict = dict()
+    for tetrode in tetrodes:
+        name = 'tetrode{}'.format(tetrode)
+        device = nwbfile.create_device(name)
+        electrode_group = nwbfile.create_electrode_group(
+            name=name,
+            description='a 4-wired probe',
+            location=location,
+            device=device
+        )
+        rows = add_electrodes(
+            nwbfile,
+            groups=[electrode_group] * 4,
+            location=location,
             filtering='unknown'
         )
-    electrodes_dict.update({
-        tetrode: nwbfile.create_electrode_table_region(
-            list(range(itetrode * 4, itetrode * 4 + 4)),
-            description='electrodes for ' + tetrode,
-            name=tetrode + '_electrodes'
+        electrodes_dict[tetrode] = nwbfile.create_electrode_table_region(
+            list(rows),
+            description='electrodes for ' + name
+        )
+    return electrodes_dict
+
+
+def add_position(nwbfile, pos_fpath):
+    """Add the tracked position of both LEDs from a .pos file to the behavior module.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    pos_fpath: str | Path
+    """
+    frames, params = read_pos(pos_fpath)
+    positions = led_positions(frames, params['pixels_per_metre'])
+    position = Position(name='Position')
+    for led in range(positions.shape[1]):
+        position.create_spatial_series(
+            name='led{}'.format(led + 1),
+            data=compressed(positions[:, led], 'timeseries'),
+            starting_time=0.,
+            rate=params['sample_rate'],
+            reference_frame='top left corner of the camera window',
+            unit='meters',
+            description='x, y position of LED {}, NaN when it was not tracked'.format(led + 1)
+        )
+    check_module(nwbfile, 'behavior', 'behavior processing module').add(position)
+
+
+def add_lfp(nwbfile, eeg_fpaths, set_fpath, electrodes_dict):
+    """Add continuous .eeg/.egf data as ElectricalSeries of an LFP container in the ecephys module.
+
+    The samples are written as stored, in int8 or int16, with their conversion to volts.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    eeg_fpaths: list of str | Path
+        .eeg, .eeg2, ..., .egf, ... files
+    set_fpath: str | Path
+        .set file of the session, for the recorded channel and gain of each file
+    electrodes_dict: dict
+        tetrode number -> electrode table region of its electrodes, as returned by `add_tetrodes`
+    """
+    settings = read_set(set_fpath)
+    lfp = LFP(name='LFP')
+    for eeg_fpath in eeg_fpaths:
+        channel = eeg_channel(settings, eeg_fpath)
+        tetrode, electrode = divmod(channel, 4)
+        if tetrode + 1 not in electrodes_dict:
+            warn('skipping {}: channel {} is not on a tetrode of this session'.format(eeg_fpath, channel + 1))
+            continue
+        samples, params = read_eeg(eeg_fpath)
+        row = electrodes_dict[tetrode + 1].data[electrode]
+        lfp.create_electrical_series(
+            name=Path(eeg_fpath).suffix[1:].upper(),
+            data=compressed(samples, 'lfp'),
+            electrodes=nwbfile.create_electrode_table_region([row], description='channel {}'.format(channel + 1)),
+            starting_time=0.,
+            rate=params['sample_rate'],
+            conversion=float(channel_conversion(settings, [channel], params['bytes_per_sample'])[0]),
+            description='continuous data of channel {} from {}'.format(channel + 1, Path(eeg_fpath).name)
         )
-    })
+    if lfp.electrical_series:
+        check_module(nwbfile, 'ecephys', 'processed extracellular electrophysiology data').add(lfp)
+
+
+def tetrode_units(tetrode_fpath, cut_fpath, set_fpath=None):
+    """Spike times and mean waveforms of the clusters cut on one tetrode, as plain arrays.
+
+    Cluster 0 holds the unassigned spikes and is left out. The spikes are partitioned by cluster with one argsort,
+    and the mean waveforms, in volts when the .set file is found, are computed in one pass over the memory-mapped
+    tetrode file.
+
+    Parameters
+    ----------
+    tetrode_fpath: str | Path
+        tetrode file, e.g. 052301.6
+    cut_fpath: str | Path
+        .cut or .clu file of the tetrode
+    set_fpath: str | Path | None (optional)
+        .set file of the session, for the gains of the channels
+    Returns
+    -------
+    dict
+        clusters, spike_times grouped by cluster, spike_counts of each cluster and waveforms (n_clusters,
+        samples_per_spike, 4)
+    """
+    spikes, params = read_tetrode(tetrode_fpath)
+    labels = read_cluster_labels(cut_fpath)
+    if len(labels) != len(spikes):
+        raise ValueError('{} has {} spikes but {} has {}'.format(cut_fpath, len(labels), tetrode_fpath, len(spikes)))
+
+    order, index, clusters = group_by_label(labels, np.unique(labels[labels > 0]))
+    mean = mean_waveforms(spikes, labels, clusters)
+    conversion = tetrode_conversion(tetrode_fpath, params['bytes_per_sample'], set_fpath)
+    return dict(
+        clusters=clusters,
+        spike_times=spikes['ch1']['t'][order] / params['timebase'],
+        spike_counts=np.diff(index, prepend=0),
+        waveforms=mean if conversion is None else mean * conversion
+    )
+
+
+def add_units(nwbfile, files, max_workers=None):
+    """Fill nwbfile.units with the clusters cut on each tetrode, in one operation.
+
+    The tetrodes are read concurrently, see `tetrode_units`, so a session takes about as long as its largest
+    tetrode file.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+        with the electrode groups of the tetrodes, see `add_tetrodes`
+    files: dict
+        the files of the session, see read_axona.find_session_files
+    max_workers: int | None (optional)
+        number of tetrodes read at the same time, defaults to all
+    """
+    cuts = dict()
+    for tetrode, cut_fpath in files['cuts'].items():
+        if tetrode not in files['tetrodes']:
+            warn('skipping {}: tetrode file not found'.format(cut_fpath))
+            continue
+        cuts[tetrode] = cut_fpath
+    if not cuts:
+        return
+
+    # numpy releases the GIL while it copies from the memory-mapped files, so the reads of the tetrodes overlap
+    with ThreadPoolExecutor(max_workers=max_workers or len(cuts)) as executor:
+        futures = {tetrode: executor.submit(tetrode_units, files['tetrodes'][tetrode], cut_fpath, files['set'])
+                   for tetrode, cut_fpath in cuts.items()}
+        units = {tetrode: future.result() for tetrode, future in futures.items()}
+
+    groups = []
+    for tetrode, value in units.items():
+        groups.extend([nwbfile.electrode_groups['tetrode{}'.format(tetrode)]] * len(value['clusters']))
+    if not groups:
+        return
+
+    nwbfile.units = make_units(
+        ids=np.arange(len(groups)),
+        spike_times=np.concatenate([value['spike_times'] for value in units.values()]),
+        spike_times_index=np.cumsum(np.concatenate([value['spike_counts'] for value in units.values()])),
+        columns=[
+            column('tetrode', 'tetrode the unit was cut from',
+                   np.concatenate([np.full(len(value['clusters']), tetrode) for tetrode, value in units.items()])),
+            column('cluster', 'cluster number of the unit in the cut file of its tetrode',
+                   np.concatenate([value['clusters'] for value in units.values()])),
+            *waveform_columns(np.concatenate([value['waveforms'] for value in units.values()])),
+            column('electrode_group', 'the electrode group that each spike unit came from', groups)
+        ]
+    )
+
+
+def add_session(nwbfile, session_fpath, max_workers=None):
+    """Add the spikes of all tetrodes of an Axona session, each streamed into a SpikeEventSeries, with its units,
+    position tracking and continuous .eeg/.egf data when they exist.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    session_fpath: str
+        path of the session without extension, e.g. raw/052301
+    max_workers: int | None (optional)
+        number of tetrodes whose units are read at the same time, defaults to all
+    Returns
+    -------
+    dict
+        the files of the session, see read_axona.find_session_files
+    """
+    files = find_session_files(session_fpath)
+    electrodes_dict = add_tetrodes(nwbfile, files['tetrodes'])
+    for tetrode, spikes_fpath in files['tetrodes'].items():
+        # memory-mapped, the waveforms are read while they are written
+        spikes = read_spikes(str(spikes_fpath), files['set'])
+        nwbfile.add_acquisition(
+            SpikeEventSeries(
+                name=spikes['name'],
+                data=compressed(spikes['data'], 'spike_events'),
+                timestamps=compressed(spikes['timestamps'], 'events'),
+                electrodes=electrodes_dict[tetrode],
+                conversion=spikes['conversion'],
+                description='spike waveforms of tetrode{}'.format(tetrode)
+            )
+        )
+    add_units(nwbfile, files, max_workers=max_workers)
+    if files['pos'] is not None:
+        add_position(nwbfile, files['pos'])
+    if files['set'] is not None and (files['eeg'] or files['egf']):
+        add_lfp(nwbfile, files['eeg'] + files['egf'], files['set'], electrodes_dict)
+    return files
+
 
+if __name__ == '__main__':
+    nwbfile = NWBFile('aa', 'bb', datetime.datetime.now().astimezone())
+    add_session(nwbfile, session_fpath)
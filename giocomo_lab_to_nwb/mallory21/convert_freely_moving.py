@@ -1,11 +1,17 @@
-
 from .processed import (
     convert_freely_moving_with_inertial_sensor,
     convert_freely_moving_without_inertial_sensor
 )
 
-convert_freely_moving_without_inertial_sensor(
-    '/Volumes/easystore5T/data/Giocomo/nature_comm/src/processed/Freely_moving_data_without_inertial_sensor.mat')
+# number of sessions written in parallel, each worker process opens the .mat file once
+n_jobs = 4
+
+# the sessions are written by spawned worker processes, which import this module again
+if __name__ == '__main__':
+    convert_freely_moving_without_inertial_sensor(
+        '/Volumes/easystore5T/data/Giocomo/nature_comm/src/processed/Freely_moving_data_without_inertial_sensor.mat',
+        n_jobs=n_jobs)
 
-convert_freely_moving_with_inertial_sensor(
-    '/Volumes/easystore5T/data/Giocomo/nature_comm/src/processed/Freely_moving_data_with_inertial_sensor.mat')
+    convert_freely_moving_with_inertial_sensor(
+        '/Volumes/easystore5T/data/Giocomo/nature_comm/src/processed/Freely_moving_data_with_inertial_sensor.mat',
+        n_jobs=n_jobs)
@@ -1,42 +1,81 @@
 from glob import glob
-from pathlib import Path
 
+from ..cache import fingerprint, is_up_to_date, write_fingerprint
+from ..catalog import build_catalog, find_session, session_paths
+from ..compression import recording_options, set_policy
 from .malloryvrnwbconverter import MalloryVRNWBConverter, get_track_session_info
+from .utils import cell_info_pool
 
 np_fpath = '/Volumes/easystore5T/data/Giocomo/nature_comm/src/spikeglx'
 cell_info_files = glob('/Volumes/easystore5T/data/Giocomo/nature_comm/src/processed/cell_info_session*.mat')
+# compression profile written by codec_benchmark, None for the package defaults
+compression_profile = None
+set_policy(compression_profile)
+# skip sessions whose output was already converted from the same inputs, metadata and converter
+skip_unchanged = True
+# convert only the first seconds of every interface, to check a conversion end to end. None for whole sessions
+preview_duration = None
+# link the AP and LF .bin files from the NWB files instead of copying them, the NWB files then need the .bin files
+link_raw = False
+# the SpikeGLX tree is walked once, sessions whose directories did not change are not scanned again
+catalog = build_catalog([np_fpath], '/Volumes/easystore5T/data/Giocomo/nature_comm/nwb/spikeglx_catalog.json')
 
 
 for cell_info_file in cell_info_files:
-    subject_id, session_id = get_track_session_info(cell_info_file)
-
-    subject_session = '{}_{}'.format(subject_id, session_id[:4])
-
-    session_fpath = next(Path(np_fpath).glob('{}*'.format(subject_session)))
-    ap_file_path = next(session_fpath.glob('*_imec0/*imec0.ap.bin'))
-    lf_file_path = next(session_fpath.glob('*_imec0/*imec0.lf.bin'))
-
-    # Set some global conversion options here
-    stub_test = True
-
-    # Run the conversion
-    source_data = dict(
-        SpikeGLXRecording=dict(file_path=str(ap_file_path)),
-        SpikeGLXLFP=dict(file_path=str(lf_file_path)),
-        GiocomoTrackProcessed=dict(file_path=str(cell_info_file)),
-        Events=dict(session_path=str(session_fpath))
-    )
-    conversion_options = dict(
-        SpikeGLXRecording=dict(stub_test=stub_test),
-        SpikeGLXLFP=dict(stub_test=stub_test)
-    )
-
-    converter = MalloryVRNWBConverter(source_data=source_data)
-    metadata = converter.get_metadata()
-
-    converter.run_conversion(
-        nwbfile_path='/Volumes/easystore5T/data/Giocomo/nature_comm/nwb/{}_{}.nwb'.format(subject_id, session_id),
-        metadata=metadata,
-        conversion_options=conversion_options,
-        overwrite=True
-    )
+    # the cell_info file is opened once for the session and closed when it is converted or skipped
+    with cell_info_pool():
+        subject_id, session_id = get_track_session_info(cell_info_file)
+
+        subject_session = '{}_{}'.format(subject_id, session_id[:4])
+
+        session = find_session(catalog, subject_session)
+        session_fpath = session['path']
+        ap_file_path = session['ap']
+        lf_file_path = session['lf']
+
+        # Set some global conversion options here
+        stub_test = True
+
+        # Run the conversion
+        source_data = dict(
+            GiocomoTrackProcessed=dict(file_path=str(cell_info_file)),
+            Events=dict(session_path=str(session_fpath))
+        )
+        if link_raw:
+            source_data.update(
+                SpikeGLXRecordingExternal=dict(file_path=str(ap_file_path)),
+                SpikeGLXLFPExternal=dict(file_path=str(lf_file_path))
+            )
+            conversion_options = dict()
+        else:
+            source_data.update(
+                SpikeGLXRecording=dict(file_path=str(ap_file_path)),
+                SpikeGLXLFP=dict(file_path=str(lf_file_path))
+            )
+            conversion_options = dict(
+                SpikeGLXRecording=dict(stub_test=stub_test, **recording_options('raw')),
+                SpikeGLXLFP=dict(stub_test=stub_test, **recording_options('lfp'))
+            )
+        if preview_duration is not None:
+            for name in source_data:
+                conversion_options.setdefault(name, dict())['preview_duration'] = preview_duration
+
+        converter = MalloryVRNWBConverter(source_data=source_data)
+        metadata = converter.get_metadata()
+
+        nwbfile_path = '/Volumes/easystore5T/data/Giocomo/nature_comm/nwb/{}_{}.nwb'.format(subject_id, session_id)
+        session_fingerprint = fingerprint(
+            [cell_info_file] + session_paths(session),
+            metadata=dict(metadata=metadata, conversion_options=conversion_options)
+        )
+        if skip_unchanged and is_up_to_date(nwbfile_path, session_fingerprint):
+            print('up to date, skipping {}'.format(nwbfile_path))
+            continue
+
+        converter.run_conversion(
+            nwbfile_path=nwbfile_path,
+            metadata=metadata,
+            conversion_options=conversion_options,
+            overwrite=True
+        )
+        write_fingerprint(nwbfile_path, session_fingerprint)
@@ -2,7 +2,6 @@ import datetime
 from pathlib import Path
 from typing import Optional, Union
 
-import h5py
 import numpy as np
 import pandas as pd
 from ndx_events import Events
@@ -13,6 +12,12 @@ from pynwb.behavior import Position, SpatialSeries, EyeTracking
 from pynwb.file import Subject
 from pytz import timezone
 
+from giocomo_lab_to_nwb.catalog import session_files
+from giocomo_lab_to_nwb.compression import compressed
+from giocomo_lab_to_nwb.mallory21.utils import close_cell_info, open_cell_info
+from giocomo_lab_to_nwb.preview import PreviewMixin, clip_times, preview_intervals, preview_stop
+from giocomo_lab_to_nwb.spikeglx_interface import ExternalLinkMixin, SpikeGLXExternalInterface
+from giocomo_lab_to_nwb.tables import add_intervals, concatenate_ragged, make_units
 from giocomo_lab_to_nwb.utils import check_module
 
 OptionalArrayType = Optional[Union[list, np.ndarray]]
@@ -21,17 +26,9 @@ PathType = Union[Path, str]
 year = '19'
 
 
-def get_data(file: h5py.File, str_: str, row=0):
-    return file[file['cell_info'][str_][row][0]][:].ravel()
-
-
-def get_str(file: h5py.File, str_: str, row=0) -> str:
-    return ''.join([chr(x) for x in file[file['cell_info'][str_][row][0]]])
-
-
 def get_track_session_info(fpath: str):
-    file = h5py.File(fpath, 'r')
-    return get_str(file, 'animal_id'), get_str(file, 'session_id')
+    cell_info = open_cell_info(fpath)
+    return cell_info.string('animal_id'), cell_info.string('session_id')
 
 
 class GiocomoTrackProcessedInterface(BaseDataInterface):
@@ -55,8 +52,7 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
         session_start_time = datetime.datetime.strptime(year + self.datestr, '%y%m%d')
         session_start_time = timezone('US/Pacific').localize(session_start_time)
 
-        file = h5py.File(file_path, 'r')
-        trial_contrast = get_data(file, 'trial_contrast')
+        trial_contrast = open_cell_info(file_path).scalar('trial_contrast')
 
         return dict(
             NWBFile=dict(
@@ -65,30 +61,36 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
                 session_start_time=session_start_time,
                 lab='Giocomo',
                 institution='Stanford University',
-                experiment_description='trial contrast: {}'.format(int(trial_contrast[0])),
+                experiment_description='trial contrast: {}'.format(int(trial_contrast)),
                 subject=Subject(
                     subject_id=subject_id
                 )
             )
         )
 
-    def run_conversion(self, nwbfile: NWBFile, metadata: dict):
+    def run_conversion(self, nwbfile: NWBFile, metadata: dict, preview_duration: float = None):
         file_path = self.source_data['file_path']
 
-        file = h5py.File(file_path, 'r')
-        cell_info = file['cell_info']
-
-        cell_ids = [''.join([chr(x[0]) for x in file[x[0]]]) for x in cell_info['cell_id']]
-
-        times = get_data(file, 'time')
-        body_pos = get_data(file, 'body_position')
-        body_speed = get_data(file, 'body_speed')
-        horizontal_eye_pos = get_data(file, 'horizontal_eye_position')
-        vertial_eye_pos = get_data(file, 'vertical_eye_position')
-        horizontal_eye_vel = get_data(file, 'horiztonal_eye_velocity')
-        vertial_eye_vel = get_data(file, 'vertical_eye_velocity')
-
-        all_spike_times = [file[x[0]][:].ravel() for x in cell_info['spike_times']]
+        cell_info = open_cell_info(file_path)
+        try:
+            cell_ids = cell_info.strings('cell_id')
+
+            times = cell_info.array('time')
+            # only the samples within the preview are read
+            stop = preview_stop(times, preview_duration)
+            times = times[:stop]
+            body_pos = cell_info.array('body_position', stop=stop)
+            body_speed = cell_info.array('body_speed', stop=stop)
+            horizontal_eye_pos = cell_info.array('horizontal_eye_position', stop=stop)
+            vertial_eye_pos = cell_info.array('vertical_eye_position', stop=stop)
+            horizontal_eye_vel = cell_info.array('horiztonal_eye_velocity', stop=stop)
+            vertial_eye_vel = cell_info.array('vertical_eye_velocity', stop=stop)
+
+            all_spike_times = [clip_times(spike_times, preview_duration)
+                               for spike_times in cell_info.arrays('spike_times')]
+        finally:
+            # everything is read, the file is not needed to write the NWB file
+            close_cell_info(file_path)
 
         behavior = nwbfile.create_processing_module(
             name='behavior',
@@ -97,8 +99,8 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
 
         spatial_series = SpatialSeries(
             name='position',
-            data=body_pos,
-            timestamps=times,
+            data=compressed(body_pos, 'timeseries'),
+            timestamps=compressed(times, 'timeseries'),
             conversion=.01,
             reference_frame='on track. Position is in VR.'
         )
@@ -112,7 +114,7 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
         behavior.add(
             TimeSeries(
                 name='body_speed',
-                data=body_speed,
+                data=compressed(body_speed, 'timeseries'),
                 timestamps=spatial_series,
                 unit='cm/s'
             )
@@ -122,7 +124,7 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
             EyeTracking(
                 spatial_series=SpatialSeries(
                     name='eye_position',
-                    data=np.c_[horizontal_eye_pos, vertial_eye_pos],
+                    data=compressed(np.c_[horizontal_eye_pos, vertial_eye_pos], 'timeseries'),
                     timestamps=spatial_series,
                     reference_frame='unknown'
                 )
@@ -132,15 +134,18 @@ class GiocomoTrackProcessedInterface(BaseDataInterface):
         behavior.add(
             TimeSeries(
                 name='eye_velocity',
-                data=np.c_[horizontal_eye_vel, vertial_eye_vel],
+                data=compressed(np.c_[horizontal_eye_vel, vertial_eye_vel], 'timeseries'),
                 timestamps=spatial_series,
                 unit='unknown'
             )
         )
 
-        for spike_times, cell_id in zip(all_spike_times, cell_ids):
-            id_ = int(cell_id.split('_')[-1])
-            nwbfile.add_unit(spike_times=spike_times, id=id_)
+        spike_times, spike_times_index = concatenate_ragged(all_spike_times)
+        nwbfile.units = make_units(
+            ids=[int(cell_id.split('_')[-1]) for cell_id in cell_ids],
+            spike_times=spike_times,
+            spike_times_index=spike_times_index
+        )
 
         return nwbfile
 
@@ -162,46 +167,51 @@ class MalloryEventsInterface(BaseDataInterface):
             metadata: dict = None,
             write_licks: bool = True,
             write_rewards: bool = True,
-            write_trials: bool = True
+            write_trials: bool = True,
+            preview_duration: float = None
     ):
 
         session_fpath = self.source_data['session_path']
+        # looked up in the catalog built by convert_vr.py, or scanned once here
+        behavior_files = session_files(session_fpath)['behavior']
 
         behav_mod = check_module(nwbfile, 'behavior')
 
         if write_licks:
             lick_timestamps = pd.read_csv(
-                next(Path(session_fpath).glob('*{}.txt'.format('licks'))),
+                behavior_files['licks'][0],
                 sep='\t',
                 names=['pos', 'time']
             )['time'].values
+            lick_timestamps = clip_times(lick_timestamps, preview_duration)
 
             events = Events(
                 name='licks',
                 description='times when the subject licked in seconds',
-                timestamps=lick_timestamps
+                timestamps=compressed(lick_timestamps, 'events')
             )
             behav_mod.add(events)
 
         # rewards
         if write_rewards:
             rewards_timestamps = pd.read_csv(
-                next(Path(session_fpath).glob('*{}.txt'.format('reward_times'))),
+                behavior_files['reward_times'][0],
                 sep='\t',
                 names=['time', 'rewards']
             )['time'].values
+            rewards_timestamps = clip_times(rewards_timestamps, preview_duration)
 
             events = Events(
                 name='rewards',
                 description='times when the subject was rewarded in seconds',
-                timestamps=rewards_timestamps
+                timestamps=compressed(rewards_timestamps, 'events')
             )
             behav_mod.add(events)
 
         # trials
         if write_trials:
             df = pd.read_csv(
-                next(Path(session_fpath).glob('*{}.txt'.format('trial_times'))),
+                behavior_files['trial_times'][0],
                 sep='\t',
                 names=[
                     'start_time',
@@ -211,38 +221,37 @@ class MalloryEventsInterface(BaseDataInterface):
                 ]
             )
 
-            nwbfile.add_trial_column(
-                'visual_contrast',
-                'the visual contrast setting of that trial'
-            )
-
-            nwbfile.add_trial_column(
-                'running_wheel_gain',
-                'how to match distance on running wheel to distance in'
-                ' virtual environment'
+            # each trial stops when the next one starts, the last one has no stop time
+            df['stop_time'] = df['start_time'].shift(-1)
+            df['reward'] = df['reward'].astype(bool)
+            df = preview_intervals(df, preview_duration)
+
+            add_intervals(
+                nwbfile,
+                'trials',
+                df,
+                descriptions=dict(
+                    visual_contrast='the visual contrast setting of that trial',
+                    running_wheel_gain='how to match distance on running wheel to distance in virtual environment',
+                    reward='if the particular trial is rewarded or not'
+                )
             )
 
-            nwbfile.add_trial_column(
-                'reward',
-                'if the particular trial is rewarded or not'
-            )
 
-            for i in range(len(df)):
-                kwargs = df.iloc[i].to_dict()
-                kwargs['reward'] = bool(kwargs['reward'])
+class MalloryRecordingInterface(PreviewMixin, SpikeGLXRecordingInterface):
+    """SpikeGLX AP recording, with the preview_duration conversion option."""
 
-                if i == len(df) - 1:
-                    kwargs.update(stop_time=np.nan)
-                else:
-                    kwargs.update(stop_time=df.iloc[i + 1]['start_time'])
 
-                nwbfile.add_trial(**kwargs)
+class MalloryLFPInterface(PreviewMixin, SpikeGLXLFPInterface):
+    """SpikeGLX LF recording, with the preview_duration conversion option."""
 
 
-class MalloryVRNWBConverter(NWBConverter):
+class MalloryVRNWBConverter(ExternalLinkMixin, NWBConverter):
     data_interface_classes = dict(
-        SpikeGLXRecording=SpikeGLXRecordingInterface,
-        SpikeGLXLFP=SpikeGLXLFPInterface,
+        SpikeGLXRecording=MalloryRecordingInterface,
+        SpikeGLXLFP=MalloryLFPInterface,
+        SpikeGLXRecordingExternal=SpikeGLXExternalInterface,
+        SpikeGLXLFPExternal=SpikeGLXExternalInterface,
         GiocomoTrackProcessed=GiocomoTrackProcessedInterface,
         Events=MalloryEventsInterface
     )
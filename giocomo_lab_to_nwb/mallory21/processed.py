@@ -1,4 +1,8 @@
 import datetime
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 
 import h5py
 import numpy as np
@@ -9,238 +13,393 @@ from pytz import timezone
 from scipy.io import loadmat
 from tqdm import tqdm
 
-from .utils import get_data, get_str
+from ..compression import compressed, set_policy
+from ..tables import column, concatenate_ragged, make_units
+from ..verify import LEVELS, dataset_spec, verify
+from .utils import CellInfo, cell_info_pool, open_cell_info, session_index
 
 year = '19'
 
 
-def convert_freely_moving_with_inertial_sensor(fpath: str):
-
-    matdata = loadmat(fpath)
-    nrows = len(matdata['cell_info']['cell_id'][0])
-
-    session_ids = [matdata['cell_info']['cell_id'][0][row][0].split('_')[:2] for row in range(nrows)]
-
-    inverse = np.unique(session_ids, axis=0, return_index=True, return_inverse=True)[2]
-
-    inds = []
-    last = -1
-    for row, index in enumerate(inverse):
-        if index == last:
-            inds[-1].append(row)
-        else:
-            last = index
-            inds.append([row])
-
-    for session in tqdm(inds):
-
-        row = session[0]
-        subject_id, session_id = matdata['cell_info']['cell_id'][0][row][0].split('_')[:2]
-
-        session_start_time = datetime.datetime.strptime(year + session_id[:4], '%y%m%d')
-        session_start_time = timezone('US/Pacific').localize(session_start_time)
-
-        data = {x: matdata['cell_info'][x][0][row].ravel() for x in
-                (
-                    'time',
-                    'body_position_x',
-                    'body_position_y',
-                    'body_speed',
-                    'azimuthal_head_direction',
-                    'azimuthal_head_velocity',
-                    'arena_size_cm',
-                    'pitch',
-                    'roll'
-                )
-                }
-
-        data['cell_ids'] = [matdata['cell_info']['cell_id'][0][row][0].split('_')[2] for row in session]
-        data['spike_times'] = [matdata['cell_info']['spike_times'][0][row].ravel() for row in session]
-
-        nwbfile = NWBFile(
-            session_description='free exploration.',
-            identifier=session_id,
-            session_start_time=session_start_time,
-            lab='Giocomo Lab',
-            institution='Stanford University',
-            experiment_description='arena size (cm): {}'.format(data['arena_size_cm']),
-            subject=Subject(subject_id=subject_id)
-        )
-
-        behavior = nwbfile.create_processing_module(
-            name='behavior',
-            description='contains processed behavioral data'
-        )
-
-        spatial_series = SpatialSeries(
-            name='position',
-            data=np.c_[data['body_position_x'], data['body_position_y']],
-            timestamps=data['time'],
-            conversion=.01,
-            reference_frame='unknown'
-        )
-
-        behavior.add(
-            Position(
-                spatial_series=spatial_series
-            )
-        )
-
-        behavior.add(
-            TimeSeries(
-                name='body_speed',
-                data=data['body_speed'],
-                timestamps=spatial_series,
-                unit='cm/s'
-            )
-        )
-
-        behavior.add(
-            TimeSeries(
-                name='head_direction',
-                description='azimuth, pitch, roll',
-                data=np.c_[
-                    data['azimuthal_head_direction'],
-                    data['pitch'],
-                    data['roll']
-                ],
-                timestamps=spatial_series,
-                unit='radians'
-            )
-        )
-
-        behavior.add(
-            TimeSeries(
-                name='azimuthal_head_velocity',
-                data=data['azimuthal_head_velocity'],
-                unit='radians/s',
-                timestamps=spatial_series
-            )
-        )
-
-        nwbfile.add_unit_column('cell_id', 'string-based cell id')
-        for spike_times, cell_id in zip(data['spike_times'], data['cell_ids']):
-            nwbfile.add_unit(spike_times=spike_times, cell_id=cell_id)
-
-        with NWBHDF5IO(subject_id + session_id + '.nwb', 'w') as io:
-            io.write(nwbfile)
-
-        # test read
-        with NWBHDF5IO(subject_id + session_id + '.nwb', 'r') as io:
-            io.read()
-
-
-def convert_freely_moving_without_inertial_sensor(fpath: str):
-
-    file = h5py.File(fpath, 'r')
-
-    nrows = len(file['cell_info']['cell_id'])
-    session_ids = [get_str(file, 'cell_id', row).split('_')[:2] for row in range(nrows)]
-
-    inverse = np.unique(session_ids, axis=0, return_index=True, return_inverse=True)[2]
-
-    inds = []
-    last = -1
-    for row, index in enumerate(inverse):
-        if index == last:
-            inds[-1].append(row)
+@lru_cache(maxsize=None)
+def _load_mat(fpath):
+    """The cell_info variable of a MATLAB v5 .mat file, loaded once per process.
+
+    scipy can only load a v5 struct whole, so every worker process loads it once, for all the sessions it writes.
+    """
+    return loadmat(fpath, variable_names=['cell_info'])
+
+
+def _try_write_session(write_session, fpath, session, cell_ids, verification):
+    """Run write_session and verify its file.
+
+    Returns
+    -------
+    tuple
+        traceback if it fails or None, (nwb_path, expected datasets) if it succeeds or None
+    """
+    try:
+        nwb_path, expected = write_session(fpath, session, cell_ids)
+        verify(nwb_path, verification, expected)
+    except Exception:
+        return traceback.format_exc(), None
+    return None, (nwb_path, expected)
+
+
+def _init_worker(compression_policy=None):
+    """Set up a worker process of write_sessions: spawned processes start with the package default policy."""
+    set_policy(compression_policy)
+
+
+def write_sessions(write_session, fpath, cell_ids, sessions, n_jobs=1, verification='full',
+                   verify_async=False, compression_policy=None):
+    """Write every session of a .mat file, one after the other or on worker processes.
+
+    Each worker receives the rows and cell ids of its sessions and opens the .mat file itself, once per process. The
+    v7.3 file without inertial sensor is read through `open_cell_info`, only the fields and rows of each session. The
+    v5 file with inertial sensor is loaded whole by `_load_mat`, the complete cell_info in every worker. A session
+    that fails does not stop the others, a summary is printed at the end.
+
+    Parameters
+    ----------
+    write_session: callable
+        write_session(fpath, rows, cell_ids) writes the session made of `rows` of cell_info and returns the path of
+        the file and the datasets it is expected to have
+    fpath: str
+    cell_ids: list of str
+        cell id of every row
+    sessions: dict
+        session -> rows, see utils.session_index
+    n_jobs: int (optional)
+        number of worker processes, 1 writes the sessions in this process
+    verification: str (optional)
+        'none', 'structural' or 'full', see giocomo_lab_to_nwb.verify. 'full', the default, reads each file back with
+        pynwb, 'structural' only looks up its datasets with h5py.
+    verify_async: bool (optional)
+        verify each file on a separate process while the next sessions are written
+    compression_policy: dict | str | None (optional)
+        compression policy, or its YAML file, e.g. a profile written by codec_benchmark. None uses the package
+        defaults.
+    Returns
+    -------
+    dict
+        traceback of each failed session
+    """
+    if verification not in LEVELS:
+        raise ValueError('verification must be one of {}, got {}'.format(LEVELS, verification))
+    tasks = {session: (rows, [cell_ids[row] for row in rows]) for session, rows in sessions.items()}
+    # spawned workers do not inherit HDF5 state from this process
+    context = multiprocessing.get_context('spawn')
+    verifier = None
+    if verify_async and verification != 'none':
+        verifier = ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                       initargs=(compression_policy,))
+    inline_verification = 'none' if verifier is not None else verification
+
+    errors = dict()
+    checks = dict()
+
+    def written(session, result):
+        errors[session], output = result
+        if verifier is not None and output is not None:
+            nwb_path, expected = output
+            checks[verifier.submit(verify, nwb_path, verification, expected)] = session
+
+    try:
+        if n_jobs == 1:
+            set_policy(compression_policy)
+            try:
+                with cell_info_pool():
+                    for session, (rows, session_cell_ids) in tqdm(tasks.items()):
+                        written(session, _try_write_session(write_session, fpath, rows, session_cell_ids,
+                                                            inline_verification))
+            finally:
+                _load_mat.cache_clear()
         else:
-            last = index
-            inds.append([row])
-
-    for session in tqdm(inds):
-        row = session[0]
-        data = {
-            x: get_data(file, x, row) for x in (
+            # the workers load the file themselves, do not keep a copy that was loaded to index it
+            _load_mat.cache_clear()
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context, initializer=_init_worker,
+                                     initargs=(compression_policy,)) as executor:
+                futures = {executor.submit(_try_write_session, write_session, fpath, rows, session_cell_ids,
+                                           inline_verification): session
+                           for session, (rows, session_cell_ids) in tasks.items()}
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    try:
+                        written(futures[future], future.result())
+                    except Exception:
+                        # the worker process died
+                        errors[futures[future]] = traceback.format_exc()
+
+        for future in as_completed(checks):
+            try:
+                future.result()
+            except Exception:
+                errors[checks[future]] = traceback.format_exc()
+    finally:
+        if verifier is not None:
+            verifier.shutdown()
+
+    failed = {session: error for session, error in errors.items() if error is not None}
+    print('converted {} of {} sessions'.format(len(tasks) - len(failed), len(tasks)))
+    for session, error in failed.items():
+        print('  FAILED', session)
+        print('    ' + error.strip().split('\n')[-1])
+    return failed
+
+
+def _expected_datasets(position, time, timeseries, spike_times, n_units):
+    """Datasets that the structural verification looks up in a freely moving session."""
+    expected = {
+        'processing/behavior/Position/position/data': dataset_spec(position),
+        'processing/behavior/Position/position/timestamps': dataset_spec(time),
+        'units/id': ((n_units,), None),
+        'units/cell_id': ((n_units,), None),
+        'units/spike_times': dataset_spec(spike_times),
+        'units/spike_times_index': ((n_units,), None),
+    }
+    for name, data in timeseries.items():
+        expected['processing/behavior/{}/data'.format(name)] = dataset_spec(data)
+        expected['processing/behavior/{}/timestamps'.format(name)] = None
+    return expected
+
+
+def _write_session_with_inertial_sensor(fpath: str, session: list, cell_ids: list):
+    matdata = _load_mat(fpath)
+    row = session[0]
+    subject_id, session_id = cell_ids[0].split('_')[:2]
+
+    session_start_time = datetime.datetime.strptime(year + session_id[:4], '%y%m%d')
+    session_start_time = timezone('US/Pacific').localize(session_start_time)
+
+    data = {x: matdata['cell_info'][x][0][row].ravel() for x in
+            (
                 'time',
                 'body_position_x',
                 'body_position_y',
                 'body_speed',
-                'arena_size_cm',
                 'azimuthal_head_direction',
-                'azimuthal_head_velocity'
+                'azimuthal_head_velocity',
+                'arena_size_cm',
+                'pitch',
+                'roll'
             )
-        }
-
-        subject_id = get_str(file, 'animal_id', row)
-
-        all_spike_times = [get_data(file, 'spike_times', row) for row in session]
-        cell_ids = [get_str(file, 'cell_id', row).split('_')[-1] for row in session]
-
-        if subject_id in ('Reeves', 'Ringo'):  # e.g. 'Ringo_29_July_04+01+02+03_T1C2'
-            components = get_str(file, 'cell_id', row).split('_')
-            session_id = '_'.join(components[1:-1])
-            session_start_time = datetime.datetime.strptime(year + ''.join(components[1:-2]), '%y%d%B')
-
-        elif subject_id in ('Ella', 'Barbara'):  # e.g. 'Ella_1029_2+_1_T1C2'
-            components = get_str(file, 'cell_id', row).split('_')
-            session_id = '_'.join(components[1:-1])
-            try:
-                session_start_time = datetime.datetime.strptime(year + components[1], '%y%m%d')
-            except:
-                session_start_time = datetime.datetime.strptime(year + components[1], '%yk%m%d')
-
-        elif subject_id in ('Magnolia', 'Azalea', 'Camelia', 'Crocus', 'Lupine'):  # e.g. 'Magnolia_rectangle_013001_T1C1'
-            components = get_str(file, 'cell_id', row).split('_')
-            session_id = '_'.join(components[1:-1])
-            session_start_time = datetime.datetime.strptime(year + components[2][:4], '%y%m%d')
-
-        else:
-            session_id = get_str(file, 'cell_id', row).split('_')[1]
-            session_start_time = datetime.datetime.strptime(year + session_id[:4], '%y%m%d')
-
-        session_start_time = timezone('US/Pacific').localize(session_start_time)
-
-        nwbfile = NWBFile(
-            session_description='free exploration.',
-            identifier=session_id,
-            session_start_time=session_start_time,
-            lab='Giocomo',
-            institution='Stanford University',
-            experiment_description='arena size (cm): {}'.format(data['arena_size_cm']),
-            subject=Subject(subject_id=subject_id, species="Mus musculus")
-        )
-
-        behavior = nwbfile.create_processing_module(
-            name='behavior',
-            description='contains processed behavioral data')
-
-        spatial_series = SpatialSeries(
-            name='position',
-            data=np.c_[data['body_position_x'], data['body_position_y']],
-            timestamps=data['time'],
-            conversion=.01,
-            reference_frame='unknown'
+            }
+
+    data['cell_ids'] = [cell_id.split('_')[2] for cell_id in cell_ids]
+    data['spike_times'] = [matdata['cell_info']['spike_times'][0][row].ravel() for row in session]
+    position = np.c_[data['body_position_x'], data['body_position_y']]
+    head_direction = np.c_[data['azimuthal_head_direction'], data['pitch'], data['roll']]
+
+    nwbfile = NWBFile(
+        session_description='free exploration.',
+        identifier=session_id,
+        session_start_time=session_start_time,
+        lab='Giocomo Lab',
+        institution='Stanford University',
+        experiment_description='arena size (cm): {}'.format(data['arena_size_cm']),
+        subject=Subject(subject_id=subject_id)
+    )
+
+    behavior = nwbfile.create_processing_module(
+        name='behavior',
+        description='contains processed behavioral data'
+    )
+
+    spatial_series = SpatialSeries(
+        name='position',
+        data=compressed(position, 'timeseries'),
+        timestamps=compressed(data['time'], 'timeseries'),
+        conversion=.01,
+        reference_frame='unknown'
+    )
+
+    behavior.add(
+        Position(
+            spatial_series=spatial_series
         )
+    )
 
-        behavior.add(Position(spatial_series=spatial_series))
-
-        behavior.add(TimeSeries(
+    behavior.add(
+        TimeSeries(
             name='body_speed',
-            data=data['body_speed'],
+            data=compressed(data['body_speed'], 'timeseries'),
             timestamps=spatial_series,
-            unit='cm/s'))
+            unit='cm/s'
+        )
+    )
 
-        behavior.add(TimeSeries(
+    behavior.add(
+        TimeSeries(
             name='head_direction',
-            description='azimuth',
-            data=data['azimuthal_head_direction'],
+            description='azimuth, pitch, roll',
+            data=compressed(head_direction, 'timeseries'),
             timestamps=spatial_series,
-            unit='radians'))
+            unit='radians'
+        )
+    )
 
-        behavior.add(TimeSeries(
+    behavior.add(
+        TimeSeries(
             name='azimuthal_head_velocity',
-            data=data['azimuthal_head_velocity'],
+            data=compressed(data['azimuthal_head_velocity'], 'timeseries'),
             unit='radians/s',
-            timestamps=spatial_series))
+            timestamps=spatial_series
+        )
+    )
+
+    spike_times, spike_times_index = concatenate_ragged(data['spike_times'])
+    nwbfile.units = make_units(
+        ids=np.arange(len(data['cell_ids'])),
+        spike_times=spike_times,
+        spike_times_index=spike_times_index,
+        columns=[column('cell_id', 'string-based cell id', data['cell_ids'])]
+    )
+
+    nwb_path = subject_id + session_id + '.nwb'
+    with NWBHDF5IO(nwb_path, 'w') as io:
+        io.write(nwbfile)
+
+    return nwb_path, _expected_datasets(
+        position, data['time'],
+        dict(body_speed=data['body_speed'], head_direction=head_direction,
+             azimuthal_head_velocity=data['azimuthal_head_velocity']),
+        spike_times, len(data['cell_ids'])
+    )
+
+
+def _write_session_without_inertial_sensor(fpath: str, session: list, cell_ids: list):
+    cell_info = open_cell_info(fpath)
+    row = session[0]
+    data = {
+        x: cell_info.array(x, row) for x in (
+            'time',
+            'body_position_x',
+            'body_position_y',
+            'body_speed',
+            'arena_size_cm',
+            'azimuthal_head_direction',
+            'azimuthal_head_velocity'
+        )
+    }
+
+    subject_id = cell_info.string('animal_id', row)
+
+    all_spike_times = cell_info.arrays('spike_times', session)
+    session_cell_ids = [cell_id.split('_')[-1] for cell_id in cell_ids]
 
-        nwbfile.add_unit_column('cell_id', 'string-based cell id')
-        for spike_times, cell_id in zip(all_spike_times, cell_ids):
-            nwbfile.add_unit(spike_times=spike_times, cell_id=cell_id)
+    if subject_id in ('Reeves', 'Ringo'):  # e.g. 'Ringo_29_July_04+01+02+03_T1C2'
+        components = cell_ids[0].split('_')
+        session_id = '_'.join(components[1:-1])
+        session_start_time = datetime.datetime.strptime(year + ''.join(components[1:-2]), '%y%d%B')
 
-        with NWBHDF5IO(subject_id + session_id + '.nwb', 'w') as io:
-            io.write(nwbfile)
+    elif subject_id in ('Ella', 'Barbara'):  # e.g. 'Ella_1029_2+_1_T1C2'
+        components = cell_ids[0].split('_')
+        session_id = '_'.join(components[1:-1])
+        try:
+            session_start_time = datetime.datetime.strptime(year + components[1], '%y%m%d')
+        except:
+            session_start_time = datetime.datetime.strptime(year + components[1], '%yk%m%d')
+
+    elif subject_id in ('Magnolia', 'Azalea', 'Camelia', 'Crocus', 'Lupine'):  # e.g. 'Magnolia_rectangle_013001_T1C1'
+        components = cell_ids[0].split('_')
+        session_id = '_'.join(components[1:-1])
+        session_start_time = datetime.datetime.strptime(year + components[2][:4], '%y%m%d')
+
+    else:
+        session_id = cell_ids[0].split('_')[1]
+        session_start_time = datetime.datetime.strptime(year + session_id[:4], '%y%m%d')
 
-        # test read
-        with NWBHDF5IO(subject_id + session_id + '.nwb', 'r') as io:
-            io.read()
+    session_start_time = timezone('US/Pacific').localize(session_start_time)
+    position = np.c_[data['body_position_x'], data['body_position_y']]
+
+    nwbfile = NWBFile(
+        session_description='free exploration.',
+        identifier=session_id,
+        session_start_time=session_start_time,
+        lab='Giocomo',
+        institution='Stanford University',
+        experiment_description='arena size (cm): {}'.format(data['arena_size_cm']),
+        subject=Subject(subject_id=subject_id, species="Mus musculus")
+    )
+
+    behavior = nwbfile.create_processing_module(
+        name='behavior',
+        description='contains processed behavioral data')
+
+    spatial_series = SpatialSeries(
+        name='position',
+        data=compressed(position, 'timeseries'),
+        timestamps=compressed(data['time'], 'timeseries'),
+        conversion=.01,
+        reference_frame='unknown'
+    )
+
+    behavior.add(Position(spatial_series=spatial_series))
+
+    behavior.add(TimeSeries(
+        name='body_speed',
+        data=compressed(data['body_speed'], 'timeseries'),
+        timestamps=spatial_series,
+        unit='cm/s'))
+
+    behavior.add(TimeSeries(
+        name='head_direction',
+        description='azimuth',
+        data=compressed(data['azimuthal_head_direction'], 'timeseries'),
+        timestamps=spatial_series,
+        unit='radians'))
+
+    behavior.add(TimeSeries(
+        name='azimuthal_head_velocity',
+        data=compressed(data['azimuthal_head_velocity'], 'timeseries'),
+        unit='radians/s',
+        timestamps=spatial_series))
+
+    spike_times, spike_times_index = concatenate_ragged(all_spike_times)
+    nwbfile.units = make_units(
+        ids=np.arange(len(session_cell_ids)),
+        spike_times=spike_times,
+        spike_times_index=spike_times_index,
+        columns=[column('cell_id', 'string-based cell id', session_cell_ids)]
+    )
+
+    nwb_path = subject_id + session_id + '.nwb'
+    with NWBHDF5IO(nwb_path, 'w') as io:
+        io.write(nwbfile)
+
+    return nwb_path, _expected_datasets(
+        position, data['time'],
+        dict(body_speed=data['body_speed'], head_direction=data['azimuthal_head_direction'],
+             azimuthal_head_velocity=data['azimuthal_head_velocity']),
+        spike_times, len(session_cell_ids)
+    )
+
+
+def convert_freely_moving_with_inertial_sensor(fpath: str, n_jobs=1, verification='full', verify_async=False,
+                                               compression_policy=None):
+    """Convert every session of the freely moving data with inertial sensor, see `write_sessions`."""
+
+    # loaded once when the index is stale, and reused by the sessions written in this process
+    cell_ids, sessions = session_index(
+        fpath, lambda: [str(cell_id[0]) for cell_id in _load_mat(fpath)['cell_info']['cell_id'][0]]
+    )
+    return write_sessions(_write_session_with_inertial_sensor, fpath, cell_ids, sessions, n_jobs=n_jobs,
+                          verification=verification, verify_async=verify_async,
+                          compression_policy=compression_policy)
+
+
+def convert_freely_moving_without_inertial_sensor(fpath: str, n_jobs=1, verification='full', verify_async=False,
+                                                  compression_policy=None):
+    """Convert every session of the freely moving data without inertial sensor, see `write_sessions`."""
+
+    def read_cell_ids():
+        with h5py.File(fpath, 'r') as file:
+            return CellInfo(file).strings('cell_id')
+
+    # the last component of a cell id is the cell, e.g. 'Ringo_29_July_04+01+02+03_T1C2'
+    cell_ids, sessions = session_index(
+        fpath, read_cell_ids, session_of=lambda cell_id: cell_id.rsplit('_', 1)[0]
+    )
+    return write_sessions(_write_session_without_inertial_sensor, fpath, cell_ids, sessions, n_jobs=n_jobs,
+                          verification=verification, verify_async=verify_async,
+                          compression_policy=compression_policy)
@@ -1,11 +1,192 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
 import h5py
+import numpy as np
+
+from ..matfile import decode_str
 
 year = '19'
 
 
-def get_data(file: h5py.File, str_: str, row=0):
-    return file[file['cell_info'][str_][row][0]][:].ravel()
+class CellInfo:
+    """Batched reader of the cell_info struct array of a MATLAB v7.3 file.
+
+    Each field of cell_info is a column of object references, one per row (cell). The references of a field are
+    read at once, the values they point to are read in the order they are stored in the file, and decoded strings
+    are cached.
+    """
+
+    def __init__(self, file: h5py.File):
+        self.file = file
+        self.cell_info = file['cell_info']
+        self._references = dict()
+        self._strings = dict()
+        self._values = dict()
+
+    def __len__(self):
+        return len(self.cell_info['cell_id'])
+
+    def references(self, field):
+        """The reference of every row of a field, read once."""
+        if field not in self._references:
+            self._references[field] = self.cell_info[field][:, 0]
+        return self._references[field]
+
+    def read(self, field, rows=None) -> list:
+        """Read the values of a field at `rows` (default all), in the order they are stored in the file.
+
+        Parameters
+        ----------
+        field: str
+        rows: array-like of int | None (optional)
+        Returns
+        -------
+        list of np.ndarray
+            in the order of `rows`
+        """
+        references = self.references(field)
+        if rows is not None:
+            references = references[np.asarray(rows, dtype=int)]
+        datasets = [self.file[reference] for reference in references]
+        # data stored in the object header (compact) has no offset and was read with the header
+        offsets = [dataset.id.get_offset() for dataset in datasets]
+        values = [None] * len(datasets)
+        for i in sorted(range(len(datasets)), key=lambda i: -1 if offsets[i] is None else offsets[i]):
+            values[i] = datasets[i][()]
+        return values
+
+    def arrays(self, field, rows=None) -> list:
+        """Flat arrays of a field at `rows` (default all), e.g. the spike times of the cells of a session."""
+        return [np.ravel(value) for value in self.read(field, rows)]
+
+    def array(self, field, row=0, stop=None) -> np.ndarray:
+        """Flat array of a field at `row`, or only its first `stop` elements, read from the file."""
+        if stop is None:
+            return self.arrays(field, [row])[0]
+        dataset = self.file[self.references(field)[row]]
+        # MATLAB vectors are stored as (1, n) or (n, 1)
+        selection = [slice(None)] * dataset.ndim
+        selection[int(np.argmax(dataset.shape))] = slice(0, stop)
+        return np.ravel(dataset[tuple(selection)])
+
+    def strings(self, field) -> list:
+        """Decoded strings of a field for every row, cached."""
+        if field not in self._strings:
+            self._strings[field] = [decode_str(value) for value in self.read(field)]
+        return self._strings[field]
+
+    def string(self, field, row=0) -> str:
+        """Decoded string of a field at `row`, cached."""
+        if field in self._strings:
+            return self._strings[field][row]
+        if (field, row) not in self._values:
+            self._values[field, row] = decode_str(self.read(field, [row])[0])
+        return self._values[field, row]
+
+    def scalar(self, field, row=0):
+        """First element of a field at `row`, cached, e.g. the trial contrast of a session."""
+        if (field, row) not in self._values:
+            self._values[field, row] = self.array(field, row)[0].item()
+        return self._values[field, row]
+
+    def close(self):
+        self.file.close()
+
+
+# CellInfo of each .mat file opened by this process, by absolute path
+_cell_info_files = dict()
+
+
+def open_cell_info(fpath) -> CellInfo:
+    """CellInfo of a .mat file, opened once per process and shared with its cached metadata."""
+    key = os.path.abspath(fpath)
+    if key not in _cell_info_files:
+        _cell_info_files[key] = CellInfo(h5py.File(key, 'r'))
+    return _cell_info_files[key]
+
+
+def close_cell_info(fpath=None):
+    """Close the .mat file `fpath` if it is open, or every open file if None."""
+    keys = list(_cell_info_files) if fpath is None else [os.path.abspath(fpath)]
+    for key in keys:
+        cell_info = _cell_info_files.pop(key, None)
+        if cell_info is not None:
+            cell_info.close()
+
+
+@contextmanager
+def cell_info_pool():
+    """Close every file opened with `open_cell_info` in this block when it exits, e.g. once per session."""
+    try:
+        yield
+    finally:
+        close_cell_info()
+
+
+def subject_session(cell_id):
+    """'subject_session' of a cell id whose first two components are the subject and session, e.g. 'npI5_0417_T1C2'"""
+    return '_'.join(cell_id.split('_')[:2])
+
+
+def group_sessions(cell_ids, session_of=subject_session):
+    """Group the rows of cell_info by session in one pass.
+
+    Parameters
+    ----------
+    cell_ids: list of str
+    session_of: callable (optional)
+        session of a cell id
+    Returns
+    -------
+    dict
+        session -> rows of its cells, in order of first appearance. Rows of a session need not be contiguous.
+    """
+    sessions = dict()
+    for row, cell_id in enumerate(cell_ids):
+        sessions.setdefault(session_of(cell_id), []).append(row)
+    return sessions
+
+
+def session_index(fpath, read_cell_ids, session_of=subject_session):
+    """Cell ids and session rows of a cell_info .mat file, the cell ids cached in a sidecar next to it.
+
+    The sidecar, <fpath>.sessions.json, is reused as long as the size and modification time of the .mat file are
+    unchanged, so reruns do not decode the cell ids again. Only the cell ids are cached, the rows are grouped by
+    `session_of` on every call, so a different grouping never returns a stale one.
 
+    Parameters
+    ----------
+    fpath: str
+        .mat file
+    read_cell_ids: callable
+        returns the cell_id of each row of cell_info, called only when the sidecar is missing or stale
+    session_of: callable (optional)
+        session of a cell id
+    Returns
+    -------
+    cell_ids: list of str
+    sessions: dict
+        see `group_sessions`
+    """
+    sidecar = Path(str(fpath) + '.sessions.json')
+    stat = os.stat(fpath)
+    source = [stat.st_size, stat.st_mtime_ns]
+    cell_ids = None
+    if sidecar.exists():
+        with open(sidecar, 'r') as f:
+            index = json.load(f)
+        if index.get('source') == source:
+            cell_ids = index['cell_ids']
 
-def get_str(file: h5py.File, str_: str, row=0) -> str:
-    return ''.join([chr(x) for x in file[file['cell_info'][str_][row][0]]])
+    if cell_ids is None:
+        cell_ids = read_cell_ids()
+        try:
+            with open(sidecar, 'w') as f:
+                json.dump(dict(source=source, cell_ids=cell_ids), f)
+        except OSError:
+            # read-only archive, the index is rebuilt next time
+            pass
+    return cell_ids, group_sessions(cell_ids, session_of)
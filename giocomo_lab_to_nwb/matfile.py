@@ -0,0 +1,132 @@
+import h5py
+import numpy as np
+
+
+def decode_str(data) -> str:
+    """Decode a MATLAB char array (UTF-16 code units) into a string."""
+    return np.ravel(data).astype('<u2').tobytes().decode('utf-16-le')
+
+
+class MatArray:
+    """Array view of a variable in a MATLAB v7.3 file that only reads from disk when indexed.
+
+    MATLAB writes arrays column-major, so the HDF5 dataset holds the transpose of the MATLAB array. Shapes and
+    keys of this view follow MATLAB axis order and are translated to the dataset.
+    """
+
+    def __init__(self, dataset: h5py.Dataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape[::-1]
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def size(self):
+        return self.dataset.size
+
+    @property
+    def ndim(self):
+        return self.dataset.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return np.transpose(self.dataset[key[::-1]])
+
+    def rows(self, indices):
+        """Read the rows (first MATLAB axis) at `indices`, which may be unsorted and repeated."""
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        return self[unique_indices][np.ravel(inverse)]
+
+    def _vector_chunks(self, chunk_size):
+        # MATLAB stores vectors as (1, n) or (n, 1); iterate over the long axis of the dataset
+        axis = int(np.argmax(self.dataset.shape))
+        for start in range(0, self.size, chunk_size):
+            selection = [slice(None)] * self.ndim
+            selection[axis] = slice(start, min(start + chunk_size, self.size))
+            yield start, tuple(selection)
+
+    def ravel(self, chunk_size=2 ** 22):
+        """Read a MATLAB vector into a flat array, chunk by chunk into a single preallocated buffer."""
+        out = np.empty(self.size, dtype=self.dtype)
+        out_view = out.reshape(self.dataset.shape)
+        for _, selection in self._vector_chunks(chunk_size):
+            self.dataset.read_direct(out_view, selection, selection)
+        return out
+
+    def segment(self, start, stop):
+        """Read the contiguous elements `start:stop` of a MATLAB vector."""
+        axis = int(np.argmax(self.dataset.shape))
+        selection = [slice(None)] * self.ndim
+        selection[axis] = slice(start, stop)
+        return np.ravel(self.dataset[tuple(selection)])
+
+    def take(self, indices, chunk_size=2 ** 22):
+        """Read `vector[indices]` chunk by chunk, so the full vector is never held in memory next to the output.
+
+        Parameters
+        ----------
+        indices: np.ndarray
+            positions to read, in output order, e.g. the `order` returned by utils.group_by_label
+        chunk_size: int (optional)
+            number of elements read from disk at a time
+        Returns
+        -------
+        np.ndarray
+        """
+        indices = np.ravel(indices)
+        out = np.empty(len(indices), dtype=self.dtype)
+        by_source = np.argsort(indices, kind='stable')
+        sorted_indices = indices[by_source]
+        for start, selection in self._vector_chunks(chunk_size):
+            chunk = np.ravel(self.dataset[selection])
+            lo, hi = np.searchsorted(sorted_indices, [start, start + len(chunk)])
+            out[by_source[lo:hi]] = chunk[sorted_indices[lo:hi] - start]
+        return out
+
+
+class MatFile:
+    """Lazy, field-selective reader of MATLAB v7.3 (.mat) files.
+
+    Variables and struct fields are addressed by path, e.g. ``matfile.array('sp/st')``, and only the fields that
+    are asked for are read.
+    """
+
+    def __init__(self, file_path):
+        self.file = h5py.File(file_path, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __contains__(self, path):
+        return path in self.file
+
+    def array(self, path) -> MatArray:
+        return MatArray(self.file[path])
+
+    def vector(self, path, chunk_size=2 ** 22) -> np.ndarray:
+        return self.array(path).ravel(chunk_size=chunk_size)
+
+    def scalar(self, path):
+        return self.file[path][()].ravel()[0]
+
+    def string(self, path) -> str:
+        dataset = self.file[path]
+        if dataset.attrs.get('MATLAB_empty', 0):
+            return ''
+        return decode_str(dataset[()])
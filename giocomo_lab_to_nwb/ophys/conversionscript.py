@@ -4,23 +4,42 @@ from warnings import warn
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..cache import deterministic_identifier, fingerprint, is_up_to_date, write_fingerprint
 from .giocomoconverter import GiocomoImagingInterface
 
 
-def converter(file_path: Path, nwb_file_path=None):
+def source_paths(file_path: Path):
+    """The sbx file, its suite2p folder and VR pickle, wherever they exist."""
+    vr_pickle_path = file_path.parents[3]/'VR_pd_pickles'/file_path.relative_to(file_path.parents[3]).with_suffix('.pkl')
+    return [path for path in [file_path, file_path.with_suffix('')/'suite2p', file_path.with_suffix('.pkl'),
+                              vr_pickle_path] if path.exists()]
+
+
+def converter(file_path: Path, nwb_file_path=None, skip_unchanged=False, use_deterministic_identifier=False):
     try:
         print(f'converting {file_path.relative_to(file_path.parents[2])}')
         gio = GiocomoImagingInterface(str(file_path))
         if nwb_file_path is None:
             nwb_file_path = file_path.with_suffix('.nwb')
-        gio.run_conversion(metadata=gio.get_metadata(),
+        metadata = gio.get_metadata()
+        # the identifier of get_metadata is random, leave it out of the fingerprint
+        nwbfile_metadata = {key: value for key, value in metadata['NWBFile'].items() if key != 'identifier'}
+        session_fingerprint = fingerprint(source_paths(file_path), metadata=dict(metadata, NWBFile=nwbfile_metadata))
+        if skip_unchanged and is_up_to_date(nwb_file_path, session_fingerprint):
+            print(f'up to date, skipping {nwb_file_path}')
+            return
+        if use_deterministic_identifier:
+            metadata['NWBFile']['identifier'] = deterministic_identifier(session_fingerprint)
+        gio.run_conversion(metadata=metadata,
                            nwbfile_path=str(nwb_file_path),
                            overwrite=True)
+        write_fingerprint(nwb_file_path, session_fingerprint)
     except Exception as e:
         warn(f'could not convert: {e}')
 
 
-def conversion_complete(source_path, parallelize: bool = True, n_jobs=10):
+def conversion_complete(source_path, parallelize: bool = True, n_jobs=10, skip_unchanged=False,
+                        use_deterministic_identifier=False):
     """
     Convert all files in batch.
     Parameters
@@ -29,6 +48,11 @@ def conversion_complete(source_path, parallelize: bool = True, n_jobs=10):
     n_jobs: int
     source_path: Path, str
         location of the source_folder containing datafiles
+    skip_unchanged: bool
+        skip files whose .nwb was already converted from the same inputs, metadata and converter. Off by default,
+        every file is converted again.
+    use_deterministic_identifier: bool
+        derive the NWB identifiers from the inputs instead of random uuids
     """
     source_path = Path(source_path)
     for subject_id_path in source_path.iterdir():
@@ -36,12 +60,16 @@ def conversion_complete(source_path, parallelize: bool = True, n_jobs=10):
             print(f'converting for subject:{subject_id_path.name}')
             if parallelize:
                 file_path_list = [i for i in subject_id_path.glob('*/*/*.sbx')]
-                Parallel(n_jobs=n_jobs)(delayed(converter)(file_path) for file_path in file_path_list)
+                Parallel(n_jobs=n_jobs)(
+                    delayed(converter)(file_path, skip_unchanged=skip_unchanged,
+                                       use_deterministic_identifier=use_deterministic_identifier)
+                    for file_path in file_path_list)
             else:
                 file_path_list = tqdm([i for i in subject_id_path.glob('*/*/*.sbx')])
                 for file_path in file_path_list:
                     file_path_list.set_postfix(current=f'writing: {file_path.name}')
-                    converter(file_path)
+                    converter(file_path, skip_unchanged=skip_unchanged,
+                              use_deterministic_identifier=use_deterministic_identifier)
 
 
 def convert_file(filepath: [Path, str, dict], nwb_save_path: [Path, str] = None):
@@ -13,6 +13,8 @@ from pynwb.behavior import BehavioralTimeSeries
 from pynwb.file import Subject
 from pytz import timezone
 
+from ..compression import compressed
+
 
 class GiocomoVRInterface(BaseDataInterface):
     """Data interface for VR Pickled data, Giocomo Lab"""
@@ -120,7 +122,8 @@ class GiocomoVRInterface(BaseDataInterface):
                 behdict.update(unit='m')
             else:
                 conv = 1
-            behdict.update(starting_time=start_time, rate=rate, data=self.data_frame[behdict['name']].to_numpy()*conv)
+            behdict.update(starting_time=start_time, rate=rate,
+                           data=compressed(self.data_frame[behdict['name']].to_numpy()*conv, 'timeseries'))
             beh_ts.append(TimeSeries(**behdict))
         if 'behavior' not in nwbfile.processing:
             beh_mod = nwbfile.create_processing_module('behavior', 'Container for behavior time series')
@@ -134,5 +137,5 @@ class GiocomoVRInterface(BaseDataInterface):
         for inp_kwargs in self.stimulus_args:
             if inp_kwargs['name'] not in nwbfile.stimulus:
                 inp_kwargs.update(starting_time=start_time, rate=rate,
-                                  data=self.data_frame[inp_kwargs['name']].to_numpy())
+                                  data=compressed(self.data_frame[inp_kwargs['name']].to_numpy(), 'timeseries'))
                 nwbfile.add_stimulus(TimeSeries(**inp_kwargs))
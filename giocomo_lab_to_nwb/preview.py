@@ -0,0 +1,68 @@
+"""Preview conversions: convert only the first seconds of a session, in every interface.
+
+Every interface of the Mallory and Wen converters takes a `preview_duration` conversion option, in seconds. The raw
+and LFP recordings and the sorted spike trains are cut to their first frames, and spike times, position, eye
+tracking, licks, rewards, trials and epochs are kept when they fall in the first `preview_duration` seconds of the
+session, so the layout and metadata of a conversion can be checked end to end in seconds::
+
+    conversion_options = {name: dict(preview_duration=60.) for name in converter.data_interface_objects}
+"""
+import numpy as np
+
+
+def preview_stop(times, preview_duration=None):
+    """Number of leading samples of sorted `times` within the preview, all of them if `preview_duration` is None."""
+    if preview_duration is None:
+        return len(times)
+    return int(np.searchsorted(times, preview_duration, side='left'))
+
+
+def clip_times(times, preview_duration=None):
+    """Times within the preview, e.g. the spike times of a unit or the timestamps of events."""
+    times = np.asarray(times)
+    if preview_duration is None:
+        return times
+    return times[times < preview_duration]
+
+
+def preview_intervals(intervals, preview_duration=None):
+    """Rows of a DataFrame of intervals, e.g. trials or epochs, that start within the preview."""
+    if preview_duration is None:
+        return intervals
+    return intervals[intervals['start_time'] < preview_duration]
+
+
+def first_seconds(extractor, duration):
+    """Recording or sorting extractor of the first `duration` seconds of `extractor`.
+
+    Works with spikeinterface extractors and with spikeextractors ones.
+    """
+    end_frame = int(round(duration * extractor.get_sampling_frequency()))
+    if hasattr(extractor, 'get_num_frames'):
+        end_frame = min(end_frame, extractor.get_num_frames())
+    if hasattr(extractor, 'frame_slice'):
+        return extractor.frame_slice(start_frame=0, end_frame=end_frame)
+
+    import spikeextractors as se
+    if isinstance(extractor, se.RecordingExtractor):
+        return se.SubRecordingExtractor(extractor, start_frame=0, end_frame=end_frame)
+    return se.SubSortingExtractor(extractor, start_frame=0, end_frame=end_frame)
+
+
+class PreviewMixin:
+    """Add the `preview_duration` conversion option to an nwb_conversion_tools recording or sorting interface.
+
+    Subclass it before the interface, e.g. ``class Recording(PreviewMixin, SpikeGLXRecordingInterface)``.
+    """
+
+    def get_conversion_options_schema(self):
+        schema = super().get_conversion_options_schema()
+        schema.setdefault('properties', dict())['preview_duration'] = dict(type='number')
+        return schema
+
+    def run_conversion(self, nwbfile, metadata, preview_duration=None, **conversion_options):
+        if preview_duration is not None:
+            for name in ('recording_extractor', 'sorting_extractor'):
+                if hasattr(self, name):
+                    setattr(self, name, first_seconds(getattr(self, name), preview_duration))
+        return super().run_conversion(nwbfile, metadata, **conversion_options)
@@ -1,69 +1,361 @@
+import re
+from pathlib import Path
+
 import numpy as np
 
+DATA_START = b'data_start'
+NUMBER_CHANNELS = 4
+
+
+def read_header(filename, max_header_size=2 ** 16):
+    """Read the text header of an Axona data file.
+
+    Parameters
+    ----------
+    filename: str | Path
+    max_header_size: int (optional)
+        number of bytes searched for 'data_start'
+    Returns
+    -------
+    header: dict
+        value of each header key, as str
+    data_offset: int
+        position in the file of the first byte of data, right after 'data_start'
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(max_header_size)
+    data_start = head.find(DATA_START)
+    if data_start < 0:
+        raise ValueError("'{}' not found in the first {} bytes of {}".format(DATA_START.decode(), max_header_size,
+                                                                            filename))
+    return parse_header(head[:data_start].decode('latin-1')), data_start + len(DATA_START)
+
+
+def parse_header(text):
+    """Parse the 'key value' lines of an Axona header or .set file into a dict of str."""
+    header = dict()
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(' ')
+        if key:
+            header[key] = value.strip()
+    return header
+
+
+def read_set(filename):
+    """Read the settings of a session from its .set file into a dict of str."""
+    with open(filename, 'r', encoding='latin-1') as f:
+        return parse_header(f.read())
+
+
+def set_file_path(filename):
+    """The .set file of the session of a data file, e.g. 052301.set for 052301.6 or 052301.egf."""
+    return Path(filename).with_suffix('.set')
+
+
+def channel_conversion(settings, channels, bytes_per_sample=1):
+    """Factor converting the samples of each channel to volts, from the gains and ADC range in the .set file.
+
+    Parameters
+    ----------
+    settings: dict
+        as returned by `read_set`
+    channels: array-like of int
+        channel numbers, starting at 0, e.g. 4 * (N - 1) + [0, 1, 2, 3] for tetrode N
+    bytes_per_sample: int (optional)
+    Returns
+    -------
+    np.ndarray of float
+        volts per bit of each channel
+    """
+    adc_fullscale = float(settings['ADC_fullscale_mv']) * 1e-3
+    gains = np.array([float(settings['gain_ch_{}'.format(channel)]) for channel in channels])
+    return adc_fullscale / (gains * 2 ** (8 * bytes_per_sample - 1))
+
+
+def header_number(header, key):
+    """Leading number of a header value, e.g. 96000 for 'timebase 96000 hz'."""
+    return int(float(header[key].split(' ')[0]))
+
+
+def tetrode_dtype(bytes_per_timestamp=4, samples_per_spike=50, bytes_per_sample=1):
+    """Structured dtype of one spike in a tetrode file: for each of the 4 channels, a big-endian timestamp followed
+    by the samples of its waveform."""
+    sample_dtype = 'i1' if bytes_per_sample == 1 else '<i{}'.format(bytes_per_sample)
+    channel_dtype = [('t', '>u{}'.format(bytes_per_timestamp)), ('waveform', sample_dtype, (samples_per_spike,))]
+    return np.dtype([('ch{}'.format(chan + 1), channel_dtype) for chan in range(NUMBER_CHANNELS)])
+
+
+def read_tetrode(filename):
+    """Memory-map the spikes of a tetrode (.N) file.
+
+    Parameters
+    ----------
+    filename: str | Path
+    Returns
+    -------
+    spikes: np.memmap (num_spikes,)
+        one record per spike, see `tetrode_dtype`. ``spikes['ch1']['t']`` are the timestamps in units of the
+        timebase and ``spikes['ch1']['waveform']`` the (num_spikes, samples_per_spike) waveforms of channel 1.
+    spikeparam: dict
+        parameters of the spikes from the header
+    """
+    header, data_offset = read_header(filename)
+    spikeparam = {key: header_number(header, key)
+                  for key in ('timebase', 'bytes_per_sample', 'samples_per_spike', 'bytes_per_timestamp', 'duration',
+                              'num_spikes', 'sample_rate')}
+    dtype = tetrode_dtype(spikeparam['bytes_per_timestamp'], spikeparam['samples_per_spike'],
+                          spikeparam['bytes_per_sample'])
+    if not spikeparam['num_spikes']:
+        return np.zeros(0, dtype=dtype), spikeparam
+    spikes = np.memmap(filename, dtype=dtype, mode='r', offset=data_offset, shape=(spikeparam['num_spikes'],))
+    return spikes, spikeparam
+
 
 # importspikes was lifted from https://github.com/GeoffBarrett/gebaSpike
-def importspikes(filename):
+def importspikes(filename, set_filename=None):
     """Reads through the tetrode file as an input and returns two things, a dictionary containing the following:
-    timestamps, ch1-ch4 waveforms, and it also returns a dictionary containing the spike parameters"""
+    timestamps, ch1-ch4 waveforms, and it also returns a dictionary containing the spike parameters
 
-    with open(filename, 'rb') as f:
-        for line in f:
-            if 'data_start' in str(line):
-                spike_data = np.fromstring((line + f.read())[len('data_start'):-len('\r\ndata_end\r\n')], dtype='uint8')
-                break
-            elif 'num_spikes' in str(line):
-                num_spikes = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'bytes_per_timestamp' in str(line):
-                bytes_per_timestamp = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'samples_per_spike' in str(line):
-                samples_per_spike = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'bytes_per_sample' in str(line):
-                bytes_per_sample = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'timebase' in str(line):
-                timebase = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'duration' in str(line):
-                duration = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'sample_rate' in str(line):
-                samp_rate = int(line.decode(encoding='UTF-8').split(" ")[1])
-
-                # calculating the big-endian and little endian matrices so we can convert from bytes -> decimal
-    big_endian_vector = 256 ** np.arange(bytes_per_timestamp - 1, -1, -1)
-    little_endian_matrix = np.arange(0, bytes_per_sample).reshape(bytes_per_sample, 1)
-    little_endian_matrix = 256 ** np.matlib.repmat(little_endian_matrix, 1, samples_per_spike)
-
-    number_channels = 4
-
-    # calculating the timestamps
-    t_start_indices = np.linspace(0, num_spikes * (bytes_per_sample * samples_per_spike * 4 +
-                                                   bytes_per_timestamp * 4), num=num_spikes, endpoint=False).astype(
-        int).reshape(num_spikes, 1)
-    t_indices = t_start_indices
-
-    for chan in np.arange(1, number_channels):
-        t_indices = np.hstack((t_indices, t_start_indices + chan))
-
-    t = spike_data[t_indices].reshape(num_spikes, bytes_per_timestamp)  # acquiring the time bytes
-    t = np.sum(np.multiply(t, big_endian_vector), axis=1) / timebase  # converting from bytes to float values
-
-    waveform_data = np.zeros((number_channels, num_spikes, samples_per_spike))  # (dimensions, rows, columns)
-
-    # read the t,ch1,t,ch2,t,ch3,t,ch4
-
-    for chan in range(number_channels):  # only really care about the first time that gets written
-        chan_start_indices = t_start_indices + chan * samples_per_spike + bytes_per_timestamp + bytes_per_timestamp * chan
-        for spike_sample in np.arange(1, samples_per_spike):
-            chan_start_indices = np.hstack((chan_start_indices, t_start_indices +
-                                            chan * samples_per_spike + bytes_per_timestamp +
-                                            bytes_per_timestamp * chan + spike_sample))
-        waveform_data[chan][:][:] = spike_data[chan_start_indices].reshape(num_spikes, samples_per_spike).astype(
-            'int8')  # acquiring the channel bytes
-        waveform_data[chan][:][:][np.where(waveform_data[chan][:][:] > 127)] -= 256
-        waveform_data[chan][:][:] = np.multiply(waveform_data[chan][:][:], little_endian_matrix)
-
-    spikeparam = {'timebase': timebase, 'bytes_per_sample': bytes_per_sample, 'samples_per_spike': samples_per_spike,
-                  'bytes_per_timestamp': bytes_per_timestamp, 'duration': duration, 'num_spikes': num_spikes,
-                  'sample_rate': samp_rate}
-
-    return {'t': t.reshape(num_spikes, 1), 'ch1': np.asarray(waveform_data[0][:][:]),
-            'ch2': np.asarray(waveform_data[1][:][:]),
-            'ch3': np.asarray(waveform_data[2][:][:]), 'ch4': np.asarray(waveform_data[3][:][:])}, spikeparam
+    The waveforms are views of the file in their native integer dtype (int8 for 1 byte per sample). When the .set
+    file of the session is found, spikeparam['conversion'] holds the volts per bit of each channel, otherwise None.
+
+    Parameters
+    ----------
+    filename: str | Path
+        tetrode file, e.g. 052301.6 for tetrode 6
+    set_filename: str | Path | None (optional)
+        .set file of the session. Defaults to the tetrode file with a .set extension.
+    """
+    spikes, spikeparam = read_tetrode(filename)
+    num_spikes = spikeparam['num_spikes']
+
+    # only really care about the first time that gets written
+    t = spikes['ch1']['t'] / spikeparam['timebase']
+
+    data = {'t': t.reshape(num_spikes, 1)}
+    for chan in range(NUMBER_CHANNELS):
+        name = 'ch{}'.format(chan + 1)
+        data[name] = spikes[name]['waveform']
+
+    spikeparam['conversion'] = tetrode_conversion(filename, spikeparam['bytes_per_sample'], set_filename)
+
+    return data, spikeparam
+
+
+def tetrode_conversion(filename, bytes_per_sample=1, set_filename=None):
+    """Volts per bit of the 4 channels of a tetrode file, from the .set file of its session.
+
+    Parameters
+    ----------
+    filename: str | Path
+        tetrode file, e.g. 052301.6 for tetrode 6
+    bytes_per_sample: int (optional)
+    set_filename: str | Path | None (optional)
+        .set file of the session. Defaults to the tetrode file with a .set extension.
+    Returns
+    -------
+    np.ndarray (4,) | None
+        None if the .set file does not exist
+    """
+    if set_filename is None:
+        set_filename = set_file_path(filename)
+    if not Path(set_filename).exists():
+        return None
+    tetrode = int(Path(filename).suffix[1:])
+    channels = NUMBER_CHANNELS * (tetrode - 1) + np.arange(NUMBER_CHANNELS)
+    return channel_conversion(read_set(set_filename), channels, bytes_per_sample)
+
+
+def header_float(header, key):
+    """Leading number of a header value as float, e.g. 50.0 for 'sample_rate 50.0 hz'."""
+    return float(header[key].split(' ')[0])
+
+
+def read_pos(filename):
+    """Memory-map the position tracking frames of a .pos file.
+
+    Each frame is a big-endian frame counter followed by 8 big-endian coordinates: x1, y1, x2, y2 of the two LEDs,
+    then numpix1, numpix2, total_pix and an unused value.
+
+    Parameters
+    ----------
+    filename: str | Path
+    Returns
+    -------
+    frames: np.memmap (num_pos_samples,)
+        with fields 't' and 'coords' (num_pos_samples, 8)
+    posparam: dict
+        sample_rate, pixels_per_metre and num_pos_samples
+    """
+    header, data_offset = read_header(filename)
+    dtype = np.dtype([('t', '>u{}'.format(header_number(header, 'bytes_per_timestamp'))),
+                      ('coords', '>i{}'.format(header_number(header, 'bytes_per_coord')), (8,))])
+    posparam = dict(sample_rate=header_float(header, 'sample_rate'),
+                    pixels_per_metre=header_float(header, 'pixels_per_metre'),
+                    num_pos_samples=header_number(header, 'num_pos_samples'))
+    if not posparam['num_pos_samples']:
+        return np.zeros(0, dtype=dtype), posparam
+    frames = np.memmap(filename, dtype=dtype, mode='r', offset=data_offset, shape=(posparam['num_pos_samples'],))
+    return frames, posparam
+
+
+def led_positions(frames, pixels_per_metre, missing=1023):
+    """Decode the position of both LEDs in metres, with NaN where an LED was not tracked.
+
+    Parameters
+    ----------
+    frames: np.ndarray
+        as returned by `read_pos`
+    pixels_per_metre: float
+    missing: int (optional)
+        coordinate value of untracked frames
+    Returns
+    -------
+    np.ndarray (num_pos_samples, 2 LEDs, 2)
+        x, y of each LED
+    """
+    coords = frames['coords'][:, :4].reshape(-1, 2, 2)
+    positions = coords / pixels_per_metre
+    positions[(coords == missing).any(axis=2)] = np.nan
+    return positions
+
+
+def read_eeg(filename):
+    """Memory-map the continuous data of an .eeg/.egf file.
+
+    Parameters
+    ----------
+    filename: str | Path
+        .eeg, .eeg2, ... (int8) or .egf, .egf2, ... (little-endian int16) file
+    Returns
+    -------
+    samples: np.memmap (num_samples,)
+    eegparam: dict
+        sample_rate, bytes_per_sample and num_samples
+    """
+    header, data_offset = read_header(filename)
+    num_key = 'num_EGF_samples' if 'num_EGF_samples' in header else 'num_EEG_samples'
+    eegparam = dict(sample_rate=header_float(header, 'sample_rate'),
+                    bytes_per_sample=header_number(header, 'bytes_per_sample'),
+                    num_samples=header_number(header, num_key))
+    dtype = 'i1' if eegparam['bytes_per_sample'] == 1 else '<i{}'.format(eegparam['bytes_per_sample'])
+    if not eegparam['num_samples']:
+        return np.zeros(0, dtype=dtype), eegparam
+    samples = np.memmap(filename, dtype=dtype, mode='r', offset=data_offset, shape=(eegparam['num_samples'],))
+    return samples, eegparam
+
+
+def eeg_channel(settings, filename):
+    """Recorded channel (starting at 0) of an .eeg/.egf file, from the EEG_ch_N entries of the .set file."""
+    number = Path(filename).suffix[4:] or '1'
+    return int(settings['EEG_ch_{}'.format(number)]) - 1
+
+
+def read_cut(filename):
+    """Read the cluster of each spike from a Tint .cut file, e.g. 052301_6.cut (0 is unassigned)."""
+    with open(filename, 'r', encoding='latin-1') as f:
+        text = f.read()
+    start = text.find('Exact_cut_for')
+    if start < 0:
+        raise ValueError("'Exact_cut_for' not found in {}".format(filename))
+    # the cluster assignments follow the line 'Exact_cut_for: <basename> spikes: <num_spikes>'
+    return np.array(text[text.index('\n', start):].split(), dtype=int)
+
+
+def read_clu(filename):
+    """Read the cluster of each spike from a KlustaKwik .clu.N file, whose first value is the number of clusters."""
+    with open(filename, 'r') as f:
+        return np.array(f.read().split()[1:], dtype=int)
+
+
+def read_cluster_labels(filename):
+    """Read the cluster of each spike from a .cut or .clu.N file."""
+    if Path(filename).suffix == '.cut':
+        return read_cut(filename)
+    return read_clu(filename)
+
+
+def mean_waveforms(spikes, labels, ids, block_size=2 ** 16):
+    """Mean waveform of the spikes of each cluster.
+
+    The spikes are read in file order, block by block, and summed per cluster with one sparse one-hot product per
+    block, so the waveforms of a tetrode are neither gathered by cluster nor held in memory at once.
+
+    Parameters
+    ----------
+    spikes: np.ndarray
+        as returned by `read_tetrode`
+    labels: np.ndarray
+        cluster of each spike
+    ids: np.ndarray
+        clusters to average, in output order. Spikes of other clusters are left out.
+    block_size: int (optional)
+        number of spikes read at a time
+    Returns
+    -------
+    np.ndarray (n_clusters, samples_per_spike, 4)
+        in the units of the samples
+    """
+    from scipy.sparse import csr_matrix
+
+    ids = np.ravel(ids)
+    labels = np.ravel(labels)
+    # position of the cluster of each spike in ids, valid only for the spikes of clusters in ids
+    sorter = np.argsort(ids)
+    position = np.searchsorted(ids, labels, sorter=sorter)
+    valid = position < len(ids)
+    cluster = np.zeros(len(labels), dtype=int)
+    cluster[valid] = sorter[position[valid]]
+    valid[valid] = ids[cluster[valid]] == labels[valid]
+    counts = np.bincount(cluster[valid], minlength=len(ids))
+
+    channels = ['ch{}'.format(chan + 1) for chan in range(NUMBER_CHANNELS)]
+    samples_per_spike = spikes.dtype['ch1']['waveform'].shape[0]
+    sums = np.zeros((len(ids), samples_per_spike * NUMBER_CHANNELS))
+    for start in range(0, len(spikes), block_size):
+        stop = min(start + block_size, len(spikes))
+        spike = np.flatnonzero(valid[start:stop])
+        one_hot = csr_matrix((np.ones(len(spike)), (cluster[start + spike], spike)), shape=(len(ids), stop - start))
+        block = np.stack([spikes[channel]['waveform'][start:stop] for channel in channels], axis=2)
+        sums += one_hot @ block.reshape(stop - start, -1).astype(float)
+    return (sums / np.maximum(counts, 1)[:, None]).reshape(len(ids), samples_per_spike, NUMBER_CHANNELS)
+
+
+def find_session_files(basename):
+    """Find the files of an Axona session.
+
+    Parameters
+    ----------
+    basename: str | Path
+        path of the session without extension, e.g. raw/052301
+    Returns
+    -------
+    dict
+        tetrodes: dict of tetrode number -> .N file, in order of tetrode number
+        set: .set file or None
+        pos: .pos file or None
+        eeg, egf: lists of .eeg, .eeg2, ... and .egf, .egf2, ... files
+        cuts: dict of tetrode number -> cluster cut file, a Tint basename_N.cut or a KlustaKwik basename.clu.N
+    """
+    basename = Path(basename)
+    files = dict(tetrodes=dict(), set=None, pos=None, eeg=[], egf=[], cuts=dict())
+    for file_path in sorted(basename.parent.glob(basename.name + '_*.cut')):
+        tetrode = file_path.stem[len(basename.name) + 1:]
+        if tetrode.isdigit():
+            files['cuts'][int(tetrode)] = file_path
+    for file_path in sorted(basename.parent.glob(basename.name + '.*')):
+        extension = file_path.name[len(basename.name) + 1:]
+        if extension.isdigit():
+            files['tetrodes'][int(extension)] = file_path
+        elif re.fullmatch(r'clu\.\d+', extension):
+            # a .cut file of the same tetrode takes precedence
+            files['cuts'].setdefault(int(extension[4:]), file_path)
+        elif extension in ('set', 'pos'):
+            files[extension] = file_path
+        elif re.fullmatch(r'(eeg|egf)\d*', extension):
+            files[extension[:3]].append(file_path)
+    files['tetrodes'] = dict(sorted(files['tetrodes'].items()))
+    files['cuts'] = dict(sorted(files['cuts'].items()))
+    files['eeg'].sort(key=lambda file_path: int(file_path.suffix[4:] or 1))
+    files['egf'].sort(key=lambda file_path: int(file_path.suffix[4:] or 1))
+    return files
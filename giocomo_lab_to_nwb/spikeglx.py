@@ -0,0 +1,191 @@
+"""Write SpikeGLX recordings as ElectricalSeries whose data stay in the original .bin files.
+
+A SpikeGLX .bin file is a headerless (n_samples, n_saved_channels) array of little-endian int16, which is exactly
+the layout of a contiguous HDF5 dataset. Instead of copying it, the ElectricalSeries is written with an empty
+placeholder and, once the NWB file is written, the placeholder is replaced by a dataset with external storage that
+points at the .bin file. The raw part of a conversion becomes a metadata operation, and the NWB file can only be
+read where the .bin files are, at the absolute path they were linked from.
+
+The conversion factors come from the gains in the .meta file. The sync channel is part of the .bin file so it is
+kept as the last channel, with the conversion of the raw integer. The nwb_conversion_tools interface and converter
+mixin built on these functions are in spikeglx_interface.
+"""
+from pathlib import Path
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from pynwb.ecephys import ElectricalSeries, LFP
+
+from .codec_benchmark import read_spikeglx_meta
+from .tables import add_electrodes
+from .utils import check_module
+
+# SpikeGLX writes int16, little-endian, without a header
+DTYPE = np.dtype('<i2')
+HEADER_SIZE = 0
+
+# imro table types of probes with a fixed gain and no LF band, e.g. Neuropixels 2.0
+FIXED_GAIN_PROBES = (21, 24, 2013)
+FIXED_GAIN = 80.
+
+
+def saved_channels(meta):
+    """Stream, 'ap', 'lf' or 'sy', and probe channel of each channel saved in an imec .bin file, in file order.
+
+    With snsSaveChanSubset=all, the channels of the file are those of its own stream, counted by snsApLfSy: the AP,
+    LF and sync channels of an .ap.bin are 384,0,1 and those of an .lf.bin 0,384,1. An explicit subset lists
+    acquisition channels, numbered AP, then LF if the probe has an LF band, then sync, e.g. 0:383,768 in an .ap.meta
+    and 384:767,768 in an .lf.meta.
+    """
+    subset = meta.get('snsSaveChanSubset', 'all')
+    if subset == 'all':
+        n_ap, n_lf, n_sy = (int(value) for value in meta['snsApLfSy'].split(','))
+        return [('ap', i) for i in range(n_ap)] + [('lf', i) for i in range(n_lf)] + [('sy', i) for i in range(n_sy)]
+
+    probe_type, n_probe_channels = (int(value) for value in meta['~imroTbl'].strip('()').split(')(')[0].split(','))
+    n_lf = 0 if probe_type in FIXED_GAIN_PROBES else n_probe_channels
+    channels = []
+    for part in subset.split(','):
+        start, _, stop = part.partition(':')
+        for channel in range(int(start), int(stop or start) + 1):
+            if channel < n_probe_channels:
+                channels.append(('ap', channel))
+            elif channel < n_probe_channels + n_lf:
+                channels.append(('lf', channel - n_probe_channels))
+            else:
+                channels.append(('sy', channel - n_probe_channels - n_lf))
+    return channels
+
+
+def channel_gains(meta):
+    """Gain of each saved channel of an imec .bin file, from the imro table, and whether it is a sync channel.
+
+    Returns
+    -------
+    gains: np.ndarray
+        1 for the sync channels
+    sync: np.ndarray of bool
+    """
+    header, *entries = meta['~imroTbl'].strip('()').split(')(')
+    probe_type, n_probe_channels = (int(value) for value in header.split(','))
+    if probe_type in FIXED_GAIN_PROBES:
+        stream_gains = dict(ap=np.full(n_probe_channels, FIXED_GAIN))
+    else:
+        fields = np.array([entry.split() for entry in entries], dtype=float)
+        stream_gains = dict(ap=fields[:, 3], lf=fields[:, 4])
+
+    channels = saved_channels(meta)
+    sync = np.array([stream == 'sy' for stream, _ in channels])
+    gains = np.array([1. if stream == 'sy' else stream_gains[stream][channel] for stream, channel in channels])
+    return gains, sync
+
+
+def spikeglx_layout(file_path):
+    """Layout of a SpikeGLX imec .bin file and the conversion of its integers to volts, from its .meta file.
+
+    Parameters
+    ----------
+    file_path: str | Path
+        .ap.bin or .lf.bin file, with its .meta file next to it
+    Returns
+    -------
+    dict
+        n_samples, n_channels, sampling_rate, offset: bytes before the data in the file,
+        conversion: volts per integer at a gain of 1, channel_conversion: 1 / gain of each channel
+    """
+    meta = read_spikeglx_meta(file_path)
+    n_channels = int(meta['nSavedChans'])
+    n_bytes = int(meta.get('fileSizeBytes', Path(file_path).stat().st_size)) - HEADER_SIZE
+    probe_type = int(meta['~imroTbl'].strip('()').split(')(')[0].split(',')[0])
+    max_int = float(meta.get('imMaxInt', 8192 if probe_type in FIXED_GAIN_PROBES else 512))
+    conversion = float(meta.get('imAiRangeMax', 0.6)) / max_int
+    gains, sync = channel_gains(meta)
+    # the sync channel reads as the raw integer
+    gains[sync] = conversion
+    return dict(
+        n_samples=n_bytes // (n_channels * DTYPE.itemsize),
+        n_channels=n_channels,
+        sampling_rate=float(meta['imSampRate']),
+        offset=HEADER_SIZE,
+        conversion=conversion,
+        channel_conversion=1. / gains,
+    )
+
+
+def electrode_region(nwbfile, n_channels):
+    """Region of the first `n_channels` electrodes, adding the channels of the probe and its sync if missing."""
+    if nwbfile.electrodes is None or len(nwbfile.electrodes) == 0:
+        device = nwbfile.create_device(name='Neuropixel-Imec', description='Neuropixels probe recorded with SpikeGLX')
+        group = nwbfile.create_electrode_group(name='Imec', description='channels of the probe', location='unknown',
+                                               device=device)
+        add_electrodes(nwbfile, [group] * (n_channels - 1), location='unknown', filtering='none')
+        add_electrodes(nwbfile, [group], location='SpikeGLX sync channel, not an electrode', filtering='none')
+    elif len(nwbfile.electrodes) < n_channels:
+        raise ValueError('the electrodes table has {} rows, the recording {} channels'.format(
+            len(nwbfile.electrodes), n_channels))
+    return nwbfile.create_electrode_table_region(list(range(n_channels)), 'channels of the SpikeGLX recording')
+
+
+def add_external_series(nwbfile, file_path, lfp=False, preview_duration=None):
+    """Add a SpikeGLX recording as an ElectricalSeries with a placeholder for its data, see `link_external`.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    file_path: str | Path
+        .ap.bin or .lf.bin file
+    lfp: bool (optional)
+        write the series in processing/ecephys/LFP instead of acquisition
+    preview_duration: float | None (optional)
+        link only the first seconds of the recording
+    Returns
+    -------
+    dict
+        path of the data in the NWB file -> (absolute path of the .bin file, offset, size in bytes, shape), the
+        external storage that replaces the placeholder
+    """
+    layout = spikeglx_layout(file_path)
+    n_samples = layout['n_samples']
+    if preview_duration is not None:
+        n_samples = min(n_samples, int(round(preview_duration * layout['sampling_rate'])))
+    shape = (n_samples, layout['n_channels'])
+
+    series = ElectricalSeries(
+        name='ElectricalSeries_lfp' if lfp else 'ElectricalSeries_raw',
+        description='SpikeGLX recording, stored in {}'.format(Path(file_path).name),
+        data=H5DataIO(shape=shape, dtype=DTYPE),
+        electrodes=electrode_region(nwbfile, layout['n_channels']),
+        rate=layout['sampling_rate'],
+        starting_time=0.,
+        conversion=layout['conversion'],
+        channel_conversion=layout['channel_conversion'],
+    )
+    if lfp:
+        check_module(nwbfile, 'ecephys').add(LFP(electrical_series=series))
+        data_path = 'processing/ecephys/LFP/{}/data'.format(series.name)
+    else:
+        nwbfile.add_acquisition(series)
+        data_path = 'acquisition/{}/data'.format(series.name)
+
+    n_bytes = int(np.prod(shape)) * DTYPE.itemsize
+    return {data_path: (str(Path(file_path).resolve()), layout['offset'], n_bytes, shape)}
+
+
+def link_external(nwbfile_path, external_storage):
+    """Replace the placeholders written by `add_external_series` with datasets stored in the .bin files.
+
+    Parameters
+    ----------
+    nwbfile_path: str | Path
+        the NWB file, once written
+    external_storage: dict
+        as returned by `add_external_series`
+    """
+    with h5py.File(nwbfile_path, 'a') as file:
+        for data_path, (file_path, offset, n_bytes, shape) in external_storage.items():
+            attributes = dict(file[data_path].attrs)
+            del file[data_path]
+            dataset = file.create_dataset(data_path, shape=shape, dtype=DTYPE, external=[(file_path, offset, n_bytes)])
+            for name, value in attributes.items():
+                dataset.attrs[name] = value
@@ -0,0 +1,54 @@
+"""nwb_conversion_tools interface and converter mixin that link SpikeGLX recordings instead of copying them."""
+from nwb_conversion_tools.basedatainterface import BaseDataInterface
+
+from .spikeglx import add_external_series, link_external
+
+
+class SpikeGLXExternalInterface(BaseDataInterface):
+    """SpikeGLX AP or LF recording written as a link to its .bin file instead of a copy.
+
+    The converter calls `link_external` with `external_storage` once the NWB file is written.
+    """
+
+    @classmethod
+    def get_source_schema(cls):
+        return dict(
+            required=['file_path'],
+            properties=dict(
+                file_path=dict(type='string')
+            )
+        )
+
+    def get_conversion_options_schema(self):
+        return dict(
+            type='object',
+            additionalProperties=False,
+            properties=dict(
+                preview_duration=dict(type='number')
+            )
+        )
+
+    def run_conversion(self, nwbfile, metadata, preview_duration=None):
+        file_path = self.source_data['file_path']
+        self.external_storage = add_external_series(nwbfile, file_path, lfp=file_path.endswith('.lf.bin'),
+                                                    preview_duration=preview_duration)
+
+
+def link_interfaces(nwbfile_path, data_interfaces):
+    """Link the external data of every SpikeGLXExternalInterface of a converter, once the NWB file is written."""
+    for data_interface in data_interfaces:
+        if getattr(data_interface, 'external_storage', None):
+            link_external(nwbfile_path, data_interface.external_storage)
+
+
+class ExternalLinkMixin:
+    """Link the data of the SpikeGLXExternalInterfaces of an NWBConverter once it has written its file.
+
+    Subclass it before the converter, e.g. ``class Converter(ExternalLinkMixin, NWBConverter)``.
+    """
+
+    def run_conversion(self, nwbfile_path=None, **kwargs):
+        nwbfile = super().run_conversion(nwbfile_path=nwbfile_path, **kwargs)
+        if nwbfile_path is not None and kwargs.get('save_to_file', True):
+            link_interfaces(nwbfile_path, self.data_interface_objects.values())
+        return nwbfile
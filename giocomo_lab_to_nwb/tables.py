@@ -0,0 +1,305 @@
+import numpy as np
+from hdmf.common import VectorData, VectorIndex, ElementIdentifiers, DynamicTableRegion
+from pynwb.epoch import TimeIntervals
+from pynwb.misc import Units
+
+try:
+    from pynwb.file import ElectrodesTable
+except ImportError:
+    # pynwb < 3
+    from pynwb.file import ElectrodeTable as ElectrodesTable
+
+from .compression import compressed
+
+
+def column(name, description, data, index=None, kind=None):
+    """Build a table column from data that is already laid out column-wise.
+
+    Parameters
+    ----------
+    name: str
+    description: str
+    data: array-like
+        one value per row or, for ragged columns, the flattened values of all rows
+    index: array-like | None (optional)
+        cumulative end offset of each row into `data`. Makes the column ragged.
+    kind: str | None (optional)
+        kind of dataset in the compression policy, to chunk and compress `data` with
+    Returns
+    -------
+    list of VectorData and VectorIndex
+    """
+    if kind is not None:
+        data = compressed(data, kind)
+    vector_data = VectorData(name=name, description=description, data=data)
+    if index is None:
+        return [vector_data]
+    return [vector_data, VectorIndex(name=name + '_index', data=index, target=vector_data)]
+
+
+def add_rows(table, columns, ids=None):
+    """Append rows to a DynamicTable column by column instead of calling add_row once per row.
+
+    Parameters
+    ----------
+    table: hdmf.common.DynamicTable
+    columns: dict
+        values of each (non-ragged) column, one per row. Every column of the table must be given.
+    ids: array-like | None (optional)
+        id of each row. Defaults to continuing from the number of rows already in the table.
+    Returns
+    -------
+    np.ndarray
+        the row indices of the added rows
+    """
+    n_rows = len(next(iter(columns.values())))
+    start = len(table)
+    if ids is None:
+        ids = np.arange(start, start + n_rows)
+
+    unknown = set(columns) - set(table.colnames)
+    missing = set(table.colnames) - set(columns)
+    if unknown or missing:
+        raise ValueError("columns of table '%s' do not match: unknown %s, missing %s"
+                         % (table.name, sorted(unknown), sorted(missing)))
+    for name, values in columns.items():
+        if len(values) != n_rows:
+            raise ValueError("column '%s' has %d values, expected %d" % (name, len(values), n_rows))
+
+    table.id.extend(ids)
+    for name, values in columns.items():
+        table[name].extend(values)
+
+    return np.arange(start, start + n_rows)
+
+
+def add_intervals(nwbfile, table_name, columns, descriptions=None):
+    """Fill the trials or epochs of an NWBFile column by column instead of calling add_trial or add_epoch per row.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    table_name: str
+        'trials' or 'epochs'
+    columns: dict | pd.DataFrame
+        values of start_time, stop_time and every other column of the table, one per row
+    descriptions: dict | None (optional)
+        description of each column that is not in the table yet
+    Returns
+    -------
+    pynwb.epoch.TimeIntervals | None
+        the table, None if there are no rows and the table does not exist yet, e.g. a preview that ends before the
+        first trial. Columns without values have no dtype and the file could not be written.
+    """
+    if not len(columns['start_time']):
+        return getattr(nwbfile, table_name)
+    add_column = dict(trials=nwbfile.add_trial_column, epochs=nwbfile.add_epoch_column)[table_name]
+    for name, description in (descriptions or {}).items():
+        add_column(name=name, description=description)
+    if getattr(nwbfile, table_name) is None:
+        setattr(nwbfile, table_name, TimeIntervals(name=table_name, description='experimental ' + table_name))
+    table = getattr(nwbfile, table_name)
+    add_rows(table, {name: np.asarray(columns[name]) for name in columns})
+    return table
+
+
+def add_electrodes(nwbfile, groups, location, filtering, rel_x=None, rel_y=None,
+                   coordinate_columns=('rel_x', 'rel_y')):
+    """Add all channels of a probe to the electrodes table in one operation.
+
+    Parameters
+    ----------
+    nwbfile: pynwb.NWBFile
+    groups: list of pynwb.ecephys.ElectrodeGroup
+        group of each electrode
+    location: str
+    filtering: str
+    rel_x: array-like | None (optional)
+        x-location of each electrode on the probe
+    rel_y: array-like | None (optional)
+        y-location of each electrode on the probe
+    coordinate_columns: tuple of str (optional)
+        names of the columns holding `rel_x` and `rel_y`
+    Returns
+    -------
+    np.ndarray
+        the row indices of the added electrodes, e.g. to create an electrode table region
+    """
+    n_electrodes = len(groups)
+    nan = np.full(n_electrodes, np.nan)
+    columns = dict(
+        x=nan,
+        y=nan,
+        z=nan,
+        imp=nan,
+        location=[location] * n_electrodes,
+        filtering=[filtering] * n_electrodes,
+        group=list(groups),
+        group_name=[group.name for group in groups]
+    )
+    descriptions = dict(
+        x='the x coordinate of the channel location',
+        y='the y coordinate of the channel location',
+        z='the z coordinate of the channel location',
+        imp='the impedance of the channel',
+        filtering='description of hardware filtering',
+        group_name='the name of the ElectrodeGroup this electrode is a part of'
+    )
+    for name, axis, coords in zip(coordinate_columns, 'xy', (rel_x, rel_y)):
+        if coords is not None:
+            columns[name] = np.asarray(coords, dtype=float)
+            descriptions[name] = 'electrode {}-location on the probe'.format(axis)
+
+    if nwbfile.electrodes is None:
+        nwbfile.electrodes = ElectrodesTable()
+    for name, description in descriptions.items():
+        if name in columns and name not in nwbfile.electrodes.colnames:
+            nwbfile.add_electrode_column(name, description)
+
+    return add_rows(nwbfile.electrodes, columns)
+
+
+def concatenate_ragged(arrays):
+    """Flatten a list of arrays into the data and index of a ragged column.
+
+    Parameters
+    ----------
+    arrays: list of array-like
+    Returns
+    -------
+    data: np.ndarray
+    index: np.ndarray
+        cumulative end offset of each array into `data`
+    """
+    index = np.cumsum([len(array) for array in arrays], dtype=int)
+    if not len(arrays):
+        return np.array([]), index
+    return np.concatenate([np.ravel(array) for array in arrays]), index
+
+
+def waveform_columns(templates, dtype=None):
+    """Build the columns holding the mean waveform of each unit, with its peak channel and peak-to-peak amplitude.
+
+    Parameters
+    ----------
+    templates: np.ndarray (n_units, n_samples, n_channels)
+    dtype: None | str (optional)
+        None writes the templates in their own dtype, otherwise they are converted to 'float32' or 'int16'. int16
+        values are scaled per unit, waveform_mean = waveform_mean_int16 * waveform_scale. Either way they are
+        chunked and compressed as 'waveforms' in the compression policy, by default one chunk per unit.
+    Returns
+    -------
+    list of lists of VectorData
+    """
+    templates = np.asarray(templates)
+    peak_to_peak_per_channel = templates.max(axis=1) - templates.min(axis=1)
+    peak_channel = np.argmax(peak_to_peak_per_channel, axis=1)
+    columns = [
+        column('peak_channel', 'index of the channel with the largest peak-to-peak amplitude of waveform_mean',
+               peak_channel),
+        column('peak_to_peak', 'peak-to-peak amplitude of waveform_mean on the peak channel',
+               peak_to_peak_per_channel[np.arange(len(templates)), peak_channel])
+    ]
+
+    if dtype is None:
+        return [column('waveform_mean', 'the spike waveform mean for each spike unit', templates,
+                       kind='waveforms')] + columns
+
+    if np.dtype(dtype) == np.int16:
+        scale = np.abs(templates).max(axis=(1, 2)) / np.iinfo(np.int16).max
+        scale[scale == 0] = 1
+        data = np.round(templates / scale[:, None, None]).astype(np.int16)
+        return [
+            column('waveform_mean_int16', 'the spike waveform mean for each spike unit, scaled to int16',
+                   data, kind='waveforms'),
+            column('waveform_scale', 'factor converting waveform_mean_int16 to the spike waveform mean', scale)
+        ] + columns
+
+    return [
+        column('waveform_mean', 'the spike waveform mean for each spike unit',
+               templates.astype(dtype), kind='waveforms')
+    ] + columns
+
+
+def make_units(ids, spike_times=None, spike_times_index=None, columns=(), name='units',
+               description='Autogenerated by NWBFile'):
+    """Build a Units table in one operation instead of one add_unit call per unit.
+
+    Parameters
+    ----------
+    ids: array-like
+        id of each unit
+    spike_times: array-like | None (optional)
+        spike times of all units, grouped by unit in the order of `ids`
+    spike_times_index: array-like | None (optional)
+        cumulative end offset of each unit into `spike_times`, e.g. from utils.group_by_label
+    columns: iterable of lists of VectorData (optional)
+        additional columns, as returned by `column`
+    name: str (optional)
+    description: str (optional)
+    Returns
+    -------
+    pynwb.misc.Units
+    """
+    all_columns = []
+    if spike_times is not None:
+        all_columns.extend(
+            column('spike_times', 'the spike times for each unit', spike_times, index=spike_times_index,
+                   kind='spikes')
+        )
+    for col in columns:
+        all_columns.extend(col)
+
+    return Units(
+        name=name,
+        description=description,
+        id=ElementIdentifiers(name='id', data=ids),
+        columns=all_columns
+    )
+
+
+def make_template_units(template_ids, spike_times_index, temp_scaling_amps, electrode_group, spike_times=None,
+                        units=None, name='TemplateUnits', description='units assigned during automatic spike sorting'):
+    """Build the table of units found by automatic spike sorting, one row per template.
+
+    The spike times are either stored in the table itself or, when every template is exactly one unit of an
+    existing units table, referenced through a `unit` column so they are only stored once.
+
+    Parameters
+    ----------
+    template_ids: array-like
+    spike_times_index: array-like
+        cumulative end offset of each template into `temp_scaling_amps` (and `spike_times`)
+    temp_scaling_amps: array-like
+        scaling amplitude of each spike, grouped by template in the order of `template_ids`
+    electrode_group: pynwb.ecephys.ElectrodeGroup
+    spike_times: array-like | None (optional)
+        spike times, in the same order as `temp_scaling_amps`
+    units: pynwb.misc.Units | None (optional)
+        units table whose rows hold, in the same order, the spike times of each template
+    name: str (optional)
+    description: str (optional)
+    Returns
+    -------
+    pynwb.misc.Units
+    """
+    columns = [
+        column('electrode_group', 'the electrode group that each spike unit came from',
+               [electrode_group] * len(template_ids)),
+        column('tempScalingAmps', 'scaling amplitude applied to the template when extracting spike',
+               temp_scaling_amps, index=spike_times_index, kind='spikes')
+    ]
+    if units is not None:
+        columns.append([
+            DynamicTableRegion(name='unit', data=np.arange(len(template_ids)),
+                               description='the unit holding the spike times of this template', table=units)
+        ])
+
+    return make_units(
+        ids=template_ids,
+        spike_times=spike_times,
+        spike_times_index=spike_times_index,
+        columns=columns,
+        name=name,
+        description=description
+    )
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def check_module(nwbfile, name, description=None):
     """Check if processing module exists. If not, create it. Then return module.
     Parameters
@@ -15,3 +18,108 @@ def check_module(nwbfile, name, description=None):
         if description is None:
             description = name
         return nwbfile.create_processing_module(name, description)
+
+
+def group_by_label(labels, ids=None):
+    """Partition elements by label with a single stable argsort.
+
+    Parameters
+    ----------
+    labels: array-like
+        label of each element, e.g. the cluster id of each spike
+    ids: array-like | None (optional)
+        labels to group by, in output order. Defaults to the sorted unique labels.
+    Returns
+    -------
+    order: np.ndarray
+        indices that gather the elements of each group contiguously, in the order of `ids`. Elements keep
+        their original order within a group.
+    index: np.ndarray
+        cumulative end offset of each group into `order`, i.e. the layout of a VectorIndex
+    ids: np.ndarray
+    """
+    labels = np.ravel(labels)
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    if ids is None:
+        ids = np.unique(sorted_labels)
+    ids = np.ravel(ids)
+
+    starts = np.searchsorted(sorted_labels, ids, side='left')
+    counts = np.searchsorted(sorted_labels, ids, side='right') - starts
+    index = np.cumsum(counts)
+    # shift each group from its position in the sorted labels to its position in the output
+    take = np.arange(counts.sum()) + np.repeat(starts - (index - counts), counts)
+
+    return order[take], index, ids
+
+
+def one_to_one_labels(labels, other_labels):
+    """Check whether two labelings of the same elements describe the same partition.
+
+    Parameters
+    ----------
+    labels: array-like
+    other_labels: array-like
+        a second label for each element, e.g. the template of each spike next to its cluster
+    Returns
+    -------
+    dict | None
+        maps each label to its counterpart in `other_labels`, or None if some label has more than one
+        counterpart (in either direction)
+    """
+    pairs = np.unique(np.c_[np.ravel(labels), np.ravel(other_labels)], axis=0)
+    if len(np.unique(pairs[:, 0])) != len(pairs) or len(np.unique(pairs[:, 1])) != len(pairs):
+        return None
+    return dict(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+
+
+def cluster_templates(spike_cluster, spike_templates, cluster_ids):
+    """Template of each cluster when every cluster is exactly one template, see `one_to_one_labels`.
+
+    Parameters
+    ----------
+    spike_cluster: array-like
+        cluster of each spike
+    spike_templates: array-like
+        template of each spike
+    cluster_ids: array-like
+        clusters in output order, e.g. sp/cids
+    Returns
+    -------
+    np.ndarray | None
+        template of each cluster of `cluster_ids`, or None if the partitions differ or a cluster has no spikes, and
+        so no template
+    """
+    template_of_cluster = one_to_one_labels(spike_cluster, spike_templates)
+    if template_of_cluster is None:
+        return None
+    cluster_ids = np.ravel(cluster_ids).tolist()
+    if not all(cluster_id in template_of_cluster for cluster_id in cluster_ids):
+        return None
+    return np.array([template_of_cluster[cluster_id] for cluster_id in cluster_ids], dtype=int)
+
+
+def segment_runs(labels):
+    """Find the runs of consecutive equal labels in one pass, e.g. the samples of each trial.
+
+    Parameters
+    ----------
+    labels: array-like
+        label of each sample
+    Returns
+    -------
+    starts: np.ndarray
+        index of the first sample of each run
+    stops: np.ndarray
+        index one past the last sample of each run
+    run_labels: np.ndarray
+        label of each run
+    """
+    labels = np.ravel(labels)
+    if not len(labels):
+        return np.array([], dtype=int), np.array([], dtype=int), labels
+    boundaries = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.r_[0, boundaries]
+    stops = np.r_[boundaries, len(labels)]
+    return starts, stops, labels[starts]
@@ -0,0 +1,76 @@
+"""Check NWB files once they are written.
+
+Three levels of verification:
+
+    'none'        nothing is checked
+    'structural'  the file is opened with h5py and the expected groups and datasets, with their shapes and dtypes,
+                  are looked up. No pynwb object is built, so this costs a few metadata reads.
+    'full'        the file is read back with pynwb, which builds every container
+"""
+import h5py
+import numpy as np
+from pynwb import NWBHDF5IO
+
+LEVELS = ('none', 'structural', 'full')
+
+# written by pynwb in every NWB file
+REQUIRED = ('acquisition', 'analysis', 'general', 'processing', 'stimulus', 'identifier', 'session_description',
+            'session_start_time', 'timestamps_reference_time', 'file_create_date')
+
+
+def dataset_spec(data):
+    """Shape and dtype that a dataset written from `data` is expected to have, small enough to send to a process."""
+    data = np.asarray(data)
+    return tuple(data.shape), data.dtype.str
+
+
+def check_structure(nwb_path, expected=None):
+    """Check with h5py that an NWB file has the expected groups and datasets.
+
+    Parameters
+    ----------
+    nwb_path: str | Path
+    expected: dict | None (optional)
+        path in the file -> None for a group or a dataset of any shape, or (shape, dtype) of a dataset,
+        see `dataset_spec`. A shape of None matches any shape.
+    """
+    expected = dict(expected or {})
+    with h5py.File(nwb_path, 'r') as file:
+        if 'nwb_version' not in file.attrs:
+            raise ValueError('{} is not an NWB file, it has no nwb_version'.format(nwb_path))
+        for path in REQUIRED + tuple(expected):
+            if path not in file:
+                raise ValueError("'{}' not found in {}".format(path, nwb_path))
+        for path, spec in expected.items():
+            if spec is None:
+                continue
+            shape, dtype = spec
+            dataset = file[path]
+            if not isinstance(dataset, h5py.Dataset):
+                raise ValueError("'{}' in {} is not a dataset".format(path, nwb_path))
+            if shape is not None and dataset.shape != tuple(shape):
+                raise ValueError("'{}' in {} has shape {}, expected {}".format(path, nwb_path, dataset.shape,
+                                                                               tuple(shape)))
+            if dtype is not None and dataset.dtype != np.dtype(dtype):
+                raise ValueError("'{}' in {} has dtype {}, expected {}".format(path, nwb_path, dataset.dtype,
+                                                                               np.dtype(dtype)))
+
+
+def verify(nwb_path, level='structural', expected=None):
+    """Verify a written NWB file, raise ValueError if it is not as expected.
+
+    Parameters
+    ----------
+    nwb_path: str | Path
+    level: str (optional)
+        'none', 'structural' or 'full'
+    expected: dict | None (optional)
+        groups and datasets that the structural check looks up, see `check_structure`
+    """
+    if level not in LEVELS:
+        raise ValueError('verification level must be one of {}, got {}'.format(LEVELS, level))
+    if level == 'structural':
+        check_structure(nwb_path, expected)
+    elif level == 'full':
+        with NWBHDF5IO(str(nwb_path), 'r') as io:
+            io.read()
@@ -4,6 +4,9 @@ from datetime import datetime
 
 from wen21nwbconverter import Wen21NWBConverter
 from nwb_conversion_tools.utils import dict_deep_update, load_dict_from_file
+from giocomo_lab_to_nwb.cache import deterministic_identifier, fingerprint, is_up_to_date, write_fingerprint
+from giocomo_lab_to_nwb.catalog import build_catalog, session_paths
+from giocomo_lab_to_nwb.compression import recording_options, set_policy
 
 # To be changed in the running system
 data_path = Path("/media/heberto/TOSHIBA EXT/Wen/")
@@ -11,17 +14,30 @@ output_path = Path("/media/heberto/TOSHIBA EXT/nwb/")
 
 general_metadata_path = Path("./giocomo_lab_to_nwb/wen22/metadata.yml")
 stub_test = True
-if stub_test:
+# Convert only the first seconds of every interface, to check a conversion end to end. None for whole sessions
+preview_duration = None
+if stub_test or preview_duration is not None:
     output_path = output_path.parent / "nwb_stub"
 spikeextractors_backend = False
+# Link the AP and LF .bin files from the NWB files instead of copying them, the NWB files then need the .bin files
+link_raw = False
+# Compression profile written by codec_benchmark, None for the package defaults
+compression_profile = None
+set_policy(compression_profile)
+# Skip sessions whose output was already converted from the same inputs, metadata and converter
+skip_unchanged = True
+# Derive the NWB identifier from the inputs instead of a random uuid
+use_deterministic_identifier = False
 
-session_path_list = [path for path in data_path.iterdir() if path.name != "VR"]
-# session_path_list = [session_path_list[-1]]
-for session_path in session_path_list:
+# The data tree is walked once, sessions whose directories did not change are not scanned again
+catalog = build_catalog([data_path], output_path / "catalog.json")
+session_list = [session for path, session in catalog.items() if Path(path).name != "VR"]
+# session_list = [session_list[-1]]
+for session in session_list:
     # Determine relevant file paths and initialize variables
+    session_path = Path(session["path"])
     session_id = session_path.name
-    device = "imec0"
-    directory_with_data_path = session_path / f"{session_id}_{device}"
+    directory_with_data_path = Path(session["ap"]).parent
 
     source_data = dict()
     conversion_options = dict()
@@ -31,20 +47,24 @@ for session_path in session_path_list:
     print(f"{session_id=}")
 
     # Raw signal spikeglx
-    signal_kind = "ap"
-    ap_file_name = f"{directory_with_data_path.stem.replace('g0_', 'g0_t0.')}.{signal_kind}.bin"
-    ap_file_path = directory_with_data_path / ap_file_name
-    source_data.update(
-        SpikeGLXRecording=dict(file_path=str(ap_file_path), spikeextractors_backend=spikeextractors_backend)
-    )
-    conversion_options.update(SpikeGLXRecording=dict(stub_test=stub_test))
+    ap_file_path = session["ap"]
+    if link_raw:
+        source_data.update(SpikeGLXRecordingExternal=dict(file_path=str(ap_file_path)))
+    else:
+        source_data.update(
+            SpikeGLXRecording=dict(file_path=str(ap_file_path), spikeextractors_backend=spikeextractors_backend)
+        )
+        conversion_options.update(SpikeGLXRecording=dict(stub_test=stub_test, **recording_options("raw")))
 
     # LFP signa spikeglx
-    signal_kind = "lf"
-    lf_file_name = f"{directory_with_data_path.stem.replace('g0_', 'g0_t0.')}.{signal_kind}.bin"
-    lf_file_path = directory_with_data_path / lf_file_name
-    source_data.update(SpikeGLXLFP=dict(file_path=str(lf_file_path), spikeextractors_backend=spikeextractors_backend))
-    conversion_options.update(SpikeGLXLFP=dict(stub_test=stub_test))
+    lf_file_path = session["lf"]
+    if link_raw:
+        source_data.update(SpikeGLXLFPExternal=dict(file_path=str(lf_file_path)))
+    else:
+        source_data.update(
+            SpikeGLXLFP=dict(file_path=str(lf_file_path), spikeextractors_backend=spikeextractors_backend)
+        )
+        conversion_options.update(SpikeGLXLFP=dict(stub_test=stub_test, **recording_options("lfp")))
 
     # Spikes
     phy_directory_path = directory_with_data_path
@@ -54,6 +74,10 @@ for session_path in session_path_list:
     # Behavior
     source_data.update(Behavior=dict(session_path=str(session_path)))
 
+    if preview_duration is not None:
+        for name in source_data:
+            conversion_options.setdefault(name, dict())["preview_duration"] = preview_duration
+
     # Metadata
     converter = Wen21NWBConverter(source_data=source_data)
     metadata = converter.get_metadata()
@@ -71,12 +95,25 @@ for session_path in session_path_list:
     subject_metadata = subject_metadata_from_yaml[subject]
     metadata["Subject"] = dict_deep_update(metadata["Subject"], subject_metadata)
 
-    # Run conversion
+    # Fingerprint, without the random identifier of get_metadata
     nwb_file_name = f"{session_id}.nwb"
     nwbfile_path = output_path / nwb_file_name
+    nwbfile_metadata = {key: value for key, value in metadata["NWBFile"].items() if key != "identifier"}
+    session_fingerprint = fingerprint(
+        session_paths(session) + [phy_directory_path],
+        metadata=dict(metadata=dict(metadata, NWBFile=nwbfile_metadata), conversion_options=conversion_options),
+    )
+    if skip_unchanged and is_up_to_date(nwbfile_path, session_fingerprint):
+        print(f"up to date, skipping {nwbfile_path}")
+        continue
+    if use_deterministic_identifier:
+        metadata["NWBFile"]["identifier"] = deterministic_identifier(session_fingerprint)
+
+    # Run conversion
     converter.run_conversion(
         nwbfile_path=str(nwbfile_path),
         metadata=metadata,
         conversion_options=conversion_options,
         overwrite=True,
     )
+    write_fingerprint(nwbfile_path, session_fingerprint)
@@ -5,7 +5,6 @@ import pandas as pd
 import numpy as np
 
 from pynwb import NWBFile, TimeSeries
-from hdmf.backends.hdf5.h5_utils import H5DataIO
 from ndx_events import Events
 from pynwb.behavior import Position, SpatialSeries
 from nwb_conversion_tools.basedatainterface import BaseDataInterface
@@ -13,6 +12,11 @@ from nwb_conversion_tools.utils.types import FolderPathType
 from nwb_conversion_tools.tools.nwb_helpers import get_module
 from spikeinterface.extractors import SpikeGLXRecordingExtractor
 
+from giocomo_lab_to_nwb.catalog import session_files
+from giocomo_lab_to_nwb.compression import compressed
+from giocomo_lab_to_nwb.preview import clip_times, preview_intervals
+from giocomo_lab_to_nwb.tables import add_intervals
+
 
 class Wen21EventsInterface(BaseDataInterface):
     def __init__(self, session_path: FolderPathType):
@@ -24,11 +28,9 @@ class Wen21EventsInterface(BaseDataInterface):
         session_path = Path(self.source_data["session_path"])
         # Calculate shift
         stream_id = "nidq"
-        nidq_file_name = f"{session_path.stem.replace('g0', 'g0_t0')}.{stream_id}.bin"
-        nidq_file_path = session_path / nidq_file_name
 
         offset_for_behavioral_time_stamps = 0
-        if nidq_file_path.is_file():
+        if session_files(session_path)["nidq"] is not None:
             nidq_extractor = SpikeGLXRecordingExtractor(session_path, stream_id=stream_id)
             channel = "nidq#XA2"  # The channel that indicates change in epoch
             recording_nidq = nidq_extractor
@@ -50,15 +52,17 @@ class Wen21EventsInterface(BaseDataInterface):
 
         return offset_for_behavioral_time_stamps
 
-    def run_conversion(self, nwbfile: NWBFile, metadata: dict):
+    def run_conversion(self, nwbfile: NWBFile, metadata: dict, preview_duration: float = None):
 
         behavior_module = get_module(nwbfile, "behavior")
         session_path = Path(self.source_data["session_path"])
         track_label = next(_ for _ in session_path.name.split("_") if "john" in _)
         no_name_epoch_name = "No name"
+        # Looked up in the catalog built by convert_wen21.py, or scanned once here
+        behavior_files = session_files(session_path)["behavior"]
 
         # Get positions and epochs to calculate beahavioral shift
-        file_path_list = list(session_path.glob("*position.txt"))
+        file_path_list = [Path(path) for path in behavior_files.get("position", [])]
         file_path_list = [path for path in file_path_list if track_label in path.name]
         df_data_list = []
         for position_file_path in file_path_list:
@@ -90,6 +94,8 @@ class Wen21EventsInterface(BaseDataInterface):
         df_position_data["timestamps"] -= offset_for_behavioral_time_stamps
         df_epochs["start_time"] -= offset_for_behavioral_time_stamps
         df_epochs["stop_time"] -= offset_for_behavioral_time_stamps
+        if preview_duration is not None:
+            df_position_data = df_position_data[df_position_data["timestamps"] < preview_duration]
 
         # Add positions to the nwb_file
         position_data = df_position_data.position.values.astype("float", copy=False)
@@ -98,11 +104,11 @@ class Wen21EventsInterface(BaseDataInterface):
         spatial_series_object = SpatialSeries(
             name="position",
             description="position within the virtual reality wheel",
-            data=H5DataIO(position_data, compression="gzip"),
+            data=compressed(position_data, "timeseries"),
             reference_frame="unknown",
             unit="m",
             conversion=0.01,
-            timestamps=position_timestamps,
+            timestamps=compressed(position_timestamps, "timeseries"),
         )
 
         # Add epochs to the nwb-file
@@ -110,12 +116,15 @@ class Wen21EventsInterface(BaseDataInterface):
         behavior_module.add_data_interface(pos_obj)
 
         df_epochs.drop(columns=["epoch_start_by_niqd", "behavioral_to_signal_shift"], inplace=True)
-        rows_as_dicts = df_epochs.T.to_dict().values()
-        nwbfile.add_epoch_column(name="epoch_name", description="the name of the epoch")
-        [nwbfile.add_epoch(**row_dict) for row_dict in rows_as_dicts]
+        add_intervals(
+            nwbfile,
+            "epochs",
+            preview_intervals(df_epochs, preview_duration),
+            descriptions=dict(epoch_name="the name of the epoch"),
+        )
 
         # Add trial time intervals
-        file_path_list = list(session_path.glob("*trial_times.txt"))
+        file_path_list = [Path(path) for path in behavior_files.get("trial_times", [])]
         file_path_list = [path for path in file_path_list if track_label in path.name]
         df_data_list = []
         for trial_file_path in file_path_list:
@@ -136,14 +145,17 @@ class Wen21EventsInterface(BaseDataInterface):
         df_data_concatenated.sort_values(by="stop_time", inplace=True)
         df_data_concatenated["stop_time"] -= offset_for_behavioral_time_stamps
 
-        first_trial_time = nwbfile.epochs.start_time[:][1]
+        first_trial_time = df_epochs["start_time"].iloc[1]
         df_data_concatenated["start_time"] = df_data_concatenated.stop_time.shift(1).fillna(first_trial_time)
-        rows_as_dicts = df_data_concatenated[["start_time", "stop_time", "epoch"]].T.to_dict().values()
-        nwbfile.add_trial_column(name="epoch", description="epoch")
-        [nwbfile.add_trial(**row_dict) for row_dict in rows_as_dicts]
+        add_intervals(
+            nwbfile,
+            "trials",
+            preview_intervals(df_data_concatenated[["start_time", "stop_time", "epoch"]], preview_duration),
+            descriptions=dict(epoch="epoch"),
+        )
 
         # Add lick events
-        file_path_list = list(session_path.glob("*licks.txt"))
+        file_path_list = [Path(path) for path in behavior_files.get("licks", [])]
         file_path_list = [path for path in file_path_list if track_label in path.name]
         df_data_list = []
         for licks_file_path in file_path_list:
@@ -154,22 +166,25 @@ class Wen21EventsInterface(BaseDataInterface):
         df_data_concatenated.sort_values(by="time", inplace=True)
         df_data_concatenated["time"] -= offset_for_behavioral_time_stamps
 
+        if preview_duration is not None:
+            df_data_concatenated = df_data_concatenated[df_data_concatenated["time"] < preview_duration]
+
         lick_timestamps = df_data_concatenated.time.values.astype("float", copy=False)
         lick_positions = df_data_concatenated.position.values.astype("float", copy=False)
 
         position_on_lick_series = TimeSeries(
             name="lick events",
             description="lick events timestamps and their corresponding position",
-            data=lick_positions,
+            data=compressed(lick_positions, "events"),
             unit="m",
             conversion=0.01,
-            timestamps=lick_timestamps,
+            timestamps=compressed(lick_timestamps, "events"),
         )
 
         behavior_module.add(position_on_lick_series)
 
         # Add reward times
-        file_path_list = list(session_path.glob("*reward_times.txt"))
+        file_path_list = [Path(path) for path in behavior_files.get("reward_times", [])]
         file_path_list = [path for path in file_path_list if track_label in path.name]
         df_data_list = []
         for reward_file_path in file_path_list:
@@ -180,10 +195,12 @@ class Wen21EventsInterface(BaseDataInterface):
         df_data_concatenated.sort_values(by="reward_time_stamps", inplace=True)
         df_data_concatenated["reward_time_stamps"] -= offset_for_behavioral_time_stamps
 
-        reward_timestamps = df_data_concatenated.reward_time_stamps.values.astype("float", copy=False)
+        reward_timestamps = clip_times(
+            df_data_concatenated.reward_time_stamps.values.astype("float", copy=False), preview_duration
+        )
         events = Events(
             name=f"reward_times",
             description="timestamps for rewards",
-            timestamps=reward_timestamps,
+            timestamps=compressed(reward_timestamps, "events"),
         )
         behavior_module.add(events)
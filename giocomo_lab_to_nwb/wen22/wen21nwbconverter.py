@@ -1,10 +1,28 @@
 from nwb_conversion_tools import NWBConverter, SpikeGLXRecordingInterface, SpikeGLXLFPInterface, PhySortingInterface
 from wen21behaviorinterface import Wen21EventsInterface
 
-class Wen21NWBConverter(NWBConverter):
+from giocomo_lab_to_nwb.preview import PreviewMixin
+from giocomo_lab_to_nwb.spikeglx_interface import ExternalLinkMixin, SpikeGLXExternalInterface
+
+
+class Wen21RecordingInterface(PreviewMixin, SpikeGLXRecordingInterface):
+    """SpikeGLX AP recording, with the preview_duration conversion option."""
+
+
+class Wen21LFPInterface(PreviewMixin, SpikeGLXLFPInterface):
+    """SpikeGLX LF recording, with the preview_duration conversion option."""
+
+
+class Wen21SortingInterface(PreviewMixin, PhySortingInterface):
+    """Phy sorting, with the preview_duration conversion option."""
+
+
+class Wen21NWBConverter(ExternalLinkMixin, NWBConverter):
     data_interface_classes = dict(
-        SpikeGLXRecording=SpikeGLXRecordingInterface,
-        SpikeGLXLFP=SpikeGLXLFPInterface,
-        PhySorting=PhySortingInterface,
+        SpikeGLXRecording=Wen21RecordingInterface,
+        SpikeGLXLFP=Wen21LFPInterface,
+        SpikeGLXRecordingExternal=SpikeGLXExternalInterface,
+        SpikeGLXLFPExternal=SpikeGLXExternalInterface,
+        PhySorting=Wen21SortingInterface,
         Behavior=Wen21EventsInterface
     )
@@ -14,15 +14,17 @@ setup(
     author_email='kristin@scenda.io',
     packages=find_packages(),
     include_package_data=True,
+    package_data={'giocomo_lab_to_nwb': ['compression.yml']},
     install_requires=['pynwb',
                       'numpy',
                       'scipy',
-                      'hdf5storage',
+                      'h5py',
                       'pytz',
                       'uuid',
                       'tkcalendar',
                       'PyYAML',
                       'nwbn_conversion_tools==0.1.1',
                       'ndx_labmetadata_giocomo',
-                      ]
+                      ],
+    extras_require={'blosc': ['hdf5plugin']}
 )
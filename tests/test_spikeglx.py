@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from giocomo_lab_to_nwb.spikeglx import spikeglx_layout
+
+N_PROBE_CHANNELS = 384
+N_SAMPLES = 10
+
+
+def imro_table(probe_type=0, ap_gain=500, lf_gain=250):
+    entries = ''.join('({} 0 0 {} {} 1)'.format(channel, ap_gain, lf_gain) for channel in range(N_PROBE_CHANNELS))
+    return '({},{}){}'.format(probe_type, N_PROBE_CHANNELS, entries)
+
+
+def write_recording(tmp_path, name, sns_ap_lf_sy, subset, probe_type=0):
+    n_channels = sum(int(value) for value in sns_ap_lf_sy.split(','))
+    meta = dict(
+        nSavedChans=n_channels,
+        imSampRate=2500 if '.lf.' in name else 30000,
+        fileSizeBytes=N_SAMPLES * n_channels * 2,
+        imAiRangeMax=0.6,
+        snsApLfSy=sns_ap_lf_sy,
+        snsSaveChanSubset=subset,
+        **{'~imroTbl': imro_table(probe_type)},
+    )
+    with open(tmp_path / name.replace('.bin', '.meta'), 'w') as f:
+        f.writelines('{}={}\n'.format(key, value) for key, value in meta.items())
+    np.zeros((N_SAMPLES, n_channels), dtype='<i2').tofile(tmp_path / name)
+    return tmp_path / name
+
+
+@pytest.mark.parametrize('subset', ['all', '0:383,768'])
+def test_ap_layout(tmp_path, subset):
+    layout = spikeglx_layout(write_recording(tmp_path, 'session_g0_t0.imec0.ap.bin', '384,0,1', subset))
+    conversion = 0.6 / 512
+    assert layout['n_channels'] == N_PROBE_CHANNELS + 1
+    assert layout['n_samples'] == N_SAMPLES
+    assert layout['conversion'] == pytest.approx(conversion)
+    np.testing.assert_allclose(layout['channel_conversion'][:-1], 1. / 500)
+    assert layout['channel_conversion'][-1] == pytest.approx(1. / conversion)
+
+
+@pytest.mark.parametrize('subset', ['all', '384:767,768'])
+def test_lf_layout(tmp_path, subset):
+    layout = spikeglx_layout(write_recording(tmp_path, 'session_g0_t0.imec0.lf.bin', '0,384,1', subset))
+    conversion = 0.6 / 512
+    assert layout['n_channels'] == N_PROBE_CHANNELS + 1
+    assert layout['sampling_rate'] == 2500.
+    np.testing.assert_allclose(layout['channel_conversion'][:-1], 1. / 250)
+    assert layout['channel_conversion'][-1] == pytest.approx(1. / conversion)
+
+
+def test_channel_subset(tmp_path):
+    layout = spikeglx_layout(write_recording(tmp_path, 'session_g0_t0.imec0.lf.bin', '0,2,1', '384,386,768'))
+    assert layout['n_channels'] == 3
+    np.testing.assert_allclose(layout['channel_conversion'][:2], 1. / 250)
+    assert layout['channel_conversion'][2] == pytest.approx(512 / 0.6)
+
+
+@pytest.mark.parametrize('subset', ['all', '0:383,384'])
+def test_fixed_gain_layout(tmp_path, subset):
+    layout = spikeglx_layout(write_recording(tmp_path, 'session_g0_t0.imec0.ap.bin', '384,0,1', subset, probe_type=21))
+    conversion = 0.6 / 8192
+    assert layout['conversion'] == pytest.approx(conversion)
+    np.testing.assert_allclose(layout['channel_conversion'][:-1], 1. / 80)
+    assert layout['channel_conversion'][-1] == pytest.approx(1. / conversion)
@@ -0,0 +1,36 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+from pynwb import NWBFile, NWBHDF5IO
+
+from giocomo_lab_to_nwb.preview import preview_intervals
+from giocomo_lab_to_nwb.tables import add_intervals
+
+DESCRIPTIONS = dict(visual_contrast='the visual contrast setting of that trial')
+
+
+def make_nwbfile():
+    return NWBFile('session', 'identifier', datetime.datetime(2019, 4, 17, tzinfo=datetime.timezone.utc))
+
+
+def trials():
+    return pd.DataFrame(dict(start_time=[10., 20.], stop_time=[20., 30.], visual_contrast=[100., 50.]))
+
+
+def test_add_intervals(tmp_path):
+    nwbfile = make_nwbfile()
+    add_intervals(nwbfile, 'trials', trials(), descriptions=DESCRIPTIONS)
+    with NWBHDF5IO(str(tmp_path / 'trials.nwb'), 'w') as io:
+        io.write(nwbfile)
+    with NWBHDF5IO(str(tmp_path / 'trials.nwb'), 'r') as io:
+        np.testing.assert_array_equal(io.read().trials['visual_contrast'][:], [100., 50.])
+
+
+def test_add_intervals_without_rows(tmp_path):
+    # a preview that ends before the first trial starts
+    nwbfile = make_nwbfile()
+    assert add_intervals(nwbfile, 'trials', preview_intervals(trials(), 5.), descriptions=DESCRIPTIONS) is None
+    assert nwbfile.trials is None
+    with NWBHDF5IO(str(tmp_path / 'no_trials.nwb'), 'w') as io:
+        io.write(nwbfile)
@@ -0,0 +1,23 @@
+import numpy as np
+
+from giocomo_lab_to_nwb.utils import cluster_templates, group_by_label
+
+
+def test_cluster_templates():
+    spike_cluster = np.array([3, 1, 3, 1])
+    spike_templates = np.array([7, 5, 7, 5])
+    np.testing.assert_array_equal(cluster_templates(spike_cluster, spike_templates, [3, 1]), [7, 5])
+
+
+def test_cluster_templates_split_cluster():
+    assert cluster_templates([1, 1, 3, 3], [5, 6, 7, 7], [1, 3]) is None
+
+
+def test_cluster_templates_empty_cluster():
+    # sp/cids keeps clusters without spikes, which have no template
+    spike_cluster = np.array([1, 1, 3, 3])
+    cluster_ids = np.array([1, 2, 3])
+    assert cluster_templates(spike_cluster, np.array([5, 5, 7, 7]), cluster_ids) is None
+
+    order, index, ids = group_by_label(spike_cluster, cluster_ids)
+    np.testing.assert_array_equal(index, [2, 2, 4])